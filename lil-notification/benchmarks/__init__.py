@@ -0,0 +1,7 @@
+"""
+Benchmarks for the real-time path and the API.
+
+Each module exposes a `run()` function; use `fab benchmark:<module>` to run one.
+Benchmarks create (and destroy) their own test database and use the
+in-memory channel layer, so they are safe to run against a dev environment.
+"""
@@ -0,0 +1,139 @@
+"""
+Publish throughput of the sharded channel layer as the number of Redis shards grows.
+
+    fab benchmark:channel_layer,shards=1;2;4;8,messages=2000
+
+For each shard count, `processes` layer instances (standing in for worker processes) subscribe
+`subscribers` channels to each of `groups` maintenance groups; then `concurrency` publishers
+group_send `messages` broadcasts across the groups. Reports broadcasts and deliveries per second,
+and how many groups move to another shard when one more is added, compared to channels_redis' own
+placement.
+
+By default, the shards are in-process stand-ins (testing.InProcessRedis), each serving one command
+at a time in `service_time` seconds, like a single-threaded Redis would; pass hosts=<host:port;...>
+to use real Redis servers instead, at most as many shards as hosts.
+"""
+import asyncio
+import itertools
+
+from asgiref.sync import async_to_sync
+from channels_redis.core import RedisChannelLayer
+
+from lil_notification.layers import HashRing, ShardedRedisChannelLayer
+from lil_notification.models import channel_message, maintenance_group
+from lil_notification.testing import InProcessShardedChannelLayer
+
+from .utils import Timer, print_table, save_results
+
+
+def split(value, convert=str):
+    # fab's task arguments can't contain commas
+    return [convert(item) for item in str(value).split(';') if item]
+
+
+def moved_groups(groups, shards):
+    """
+    The fraction of `groups` on another shard once a shard is added to `shards`,
+    with our hash ring, and with channels_redis' ranges of CRCs.
+    """
+    nodes = ['redis{}'.format(i) for i in range(shards + 1)]
+    ring, bigger_ring = HashRing(nodes[:-1]), HashRing(nodes)
+    ranges, bigger_ranges = RedisChannelLayer(hosts=nodes[:-1]), RedisChannelLayer(hosts=nodes)
+    return (
+        sum(ring.node(group) != bigger_ring.node(group) for group in groups) / len(groups),
+        sum(ranges.consistent_hash(group) != bigger_ranges.consistent_hash(group) for group in groups) / len(groups),
+    )
+
+
+async def publish_all(layers, groups, messages, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    publishers = itertools.cycle(layers)
+    targets = itertools.islice(itertools.cycle(groups), messages)
+
+    async def publish(layer, group, n):
+        async with semaphore:
+            await layer.group_send(group, channel_message(group, '{{"n": {}}}'.format(n)))
+
+    await asyncio.gather(*[publish(next(publishers), group, n) for n, group in enumerate(targets)])
+
+
+async def measure(layers, groups, subscribers, messages, concurrency, service_time):
+    await layers[0].flush()
+    processes = itertools.cycle(layers)
+    for group in groups:
+        for _ in range(subscribers):
+            layer = next(processes)
+            await layer.group_add(group, await layer.new_channel())
+    if service_time is not None:
+        for server in layers[0].servers:
+            server.service_time = service_time
+    with Timer() as timer:
+        await publish_all(layers, groups, messages, concurrency)
+    if service_time is not None:
+        for server in layers[0].servers:
+            server.service_time = 0
+    await layers[0].flush()
+    return timer.elapsed
+
+
+def run(shards='1;2;4;8', groups=100, subscribers=10, processes=16, messages=1000, concurrency=32,
+        service_time=0.0001, hosts=None, output=None):
+    shard_counts = split(shards, int)
+    groups, subscribers, processes = int(groups), int(subscribers), int(processes)
+    messages, concurrency, service_time = int(messages), int(concurrency), float(service_time)
+    if hosts:
+        hosts = [(host, int(port)) for host, port in (item.rsplit(':', 1) for item in split(hosts))]
+        shard_counts = [count for count in shard_counts if count <= len(hosts)]
+    group_names = [maintenance_group('app{}'.format(i), 'prod') for i in range(groups)]
+    # more groups than we publish to, to measure how many move
+    all_groups = [maintenance_group('app{}'.format(i), tier) for i in range(2000) for tier in ('prod', 'stage', 'dev')]
+
+    rows = []
+    results = {}
+    for count in shard_counts:
+        # generous capacity: we don't drain the channels
+        capacity = messages * subscribers
+        if hosts:
+            layers = [ShardedRedisChannelLayer(hosts=hosts[:count], capacity=capacity) for _ in range(processes)]
+        else:
+            shard_hosts = [('benchmark-redis', port) for port in range(count)]
+            layers = [InProcessShardedChannelLayer(hosts=shard_hosts, capacity=capacity) for _ in range(processes)]
+        elapsed = async_to_sync(measure)(
+            layers, group_names, subscribers, messages, concurrency, None if hosts else service_time
+        )
+        ring_moved, ranges_moved = moved_groups(all_groups, count)
+        results[str(count)] = {
+            'broadcasts_per_second': round(messages / elapsed, 1),
+            'deliveries_per_second': round(messages * subscribers / elapsed, 1),
+            'moved_on_adding_a_shard': {
+                'hash_ring': round(ring_moved, 3),
+                'crc_ranges': round(ranges_moved, 3),
+            },
+        }
+        rows.append((
+            count,
+            results[str(count)]['broadcasts_per_second'],
+            results[str(count)]['deliveries_per_second'],
+            '{:.0%}'.format(ring_moved),
+            '{:.0%}'.format(ranges_moved),
+        ))
+
+    print_table(
+        'Channel layer publish throughput ({}; {} groups of {} subscribers in {} processes, {} broadcasts)'.format(
+            'Redis' if hosts else 'in-process shards, {}s per command'.format(service_time),
+            groups, subscribers, processes, messages
+        ),
+        ('shards', 'broadcasts/s', 'deliveries/s', 'moved +1 (ring)', 'moved +1 (channels_redis)'),
+        rows
+    )
+    save_results('channel_layer', {
+        'shards': shard_counts,
+        'groups': groups,
+        'subscribers': subscribers,
+        'processes': processes,
+        'messages': messages,
+        'concurrency': concurrency,
+        'service_time': None if hosts else service_time,
+        'hosts': len(hosts) if hosts else None,
+    }, results, output)
+    return results
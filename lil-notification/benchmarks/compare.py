@@ -0,0 +1,39 @@
+"""
+Compare two runs of a benchmark, as saved by utils.save_results, e.g. before and after a change.
+
+    fab benchmark:compare,before=benchmarks/results/websocket_fanout-abc1234.json,after=benchmarks/results/websocket_fanout-def5678.json
+"""
+import json
+
+from .utils import print_table
+
+
+def flatten(results, prefix=''):
+    values = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, '{}{}.'.format(prefix, key)))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[prefix + key] = value
+    return values
+
+
+def run(before, after):
+    with open(before) as f:
+        before = json.load(f)
+    with open(after) as f:
+        after = json.load(f)
+    if before['params'] != after['params']:
+        print('Warning: the runs used different parameters:\n  {}\n  {}'.format(before['params'], after['params']))
+
+    old, new = flatten(before['results']), flatten(after['results'])
+    rows = []
+    for key in sorted(set(old) & set(new)):
+        change = '{:+.1f}%'.format((new[key] - old[key]) * 100.0 / old[key]) if old[key] else ''
+        rows.append((key, old[key], new[key], change))
+    print_table(
+        '{}: {} -> {}'.format(after['benchmark'], before['revision'], after['revision']),
+        ('metric', 'before', 'after', 'change'),
+        rows
+    )
+    return rows
@@ -0,0 +1,104 @@
+"""
+Connect throughput of ChatConsumer versus the thread-backed consumer it replaced.
+
+    fab benchmark:consumer_connect,connections=2000,concurrency=500
+
+Pass conn_max_age=600 to reuse DB connections across handlers; otherwise both
+consumers spend most of their time opening Postgres connections.
+"""
+import asyncio
+import json
+
+from asgiref.sync import async_to_sync
+from channels.generic.websocket import WebsocketConsumer
+from channels.exceptions import DenyConnection
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+
+from django.db import connections as db_connections
+from django.urls import path
+
+from lil_notification.consumers import ChatConsumer
+from lil_notification.models import Application, MaintenanceEvent, ACTIVE_STATUSES
+
+from .utils import Timer, benchmark_environment, print_table, reset_channel_layer
+
+
+class SyncChatConsumer(WebsocketConsumer):
+    """
+        The pre-asyncio ChatConsumer, kept here as the baseline.
+    """
+    def connect(self):
+        self.app_slug = self.scope['url_route']['kwargs']['app_slug']
+        self.tier = self.scope['url_route']['kwargs']['tier']
+        self.group_name = 'maintenance_{}_{}'.format(self.app_slug, self.tier)
+
+        try:
+            application = Application.objects.get(slug=self.app_slug, tier=self.tier)
+        except Application.DoesNotExist:
+            raise DenyConnection
+
+        async_to_sync(self.channel_layer.group_add)(
+            self.group_name,
+            self.channel_name
+        )
+        self.accept()
+
+        active = application.maintenance_events.filter(status__in=ACTIVE_STATUSES)
+        if active:
+            self.send(text_data=json.dumps(active[0].get_details_for_ws()))
+
+    def disconnect(self, close_code):
+        async_to_sync(self.channel_layer.group_discard)(
+            self.group_name,
+            self.channel_name
+        )
+
+    def maintenance_msg(self, event):
+        self.send(text_data=json.dumps(event))
+
+
+async def connect_all(application, connections, concurrency):
+    """
+        Open `connections` sockets, at most `concurrency` at a time, and close them again.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def connect_one():
+        async with semaphore:
+            communicator = WebsocketCommunicator(application, '/ws/perma/prod')
+            connected, _ = await communicator.connect(timeout=60)
+            assert connected
+            # the active event is sent right after accept
+            await communicator.receive_from(timeout=60)
+            return communicator
+
+    communicators = await asyncio.gather(*[connect_one() for _ in range(connections)])
+    for communicator in communicators:
+        await communicator.disconnect()
+
+
+def run(connections=1000, concurrency=250, rounds=3, conn_max_age=None):
+    connections, concurrency, rounds = int(connections), int(concurrency), int(rounds)
+    if conn_max_age is not None:
+        db_connections.databases['default']['CONN_MAX_AGE'] = int(conn_max_age)
+    rows = []
+    with benchmark_environment():
+        app = Application.objects.create(slug='perma', tier='prod')
+        MaintenanceEvent.objects.create(application=app, status='in_progress')
+        for name, consumer in [('sync (old)', SyncChatConsumer), ('async', ChatConsumer)]:
+            application = URLRouter([path('ws/<app_slug>/<tier>', consumer)])
+            best = None
+            for _ in range(rounds):
+                reset_channel_layer()
+                with Timer() as timer:
+                    async_to_sync(connect_all)(application, connections, concurrency)
+                best = timer.elapsed if best is None else min(best, timer.elapsed)
+            rows.append((name, connections, concurrency, '{:.3f}'.format(best), '{:.0f}'.format(connections / best)))
+
+    print_table(
+        'WebSocket connect throughput (best of {})'.format(rounds),
+        ('consumer', 'connections', 'concurrency', 'seconds', 'connects/s'),
+        rows
+    )
+    return rows
@@ -0,0 +1,69 @@
+"""
+CPU cost of delivering one broadcast to N subscribers, per-socket encoding versus encode-once.
+
+    fab benchmark:fanout_encoding,subscribers=1000;10000;100000
+
+For each subscriber, the Redis channel layer packs and unpacks the message with msgpack,
+and the consumer turns it into WebSocket text. Previously that meant json.dumps() of the
+whole message dict (including its channel-layer `type`) in every consumer; now the payload
+is encoded once by the sender and each consumer passes the text straight through.
+"""
+from datetime import datetime
+import json
+import time
+
+import msgpack
+
+from .utils import print_table
+
+
+DETAILS = {
+    'active': True,
+    'status': 'in_progress',
+    'scheduled_start': datetime(2018, 4, 18, 16, 0).strftime('%c %Z'),
+    'scheduled_end': datetime(2018, 4, 18, 17, 0).strftime('%c %Z'),
+}
+
+
+def per_socket_encoding(subscribers):
+    message = {'type': 'maintenance_msg'}
+    message.update(DETAILS)
+    for _ in range(subscribers):
+        event = msgpack.unpackb(msgpack.packb(message, use_bin_type=True), encoding='utf8')
+        json.dumps(event)
+
+
+def encode_once(subscribers):
+    message = {'type': 'maintenance_msg', 'text': json.dumps(DETAILS)}
+    for _ in range(subscribers):
+        event = msgpack.unpackb(msgpack.packb(message, use_bin_type=True), encoding='utf8')
+        event['text']
+
+
+def cpu_time(func, *args):
+    start = time.process_time()
+    func(*args)
+    return time.process_time() - start
+
+
+def run(subscribers='1000;10000;100000', rounds=5):
+    counts = [int(count) for count in str(subscribers).split(';')]
+    rounds = int(rounds)
+    rows = []
+    for count in counts:
+        before = min(cpu_time(per_socket_encoding, count) for _ in range(rounds))
+        after = min(cpu_time(encode_once, count) for _ in range(rounds))
+        rows.append((
+            count,
+            '{:.2f}'.format(before * 1000),
+            '{:.2f}'.format(after * 1000),
+            '{:.2f}'.format((before - after) * 1000),
+            '{:.0%}'.format((before - after) / before),
+        ))
+
+    print_table(
+        'CPU per broadcast (best of {})'.format(rounds),
+        ('subscribers', 'per-socket ms', 'encode-once ms', 'saved ms', 'saved'),
+        rows
+    )
+    return rows
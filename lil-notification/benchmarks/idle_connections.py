@@ -0,0 +1,150 @@
+"""
+Memory per idle WebSocket connection, and the cost of heartbeats, projected to 100k connections per worker.
+
+    fab benchmark:idle_connections,connections=20000
+
+Opens `connections` idle ChatConsumer sockets with ?heartbeat=1, in-process, with the in-memory
+channel layer. Python memory allocated while connecting is measured with tracemalloc, and split
+between the server (consumers, routing, channel layer) and the test clients by where it was allocated.
+Then times one heartbeat sweep pinging every socket, and one reaping every socket.
+
+The target is TARGET_BYTES_PER_CONNECTION of server-side Python memory per idle connection:
+about 1.6 GiB for 100k connections in one worker, leaving room for the kernel's socket buffers.
+(With the Redis channel layer, each channel's queue lives in Redis instead.)
+"""
+import asyncio
+import sys
+import tracemalloc
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+
+from django.db import connections as db_connections
+
+from config.routing import application as asgi_application
+from lil_notification import consumers
+from lil_notification.heartbeat import Heartbeat
+from lil_notification.models import Application
+from lil_notification.ratelimit import ConnectAdmission
+
+from .utils import Timer, benchmark_environment, print_table, reset_channel_layer, save_results
+
+
+TARGET_BYTES_PER_CONNECTION = 16 * 1024
+PROJECTED_CONNECTIONS = 100000
+
+CLIENT_FILES = ('asgiref/testing.py', 'channels/testing/')
+
+
+def allocated_by_server(trace):
+    """
+    Whether the innermost frame of our code or the test client's that made this allocation is ours.
+    """
+    frames = list(trace.traceback)
+    if sys.version_info >= (3, 7):
+        # oldest first, since 3.7
+        frames.reverse()
+    for frame in frames:
+        if any(name in frame.filename for name in CLIENT_FILES):
+            return False
+        if 'site-packages/channels/' in frame.filename or 'lil_notification' in frame.filename:
+            return True
+    return True
+
+
+async def connect_all(connections, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def connect_one():
+        async with semaphore:
+            communicator = WebsocketCommunicator(asgi_application, '/ws/perma/prod?heartbeat=1')
+            connected, _ = await communicator.connect(timeout=60)
+            assert connected
+            return communicator
+
+    return await asyncio.gather(*[connect_one() for _ in range(connections)])
+
+
+async def measure(connections, concurrency, heartbeat):
+    # warm up: imports, caches and the like
+    await asyncio.gather(*[communicator.disconnect() for communicator in await connect_all(concurrency, concurrency)])
+
+    tracemalloc.start(25)
+    before = tracemalloc.take_snapshot()
+    communicators = await connect_all(connections, concurrency)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    total = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    server = (
+        sum(trace.size for trace in after.traces if allocated_by_server(trace)) -
+        sum(trace.size for trace in before.traces if allocated_by_server(trace))
+    )
+    del before, after
+
+    assert len(heartbeat) == connections
+    with Timer() as ping:
+        await heartbeat.beat()
+    # drain the pings
+    for communicator in communicators:
+        await communicator.receive_from()
+
+    heartbeat.timeout = -1
+    with Timer() as reap:
+        await heartbeat.beat()
+    assert not get_channel_layer().groups.get('maintenance_perma_prod')
+    for communicator in communicators:
+        await communicator.disconnect()
+    return total / connections, server / connections, ping.elapsed, reap.elapsed
+
+
+def run(connections=10000, concurrency=500, conn_max_age=600, output=None):
+    connections, concurrency = int(connections), int(concurrency)
+    db_connections.databases['default']['CONN_MAX_AGE'] = int(conn_max_age)
+    admission, heartbeat = consumers.connect_admission, consumers.heartbeat
+    consumers.connect_admission = ConnectAdmission(
+        max_concurrent=connections, rate=connections, burst=connections, max_retry_after=60
+    )
+    # swept by hand, below
+    consumers.heartbeat = Heartbeat(interval=3600, timeout=3600)
+    try:
+        with benchmark_environment():
+            Application.objects.create(slug='perma', tier='prod')
+            reset_channel_layer()
+            total, server, ping_seconds, reap_seconds = async_to_sync(measure)(
+                connections, concurrency, consumers.heartbeat
+            )
+    finally:
+        consumers.connect_admission, consumers.heartbeat = admission, heartbeat
+
+    scale = PROJECTED_CONNECTIONS / connections
+    results = {
+        'memory': {
+            'bytes_per_connection': round(total),
+            'server_bytes_per_connection': round(server),
+            'server_mib_at_100k': round(server * PROJECTED_CONNECTIONS / 2 ** 20, 1),
+            'target_bytes_per_connection': TARGET_BYTES_PER_CONNECTION,
+        },
+        'heartbeat': {
+            'ping_sweep_seconds_at_100k': round(ping_seconds * scale, 3),
+            'reap_seconds_at_100k': round(reap_seconds * scale, 3),
+        },
+    }
+    print_table(
+        'Idle WebSocket connections ({} measured, projected to {})'.format(connections, PROJECTED_CONNECTIONS),
+        ('B/conn (all)', 'B/conn (server)', 'MiB @100k', 'target B/conn', 'ping sweep s @100k', 'reap s @100k'),
+        [(
+            results['memory']['bytes_per_connection'],
+            results['memory']['server_bytes_per_connection'],
+            results['memory']['server_mib_at_100k'],
+            '{} ({})'.format(TARGET_BYTES_PER_CONNECTION, 'met' if server <= TARGET_BYTES_PER_CONNECTION else 'MISSED'),
+            results['heartbeat']['ping_sweep_seconds_at_100k'],
+            results['heartbeat']['reap_seconds_at_100k'],
+        )]
+    )
+    save_results('idle_connections', {
+        'connections': connections,
+        'concurrency': concurrency,
+        'conn_max_age': int(conn_max_age),
+    }, results, output)
+    return results
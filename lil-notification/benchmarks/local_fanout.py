@@ -0,0 +1,110 @@
+"""
+Broadcasting to one big group, with and without the channel layer's local fan-out.
+
+    fab benchmark:local_fanout,subscribers=5000,processes=8
+
+`processes` layer instances (standing in for worker processes) subscribe `subscribers` channels
+between them to one maintenance group. `broadcasts` group_sends are published, one at a time;
+then every subscriber receives every broadcast. Reports, for each mode, the Redis commands and
+bytes per broadcast, the time to publish one, and the time until every subscriber had them all.
+
+By default, Redis is an in-process stand-in (testing.InProcessRedis) serving one command at a time
+in `service_time` seconds; pass host=<host:port> to use a real Redis server instead.
+"""
+import asyncio
+import itertools
+
+from asgiref.sync import async_to_sync
+
+from lil_notification.layers import ShardedRedisChannelLayer
+from lil_notification.models import channel_message, maintenance_group
+from lil_notification.testing import InProcessShardedChannelLayer
+
+from .utils import Timer, print_table, save_results
+
+
+GROUP = maintenance_group('perma', 'prod')
+
+
+async def measure(layers, subscribers, broadcasts, service_time):
+    server = getattr(layers[0], 'servers', [None])[0]
+    await layers[0].flush()
+    processes = itertools.cycle(layers)
+    channels = []
+    for _ in range(subscribers):
+        layer = next(processes)
+        channel = await layer.new_channel()
+        await layer.group_add(GROUP, channel)
+        channels.append((layer, channel))
+
+    if server:
+        server.service_time = service_time
+        commands, pushed = server.commands, server.bytes_pushed
+    with Timer() as publish:
+        for n in range(broadcasts):
+            await layers[n % len(layers)].group_send(GROUP, channel_message(GROUP, '{{"n": {}}}'.format(n)))
+    traffic = (server.commands - commands, server.bytes_pushed - pushed) if server else (None, None)
+
+    async def receive_all(layer, channel):
+        received = [(await layer.receive(channel))['text'] for _ in range(broadcasts)]
+        assert received == ['{{"n": {}}}'.format(n) for n in range(broadcasts)]
+
+    with Timer() as deliver:
+        await asyncio.gather(*[receive_all(layer, channel) for layer, channel in channels])
+    if server:
+        server.service_time = 0
+    await layers[0].flush()
+    return publish.elapsed, deliver.elapsed, traffic
+
+
+def run(subscribers=2000, processes=8, broadcasts=20, service_time=0.0001, host=None, output=None):
+    subscribers, processes, broadcasts, service_time = int(subscribers), int(processes), int(broadcasts), float(service_time)
+    hosts = [tuple(host.rsplit(':', 1))] if host else [('benchmark-redis', 0)]
+    hosts = [(name, int(port)) for name, port in hosts]
+    # every broadcast stays queued until the subscribers receive them all
+    capacity = subscribers * broadcasts
+
+    rows = []
+    results = {}
+    for mode, local_fanout in (('per_channel', False), ('local_fanout', True)):
+        if host:
+            layers = [ShardedRedisChannelLayer(hosts=hosts, local_fanout=local_fanout, capacity=capacity) for _ in range(processes)]
+        else:
+            layers = [
+                InProcessShardedChannelLayer(hosts=hosts, local_fanout=local_fanout, capacity=capacity)
+                for _ in range(processes)
+            ]
+        publish_seconds, deliver_seconds, (commands, pushed) = async_to_sync(measure)(
+            layers, subscribers, broadcasts, service_time
+        )
+        results[mode] = {
+            'publish_ms_per_broadcast': round(publish_seconds * 1000 / broadcasts, 2),
+            'deliver_seconds': round(deliver_seconds, 3),
+        }
+        if commands is not None:
+            results[mode]['redis_commands_per_broadcast'] = round(commands / broadcasts, 1)
+            results[mode]['redis_bytes_per_broadcast'] = round(pushed / broadcasts)
+        rows.append((
+            mode,
+            results[mode].get('redis_commands_per_broadcast', '-'),
+            results[mode].get('redis_bytes_per_broadcast', '-'),
+            results[mode]['publish_ms_per_broadcast'],
+            results[mode]['deliver_seconds'],
+        ))
+
+    print_table(
+        'Broadcasts to one group ({}; {} subscribers in {} processes, {} broadcasts)'.format(
+            'Redis' if host else 'in-process Redis, {}s per command'.format(service_time),
+            subscribers, processes, broadcasts
+        ),
+        ('mode', 'Redis commands/broadcast', 'bytes pushed/broadcast', 'publish ms/broadcast', 'deliver all s'),
+        rows
+    )
+    save_results('local_fanout', {
+        'subscribers': subscribers,
+        'processes': processes,
+        'broadcasts': broadcasts,
+        'service_time': None if host else service_time,
+        'redis': bool(host),
+    }, results, output)
+    return results
@@ -0,0 +1,162 @@
+"""
+Latency and SQL query counts of the REST API views, against a large synthetic dataset.
+
+    fab benchmark:rest_api,applications=500,events=300000,requests=50
+
+Generates `applications` applications with `events` maintenance events between them, each with
+`history` rows of history, in a few set-based inserts; then makes `requests` requests of each scenario
+through the Django test client, as an admin. Reports p50/p95/p99 latency and the number of
+SQL queries per request, and writes them as JSON (to `output`, or benchmarks/results/).
+"""
+import itertools
+import json
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from lil_notification.models import Application, MaintenanceEvent, ACTIVE_STATUSES
+
+from .utils import Timer, benchmark_environment, percentile, print_table, save_results
+
+
+History = MaintenanceEvent.history.model
+
+REASONS = [
+    'Database upgrade',
+    'Security patches',
+    'Moving to new servers',
+    'Scheduled downtime',
+    'Emergency fix',
+]
+
+
+def generate(applications, events, history):
+    """
+    Insert the synthetic dataset, bypassing model signals: a few set-based INSERTs,
+    so that Postgres generates the rows without a round trip (or a model instance) each.
+    Each application's latest event is active; the rest are completed or canceled.
+    """
+    tiers = ['prod', 'stage', 'dev']
+    Application.objects.bulk_create(
+        [Application(slug='app{}'.format(i // len(tiers)), tier=tiers[i % len(tiers)]) for i in range(applications)]
+    )
+    per_app = max(events // applications, 1)
+    tables = {
+        'application': connection.ops.quote_name(Application._meta.db_table),
+        'event': connection.ops.quote_name(MaintenanceEvent._meta.db_table),
+        'history': connection.ops.quote_name(History._meta.db_table),
+    }
+    with connection.cursor() as cursor:
+        cursor.execute('''
+            INSERT INTO {event} (application_id, status, scheduled_start, scheduled_end, started, ended, reason, modified)
+            SELECT id,
+                CASE WHEN latest THEN (%(active)s)[1 + id %% 2] WHEN n %% 4 = 0 THEN 'canceled' ELSE 'completed' END,
+                start, start + (1 + n %% 8) * interval '1 hour',
+                CASE WHEN latest THEN NULL ELSE start END,
+                CASE WHEN latest THEN NULL ELSE start + (1 + n %% 8) * interval '1 hour' END,
+                (%(reasons)s)[1 + (id + n) %% %(reason_count)s],
+                start
+            FROM (
+                SELECT a.id, n, n = %(per_app)s AS latest, now() - (%(per_app)s - n) * interval '1 day' AS start
+                FROM {application} a CROSS JOIN generate_series(1, %(per_app)s) n
+            ) AS events
+            ORDER BY events.start, events.id
+        '''.format(**tables), {
+            'active': ACTIVE_STATUSES,
+            'reasons': REASONS,
+            'reason_count': len(REASONS),
+            'per_app': per_app,
+        })
+        columns = ', '.join(connection.ops.quote_name(field.column) for field in MaintenanceEvent._meta.fields)
+        cursor.execute('''
+            INSERT INTO {history} ({columns}, history_date, history_type)
+            SELECT {columns}, modified + n * interval '1 minute', CASE WHEN n = 0 THEN '+' ELSE '~' END
+            FROM {event} CROSS JOIN generate_series(0, %s - 1) n
+            ORDER BY id, n
+        '''.format(columns=columns, **tables), [history])
+
+
+def scenarios(application, other_events, deep_offset):
+    """
+    (name, method, request) for each scenario, where request() returns the (path, data) of the next request.
+    Requests that change data only change `reason`, so that the dataset stays the same from request to request.
+    """
+    reasons = itertools.cycle(REASONS)
+    events = itertools.cycle(other_events)
+    app_events = '/api/applications/{}/maintenance-events/'.format(application.id)
+    return [
+        ('applications', 'get', lambda: ('/api/applications/', None)),
+        ('events', 'get', lambda: ('/api/maintenance-events/', None)),
+        ('events, deep offset', 'get', lambda: (
+            '/api/maintenance-events/?offset={}&ordering=-scheduled_start'.format(deep_offset), None
+        )),
+        ('events, keyset', 'get', lambda: ('/api/maintenance-events/?cursor=&ordering=-scheduled_start', None)),
+        ('app events, ordered', 'get', lambda: (app_events + '?ordering=-scheduled_start', None)),
+        ('app events, search', 'get', lambda: (app_events + '?search=upgrade&ordering=scheduled_end', None)),
+        ('event detail patch', 'patch', lambda: (
+            '/api/maintenance-events/{}/'.format(next(events)), {'reason': next(reasons)}
+        )),
+        # rejected by MaintenanceEvent.other_active_event_exists
+        ('create, already active', 'post', lambda: (app_events, {'status': 'imminent', 'reason': next(reasons)})),
+        ('activate, already active', 'patch', lambda: (
+            '/api/maintenance-events/{}/'.format(next(events)), {'status': 'in_progress'}
+        )),
+    ]
+
+
+def run(applications=300, events=200000, history=2, requests=50, output=None):
+    applications, events, history, requests = int(applications), int(events), int(history), int(requests)
+    rows = []
+    results = {}
+    with benchmark_environment():
+        with Timer() as timer:
+            generate(applications, events, history)
+        print('Generated {} applications, {} events and {} history rows in {:.1f}s'.format(
+            Application.objects.count(), MaintenanceEvent.objects.count(), History.objects.count(), timer.elapsed
+        ))
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+        client = Client()
+        client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        application = Application.objects.order_by('id').first()
+        active_event = application.maintenance_events.get(status__in=ACTIVE_STATUSES)
+        other_events = list(application.maintenance_events.exclude(id=active_event.id).values_list('id', flat=True)[:requests])
+
+        deep_offset = MaintenanceEvent.objects.count() // 2
+        for name, method, request in scenarios(application, other_events, deep_offset):
+            latencies, query_counts, statuses = [], [], set()
+            for _ in range(requests):
+                path, data = request()
+                kwargs = {'data': json.dumps(data), 'content_type': 'application/json'} if data is not None else {}
+                with CaptureQueriesContext(connection) as queries, Timer() as timer:
+                    response = getattr(client, method)(path, **kwargs)
+                latencies.append(timer.elapsed)
+                query_counts.append(len(queries))
+                statuses.add(response.status_code)
+            results[name] = {
+                'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+                'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+                'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+                'queries': max(query_counts),
+            }
+            rows.append((name, method.upper(), ','.join(str(s) for s in sorted(statuses))) + tuple(
+                results[name][key] for key in ('p50_ms', 'p95_ms', 'p99_ms', 'queries')
+            ))
+
+    print_table(
+        'REST API ({} applications, {} events, {} history rows each; {} requests per scenario)'.format(
+            applications, events, history, requests
+        ),
+        ('scenario', 'method', 'status', 'p50 ms', 'p95 ms', 'p99 ms', 'queries'),
+        rows
+    )
+    save_results('rest_api', {
+        'applications': applications,
+        'events': events,
+        'history': history,
+        'requests': requests,
+    }, results, output)
+    return results
@@ -0,0 +1,124 @@
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import math
+import os
+import platform
+import subprocess
+import time
+
+from channels.layers import channel_layers
+
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+
+IN_MEMORY_CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        'CONFIG': {
+            'capacity': 10000,
+        },
+    },
+}
+
+
+@contextmanager
+def benchmark_environment():
+    """
+        Run the enclosed block against a throwaway test database and the in-memory channel layer.
+    """
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        with override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS):
+            yield
+    finally:
+        disconnect_other_sessions()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def disconnect_other_sessions():
+    """
+        Consumers hit the database from the ASGI thread pool; with persistent connections
+        those threads keep their sessions open, which would block dropping the test database.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+            "WHERE datname = current_database() AND pid <> pg_backend_pid()"
+        )
+
+
+def reset_channel_layer():
+    """
+        The in-memory layer never forgets a channel that was once received on,
+        and its per-receive cleanup is linear in the number of channels: start each round afresh.
+    """
+    channel_layers.backends.clear()
+
+
+class Timer(object):
+    """
+        Context manager recording wall-clock time of the enclosed block in `elapsed`.
+    """
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.perf_counter() - self.start
+
+
+def print_table(title, header, rows):
+    widths = [max(len(str(cell)) for cell in column) for column in zip(header, *rows)]
+    print('\n{}'.format(title))
+    for row in [header] + list(rows):
+        print('  '.join(str(cell).rjust(width) for cell, width in zip(row, widths)))
+
+
+def percentile(values, p):
+    """
+        The p-th percentile of `values`, by the nearest-rank method.
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    return values[max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(__file__), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+
+def save_results(name, params, results, output=None):
+    """
+        Write a benchmark's results as JSON, along with its parameters and the commit it ran against,
+        to `output` or to results/<name>-<commit>.json. Compare two such files with `fab benchmark:compare`.
+    """
+    revision = git_revision()
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, '{}-{}.json'.format(name, revision or 'unknown'))
+    with open(output, 'w') as f:
+        json.dump({
+            'benchmark': name,
+            'revision': revision,
+            'date': datetime.utcnow().isoformat() + 'Z',
+            'python': platform.python_version(),
+            'params': params,
+            'results': results,
+        }, f, indent=2, sort_keys=True)
+    print('\nResults written to {}'.format(output))
+    return output
@@ -0,0 +1,179 @@
+"""
+End-to-end fan-out of maintenance broadcasts to many WebSocket clients.
+
+    fab benchmark:websocket_fanout,connections=5000,broadcasts=20
+
+Runs config.routing.application in-process and opens `connections` clients on ws/perma/prod,
+`concurrency` at a time. Then, `broadcasts` times, saves the tier's MaintenanceEvent, has the
+outbox dispatcher publish the queued broadcast, and waits for every client to receive it.
+Reports connect throughput, save-to-receive latency percentiles across all clients, and the
+Python memory allocated per open connection (measured in a separate round, with tracemalloc).
+
+Uses the in-memory channel layer, or pass layer=redis (and redis_url=...) to go through Redis.
+Results are also written as JSON (to `output`, or benchmarks/results/): see benchmarks.compare.
+"""
+import asyncio
+import time
+import tracemalloc
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+
+from django.db import connections as db_connections, transaction
+from django.test.utils import override_settings
+
+from config.routing import application as asgi_application
+from lil_notification import consumers
+from lil_notification.dispatch import Dispatcher
+from lil_notification.models import Application, MaintenanceEvent, OutboxMessage
+from lil_notification.ratelimit import ConnectAdmission
+
+from .utils import Timer, benchmark_environment, percentile, print_table, reset_channel_layer, save_results
+
+
+def redis_channel_layers(redis_url):
+    return {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': [redis_url],
+                'capacity': 10000,
+            },
+        },
+    }
+
+
+async def connect_all(connections, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def connect_one():
+        async with semaphore:
+            communicator = WebsocketCommunicator(asgi_application, '/ws/perma/prod')
+            connected, _ = await communicator.connect(timeout=60)
+            assert connected
+            return communicator
+
+    return await asyncio.gather(*[connect_one() for _ in range(connections)])
+
+
+async def disconnect_all(communicators):
+    for communicator in communicators:
+        await communicator.disconnect()
+
+
+@database_sync_to_async
+def save_event(event, status):
+    event.status = status
+    event.save()
+
+
+@database_sync_to_async
+def take_outbox():
+    with transaction.atomic():
+        batch = list(OutboxMessage.objects.select_for_update().order_by('id'))
+        OutboxMessage.objects.filter(id__in=[message.id for message in batch]).delete()
+    return batch
+
+
+async def broadcast_all(communicators, event, broadcasts, dispatcher):
+    """
+    Returns the latency, in seconds, of every client's receipt of every broadcast.
+    """
+    latencies = []
+    # alternate between two active statuses, so that every save is broadcast
+    statuses = ['in_progress', 'imminent']
+    for i in range(broadcasts):
+        start = time.perf_counter()
+        await save_event(event, statuses[i % 2])
+        # published here, on the clients' event loop, as dispatch_batch() would in its own process
+        published, failed = await dispatcher.publish(await take_outbox())
+        assert len(published) == 1 and not failed
+
+        async def receive(communicator):
+            await communicator.receive_from(timeout=60)
+            return time.perf_counter() - start
+
+        latencies += await asyncio.gather(*[receive(communicator) for communicator in communicators])
+    return latencies
+
+
+async def memory_per_connection(connections, concurrency):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        communicators = await connect_all(connections, concurrency)
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    await disconnect_all(communicators)
+    return (after - before) / connections
+
+
+def run(connections=1000, concurrency=250, broadcasts=10, layer='memory', redis_url='redis://localhost:6379',
+        conn_max_age=600, output=None):
+    connections, concurrency, broadcasts = int(connections), int(concurrency), int(broadcasts)
+    # reuse DB connections across handlers: otherwise connects mostly measure Postgres' connection setup
+    db_connections.databases['default']['CONN_MAX_AGE'] = int(conn_max_age)
+    channel_layers = redis_channel_layers(redis_url) if layer == 'redis' else None
+    # don't measure admission control turning clients away
+    admission = consumers.connect_admission
+    consumers.connect_admission = ConnectAdmission(
+        max_concurrent=connections, rate=connections, burst=connections, max_retry_after=60
+    )
+    dispatcher = Dispatcher()
+    try:
+        with benchmark_environment(), override_settings(**({'CHANNEL_LAYERS': channel_layers} if channel_layers else {})):
+            app = Application.objects.create(slug='perma', tier='prod')
+            event = MaintenanceEvent.objects.create(application=app, status='completed')
+            OutboxMessage.objects.all().delete()
+
+            async def connect_and_broadcast():
+                with Timer() as timer:
+                    communicators = await connect_all(connections, concurrency)
+                latencies = await broadcast_all(communicators, event, broadcasts, dispatcher)
+                await disconnect_all(communicators)
+                return timer.elapsed, latencies
+
+            reset_channel_layer()
+            connect_seconds, latencies = async_to_sync(connect_and_broadcast)()
+            reset_channel_layer()
+            memory = async_to_sync(memory_per_connection)(connections, concurrency)
+    finally:
+        consumers.connect_admission = admission
+        dispatcher.close()
+
+    results = {
+        'connect': {
+            'seconds': round(connect_seconds, 3),
+            'connects_per_second': round(connections / connect_seconds, 1),
+        },
+        'latency_ms': dict(
+            ('p{}'.format(p), round(percentile(latencies, p) * 1000, 2)) for p in (50, 95, 99)
+        ),
+        'memory': {
+            'bytes_per_connection': round(memory),
+        },
+    }
+    results['latency_ms']['max'] = round(max(latencies) * 1000, 2)
+
+    print_table(
+        'WebSocket fan-out ({} layer, {} connections, {} broadcasts)'.format(layer, connections, broadcasts),
+        ('connects/s', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms', 'KiB/connection'),
+        [(
+            results['connect']['connects_per_second'],
+            results['latency_ms']['p50'],
+            results['latency_ms']['p95'],
+            results['latency_ms']['p99'],
+            results['latency_ms']['max'],
+            '{:.1f}'.format(memory / 1024),
+        )]
+    )
+    save_results('websocket_fanout', {
+        'connections': connections,
+        'concurrency': concurrency,
+        'broadcasts': broadcasts,
+        'layer': layer,
+        'conn_max_age': int(conn_max_age),
+    }, results, output)
+    return results
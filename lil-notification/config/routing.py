@@ -1,13 +1,19 @@
-from channels.auth import AuthMiddlewareStack
+from channels.http import AsgiHandler
 from channels.routing import ProtocolTypeRouter, URLRouter
+from django.urls import re_path
 import lil_notification.routing
+from lil_notification.snapshots import SnapshotChangesMiddleware
 
 
-application = ProtocolTypeRouter({
-    # (http->django views is added by default)
-    'websocket': AuthMiddlewareStack(
-        URLRouter(
-            lil_notification.routing.websocket_urlpatterns
-        )
+application = SnapshotChangesMiddleware(ProtocolTypeRouter({
+    'http': URLRouter(
+        lil_notification.routing.http_urlpatterns + [
+            # everything else goes to the django views
+            re_path(r'', AsgiHandler),
+        ]
     ),
-})
+    # no session or user: the consumers don't need them, and they'd be kept for the life of every socket
+    'websocket': URLRouter(
+        lil_notification.routing.websocket_urlpatterns
+    ),
+}))
@@ -43,6 +43,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'lil_notification.metrics.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -75,15 +76,91 @@ WSGI_APPLICATION = 'config.wsgi.application'
 
 # Channels
 ASGI_APPLICATION = 'config.routing.application'
+# Groups and channels are spread across the hosts by consistent hashing: add hosts to scale out.
+# With local_fanout, a broadcast is one message per process rather than per socket.
+# (Every process must be given the same hosts and local_fanout; see lil_notification.layers.ShardedRedisChannelLayer.)
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'BACKEND': 'lil_notification.layers.ShardedRedisChannelLayer',
         'CONFIG': {
             "hosts": [('redis', 6379)],
+            "local_fanout": True,
         },
     },
 }
 
+# Per-process cache of each application tier's current maintenance state,
+# shared by the WebSocket consumer and the views.
+SNAPSHOT_CACHE_MAX_SIZE = 1000  # (slug, tier) entries
+SNAPSHOT_CACHE_TTL = 30  # seconds
+# Drop the entries of tiers changed by other processes as soon as the dispatcher announces them,
+# rather than only when they expire; see lil_notification/snapshots.py
+SNAPSHOT_CACHE_FOLLOW_CHANGES = True
+
+# Validated API tokens, per process...
+# Revoking a token or deactivating its user only clears the cache of the process that saved
+# the change: other workers keep accepting the token for up to API_TOKEN_CACHE_TTL seconds.
+API_TOKEN_CACHE_MAX_SIZE = 1000
+API_TOKEN_CACHE_TTL = 5  # seconds
+# ...or, set to the alias of one of the CACHES, shared by all workers, so that revocations take
+# effect everywhere at once; then API_TOKEN_CACHE_TTL can be longer. Use it with several workers.
+API_TOKEN_CACHE = None
+
+# Broadcasts are queued in the outbox table and published by
+# `manage.py dispatch_broadcasts`; see lil_notification/dispatch.py
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_POLL_INTERVAL = 0.5  # seconds
+OUTBOX_MAX_BACKOFF = 60  # seconds between retries of a failing broadcast
+# Changes to the same group within this window go out as one broadcast of the latest state
+BROADCAST_COALESCE_WINDOW = 0.5  # seconds
+# Published broadcasts kept per group, for reconnecting clients to catch up on (ws/<app>/<tier>?since=<sequence>)
+BROADCAST_BUFFER_SIZE = 20
+
+# `manage.py run_scheduler` starts and completes maintenance events on schedule
+SCHEDULER_BATCH_SIZE = 100
+SCHEDULER_RESYNC_INTERVAL = 300  # seconds between full reloads of the schedule
+
+# `manage.py prune_history` defaults
+HISTORY_RETENTION_DAYS = 365
+HISTORY_PRUNE_BATCH_SIZE = 1000
+
+# Rows fetched at a time by the streaming exports (/api/export/maintenance-events, `manage.py export_events`)
+EXPORT_CHUNK_SIZE = 2000
+
+# WebSocket admission control, per worker process.
+# Connects beyond these limits are turned away with a jittered hint of when to retry.
+WS_CONNECT_MAX_CONCURRENT = 500  # connects being set up at once
+WS_CONNECT_RATE = 500  # connects accepted per second, on average...
+WS_CONNECT_BURST = 1000  # ...with bursts of up to this many
+WS_RETRY_AFTER_MAX = 60  # seconds
+
+# Heartbeats, for WebSocket clients that connect with ?heartbeat=1
+WS_HEARTBEAT_INTERVAL = 25  # seconds between pings
+WS_HEARTBEAT_TIMEOUT = 60  # seconds without hearing from a client before we close its socket
+
+# Test messages WebSocket clients send their tier (the monitor page's "Send Test Message" button).
+# Set WS_TEST_MESSAGES_ENABLED = False to ignore them, e.g. in production.
+WS_TEST_MESSAGES_ENABLED = True
+WS_TEST_MESSAGE_MAX_BYTES = 1024  # larger frames close the socket
+WS_TEST_MESSAGE_RATE = 0.2  # test messages per socket per second, on average...
+WS_TEST_MESSAGE_BURST = 5  # ...with bursts of up to this many
+WS_TEST_MESSAGE_GROUP_RATE = 1  # test messages per tier per second, per worker process...
+WS_TEST_MESSAGE_GROUP_BURST = 10  # ...with bursts of up to this many
+WS_TEST_MESSAGE_MAX_PENDING = 10000  # test messages waiting to be sent to sockets, per worker process
+
+# (slug, tier) pairs one ws/multiplex connection may watch, and the frames it may send us
+WS_MULTIPLEX_MAX_SUBSCRIPTIONS = 500
+WS_MULTIPLEX_MAX_FRAME_BYTES = 64 * 1024  # larger frames close the socket (room to subscribe to them all at once)
+WS_MULTIPLEX_FRAME_RATE = 1  # subscribe/unsubscribe frames per socket per second, on average...
+WS_MULTIPLEX_FRAME_BURST = 20  # ...with bursts of up to this many
+
+# HTTP fallbacks for clients that can't use WebSockets
+SSE_KEEPALIVE_INTERVAL = 15  # seconds between comments on an idle event stream
+LONG_POLL_TIMEOUT = 30  # seconds to wait for a change before answering 304
+
+# How long CDNs and browsers may cache /api/status/<slug>/<tier>
+STATUS_CACHE_MAX_AGE = 5  # seconds
+
 
 # Database
 # https://docs.djangoproject.com/en/1.11/ref/settings/#databases
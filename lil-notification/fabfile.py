@@ -16,11 +16,30 @@ def run_django():
     local("python3 manage.py runserver 0.0.0.0:80")
 
 
+@task
+def dispatch():
+    local("python3 manage.py dispatch_broadcasts")
+
+
+@task
+def schedule():
+    local("python3 manage.py run_scheduler")
+
+
 @task
 def test():
     local("pytest --fail-on-template-vars")
 
 
+@task
+def benchmark(name, **kwargs):
+    """
+        Run a benchmark from the benchmarks package, e.g. `fab benchmark:consumer_connect,connections=2000`
+    """
+    import importlib
+    importlib.import_module('benchmarks.{}'.format(name)).run(**kwargs)
+
+
 @task
 def init_db():
     """
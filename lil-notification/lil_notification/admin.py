@@ -3,7 +3,7 @@ from simple_history.admin import SimpleHistoryAdmin
 from django.contrib import admin
 from django.contrib.auth.models import Group
 
-from .models import Application, MaintenanceEvent
+from .models import Application, Broadcast, MaintenanceEvent, OutboxMessage
 
 # remove built-ins
 admin.site.unregister(Group)
@@ -31,3 +31,13 @@ class MaintenanceEventAdmin(SimpleHistoryAdmin):
     get_tier.admin_order_field = 'application__tier'
 
 
+@admin.register(OutboxMessage)
+class OutboxMessageAdmin(admin.ModelAdmin):
+    list_display = ('id', 'group', 'created', 'next_attempt', 'attempts')
+    list_filter = ('group',)
+
+
+@admin.register(Broadcast)
+class BroadcastAdmin(admin.ModelAdmin):
+    list_display = ('id', 'group', 'sequence', 'published')
+    list_filter = ('group',)
@@ -1,10 +1,150 @@
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+
 from rest_framework.authentication import TokenAuthentication as DRFTokenAuthentication
 
 from django.conf import settings
+from django.core.cache import caches
+
+from . import metrics
+
+
+class TokenCache(object):
+    """
+    Cache of validated API tokens: key -> (user, token), as returned by
+    DRFTokenAuthentication.authenticate_credentials.
+
+    By default, per process: entries expire after `ttl` seconds, and the least recently
+    used entries are evicted beyond `max_size`. Pass the alias of one of the CACHES as
+    `shared_cache` to share lookups (and invalidations) between workers instead: there,
+    each token's generation is kept in the shared cache too, so that a lookup in one worker
+    racing a revocation in another can't write the revoked credentials back.
+
+    The model signals invalidate a token's entry when it is deleted,
+    or when its user is changed (e.g. deactivated). Per process, that only reaches the process
+    that made the change: the others accept the token until their entry expires, so keep `ttl`
+    to a few seconds there, or use a shared cache.
+    """
+
+    def __init__(self, max_size, ttl, shared_cache=None, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.shared_cache = shared_cache
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # bumped on every invalidation, so that a lookup that raced with
+        # an invalidation doesn't repopulate the cache: see SnapshotCache
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def cache_key(key):
+        # don't keep the tokens themselves in the shared cache
+        return 'api-token:{}'.format(hashlib.sha256(key.encode('utf8')).hexdigest())
+
+    @staticmethod
+    def generation_key(key):
+        return 'api-token-generation:{}'.format(hashlib.sha256(key.encode('utf8')).hexdigest())
+
+    def current_generation(self, key):
+        """
+        Pass to set() the generation read before looking the token up.
+        """
+        if self.shared_cache:
+            return caches[self.shared_cache].get(self.generation_key(key), 0)
+        with self._lock:
+            return self.generation
+
+    def get(self, key):
+        """
+        Return the cached (user, token), or None.
+        """
+        if self.shared_cache:
+            cached = caches[self.shared_cache].get_many([self.cache_key(key), self.generation_key(key)])
+            # (generation, credentials), written before the token's latest invalidation or since
+            generation, credentials = cached.get(self.cache_key(key), (None, None))
+            if generation != cached.get(self.generation_key(key), 0):
+                credentials = None
+        else:
+            with self._lock:
+                credentials, expires = self._entries.get(key, (None, None))
+                if credentials is not None:
+                    if expires <= self.clock():
+                        del self._entries[key]
+                        credentials = None
+                    else:
+                        self._entries.move_to_end(key)
+        with self._lock:
+            if credentials is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return credentials
+
+    def set(self, key, credentials, generation=None):
+        if self.shared_cache:
+            if generation is None:
+                generation = self.current_generation(key)
+            # stored as is: get() ignores it if the token was invalidated since `generation`
+            caches[self.shared_cache].set(self.cache_key(key), (generation, credentials), self.ttl)
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (credentials, self.clock() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(key, None)
+        if self.shared_cache:
+            cache = caches[self.shared_cache]
+            # generations don't expire, or entries written before them would be valid again
+            cache.add(self.generation_key(key), 0, None)
+            try:
+                cache.incr(self.generation_key(key))
+            except ValueError:
+                # evicted in between
+                cache.set(self.generation_key(key), 1, None)
+            cache.delete(self.cache_key(key))
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+
+token_cache = TokenCache(
+    max_size=settings.API_TOKEN_CACHE_MAX_SIZE,
+    ttl=settings.API_TOKEN_CACHE_TTL,
+    shared_cache=settings.API_TOKEN_CACHE
+)
+
+
+@metrics.collector
+def token_cache_metrics():
+    return [
+        ('lil_token_cache_hits_total', 'counter', 'API token lookups served from the cache.', token_cache.hits),
+        ('lil_token_cache_misses_total', 'counter', 'API token lookups that went to the database.', token_cache.misses),
+        ('lil_token_cache_entries', 'gauge', 'API tokens cached in this process.', len(token_cache)),
+    ]
+
 
 class TokenAuthentication(DRFTokenAuthentication):
     """
         Override default TokenAuth to allow GET, POST, or Authorization header techniques.
+        Validated tokens are cached: see TokenCache.
     """
     keyword = 'ApiKey'
 
@@ -17,3 +157,12 @@ class TokenAuthentication(DRFTokenAuthentication):
             if api_key:
                 return self.authenticate_credentials(api_key)
         return super(TokenAuthentication, self).authenticate(request)
+
+    def authenticate_credentials(self, key):
+        credentials = token_cache.get(key)
+        if credentials is None:
+            generation = token_cache.current_generation(key)
+            # raises AuthenticationFailed for unknown tokens and inactive users
+            credentials = super(TokenAuthentication, self).authenticate_credentials(key)
+            token_cache.set(key, credentials, generation)
+        return credentials
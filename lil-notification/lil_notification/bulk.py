@@ -0,0 +1,150 @@
+import json
+
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Application, MaintenanceEvent, OutboxMessage, ACTIVE_STATUSES, \
+    ONE_ACTIVE_EVENT_INDEX, invalidate_snapshot, maintenance_group
+
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+###
+# Set-based versions of MaintenanceEvent.save() and its signals, for changing
+# the events of many applications at once (e.g. a fleet-wide maintenance window):
+# a handful of queries, in one transaction, however many applications are involved.
+###
+
+def resolve_applications(ids=(), targets=()):
+    """
+    The Applications with the given ids, or matching the given (slug, tier) targets
+    ("*" matches all of an application's tiers), in one query.
+    Raises ValidationError naming any that don't exist.
+    """
+    query = Q(id__in=ids) if ids else Q()
+    for slug, tier in targets:
+        query |= Q(slug=slug) if tier == '*' else Q(slug=slug, tier=tier)
+    if not query:
+        return []
+    applications = list(Application.objects.filter(query).order_by('id'))
+
+    found_ids = {a.id for a in applications}
+    found_keys = {(a.slug, a.tier) for a in applications}
+    found_slugs = {a.slug for a in applications}
+    missing = ['id {}'.format(pk) for pk in ids if pk not in found_ids] + [
+        '{} {}'.format(slug, tier) for slug, tier in targets
+        if (slug not in found_slugs if tier == '*' else (slug, tier) not in found_keys)
+    ]
+    if missing:
+        raise ValidationError('No such application: {}.'.format(', '.join(missing)))
+    return applications
+
+
+def create_events(applications, user=None, **fields):
+    """
+    Create a maintenance event with the given field values for each application.
+    """
+    fields.setdefault('status', MaintenanceEvent._meta.get_field('status').default)
+    now = timezone.now()
+    with transaction.atomic():
+        if fields['status'] in ACTIVE_STATUSES:
+            already_active = Application.objects.filter(
+                id__in=[a.id for a in applications],
+                maintenance_events__status__in=ACTIVE_STATUSES
+            ).distinct()
+            if already_active:
+                raise ValidationError('There is already an active maintenance event for {}.'.format(
+                    ', '.join(sorted(a.name for a in already_active))
+                ))
+
+        events = [MaintenanceEvent(application=a, modified=now, **fields) for a in applications]
+        try:
+            with transaction.atomic():
+                MaintenanceEvent.objects.bulk_create(events)
+        except IntegrityError as e:
+            # lost a race: see MaintenanceEvent.save
+            if ONE_ACTIVE_EVENT_INDEX in str(e):
+                raise ValidationError('There is already an active maintenance event for one of these applications.')
+            raise
+        record_history(events, '+', user, now)
+        broadcast(events)
+        for event in events:
+            invalidate_snapshot(event.application)
+    logger.info('Created {} maintenance events'.format(len(events)))
+    return events
+
+
+def transition_events(applications, user=None, **fields):
+    """
+    Apply the given field values (e.g. a new status) to the active maintenance event
+    of each application. Applications without an active event are left alone.
+    """
+    return update_events(
+        MaintenanceEvent.objects.filter(application__in=applications, status__in=ACTIVE_STATUSES),
+        user,
+        **fields
+    )
+
+
+def update_events(queryset, user=None, **fields):
+    """
+    Apply the given field values to the maintenance events in the queryset.
+    The rows are locked, and the queryset's filters re-checked, before they are changed.
+    """
+    if not fields:
+        raise ValidationError('Pass at least one field to set.')
+    now = timezone.now()
+    with transaction.atomic():
+        events = list(
+            queryset.select_for_update(of=('self',)).select_related('application').order_by('id')
+        )
+        if not events:
+            return []
+        MaintenanceEvent.objects.filter(id__in=[e.id for e in events]).update(modified=now, **fields)
+        changed = []
+        for event in events:
+            for name, value in dict(fields, modified=now).items():
+                setattr(event, name, value)
+            if event.get_broadcast_state() != event._broadcast_state:
+                changed.append(event)
+        record_history(events, '~', user, now)
+        broadcast(changed)
+        for event in events:
+            invalidate_snapshot(event.application)
+    logger.info('Updated {} maintenance events'.format(len(events)))
+    return events
+
+
+def record_history(events, history_type, user, date):
+    """
+    What simple_history does on each save, in one INSERT.
+    """
+    History = MaintenanceEvent.history.model
+    History.objects.bulk_create([
+        History(
+            history_date=date,
+            history_type=history_type,
+            history_user=user,
+            **{field.attname: getattr(event, field.attname) for field in MaintenanceEvent._meta.fields}
+        )
+        for event in events
+    ])
+
+
+def broadcast(events):
+    """
+    What notify_groups does on each save: one broadcast per affected group,
+    published once the transaction commits.
+    """
+    if not events:
+        return
+    OutboxMessage.enqueue_many({
+        maintenance_group(event.application.slug, event.application.tier): json.dumps(event.get_details_for_ws())
+        for event in events
+    })
+    for event in events:
+        event._broadcast_state = event.get_broadcast_state()
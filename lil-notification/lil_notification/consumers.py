@@ -1,62 +1,505 @@
+import asyncio
 import json
+from urllib.parse import parse_qs
 
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
+from channels.db import database_sync_to_async
+from channels.generic.http import AsyncHttpConsumer
+from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.exceptions import DenyConnection
+from channels.layers import get_channel_layer
 
-from .models import Application, ACTIVE_STATUSES
+from django.conf import settings
 
+from . import metrics
+from .heartbeat import heartbeat, is_pong
+from . import inbound
+from .models import Application, Broadcast, maintenance_group
+from .ratelimit import TokenBucket, connect_admission
+from .snapshots import INACTIVE_STATUS, snapshot_cache, state_version
 
-class ChatConsumer(WebsocketConsumer):
-    def connect(self):
-        self.app_slug = self.scope['url_route']['kwargs']['app_slug']
-        self.tier = self.scope['url_route']['kwargs']['tier']
-        self.group_name = 'maintenance_{}_{}'.format(self.app_slug, self.tier)
 
+# Close code telling clients to reconnect after the `retry_after` seconds we sent them
+RETRY_LATER = 4429
+
+
+def sequenced(text, sequence):
+    '''
+    Tag a broadcast's JSON object with its sequence number, without re-encoding it.
+    '''
+    return '{{"sequence": {}, {}'.format(sequence, text[1:])
+
+
+async def join_group(channel_layer, group, channel_name):
+    try:
+        await channel_layer.group_add(group, channel_name)
+    except Exception:
+        metrics.CHANNEL_LAYER_ERRORS.inc('group_add')
+        raise
+    metrics.GROUP_JOINS.inc(group)
+    metrics.GROUP_SUBSCRIBERS.inc(group)
+
+
+async def leave_group(channel_layer, group, channel_name):
+    metrics.GROUP_LEAVES.inc(group)
+    metrics.GROUP_SUBSCRIBERS.dec(group)
+    try:
+        await channel_layer.group_discard(group, channel_name)
+    except Exception:
+        metrics.CHANNEL_LAYER_ERRORS.inc('group_discard')
+        raise
+
+
+class AdmissionControlledConsumer(AsyncWebsocketConsumer):
+    """
+    Turns connects away, with a hint of when to retry, beyond the worker's limits:
+    see ratelimit.ConnectAdmission. Subclasses implement admitted_connect(),
+    and leave_groups() for the groups they joined.
+
+    Clients that connect with ?heartbeat=1 are sent {"type": "ping"} every WS_HEARTBEAT_INTERVAL
+    seconds, and are closed if we hear nothing from them, e.g. {"type": "pong"},
+    for WS_HEARTBEAT_TIMEOUT seconds: see heartbeat.Heartbeat.
+    """
+
+    async def connect(self):
+        if not connect_admission.try_enter():
+            metrics.WS_CONNECTS_REJECTED.inc()
+            await self.retry_later()
+            return
         try:
-            application = Application.objects.get(slug=self.app_slug, tier=self.tier)
-        except Application.DoesNotExist:
+            with metrics.WS_CONNECT_SECONDS.time(type(self).__name__):
+                await self.admitted_connect()
+        finally:
+            connect_admission.leave()
+        if self.query_param('heartbeat') == '1':
+            heartbeat.watch(self)
+
+    async def admitted_connect(self):
+        raise NotImplementedError
+
+    async def leave_groups(self):
+        pass
+
+    async def disconnect(self, close_code):
+        heartbeat.forget(self)
+        await self.leave_groups()
+
+    async def websocket_receive(self, message):
+        heartbeat.seen(self)
+        if message.get('text') and is_pong(message['text']):
+            return
+        await super(AdmissionControlledConsumer, self).websocket_receive(message)
+
+    def query_param(self, name):
+        values = parse_qs(self.scope.get('query_string', b'').decode('utf8')).get(name)
+        return values[0] if values else None
+
+    async def retry_later(self):
+        '''
+        Turn the connection away without touching the DB or the channel layer.
+        (We have to accept before we can tell the client when to come back.)
+        '''
+        await self.accept()
+        await self.send(text_data=json.dumps({
+            'retry_after': round(connect_admission.retry_after(), 1)
+        }))
+        await self.close(code=RETRY_LATER)
+
+
+class ChatConsumer(AdmissionControlledConsumer):
+    '''
+    Sends the state of one application tier, then every change to it.
+
+    Broadcasts carry a "sequence" number, increasing within the tier. Clients that reconnect
+    with ?since=<the last sequence they saw> first get the broadcasts they missed, or just the
+    latest if there were too many; ?since=0 gets the current state, whatever it is.
+    Without ?since, the current state is only sent if a maintenance event is active.
+    '''
+
+    # set once we've joined the group
+    group_name = None
+    # the last broadcast sent, so that none is sent twice, or out of order
+    sequence = 0
+    # limits the test messages this socket sends: see receive()
+    test_message_bucket = None
+
+    async def admitted_connect(self):
+        kwargs = self.scope['url_route']['kwargs']
+        slug, tier = kwargs['app_slug'], kwargs['tier']
+
+        # Usually served from the cache, without leaving the event loop
+        snapshot = await snapshot_cache.get_async(slug, tier)
+        if not snapshot.exists:
             raise DenyConnection
 
-        async_to_sync(self.channel_layer.group_add)(
-            self.group_name,
-            self.channel_name
-        )
-        self.accept()
+        group_name = maintenance_group(slug, tier)
+        await join_group(self.channel_layer, group_name, self.channel_name)
+        self.group_name = group_name
+        # Again, now that we're in the group: a broadcast published before we joined reached no one
+        snapshot = await snapshot_cache.get_async(slug, tier)
+        await self.accept()
 
-        # Signal right away if a maintenance event is active
-        active =  application.maintenance_events.filter(status__in=ACTIVE_STATUSES)
-        if active:
-            # There should only be one active at a time,
-            # but don't be strict here
-            self.send(text_data=json.dumps(active[0].get_details_for_ws()))
+        since = self.since()
+        if since is None:
+            # Signal right away if a maintenance event is active
+            if snapshot.text:
+                await self.send(text_data=snapshot.text)
+            return
 
+        # Broadcasts published since we joined the group will be sent again: see maintenance_msg
+        missed = await database_sync_to_async(Broadcast.resume)(group_name, since)
+        if missed is None:
+            missed = [(0, snapshot.text or INACTIVE_STATUS)]
+        for sequence, text in missed:
+            await self.send(text_data=sequenced(text, sequence))
+        self.sequence = missed[-1][0] if missed else since
 
-    def disconnect(self, close_code):
-        async_to_sync(self.channel_layer.group_discard)(
-            self.group_name,
-            self.channel_name
-        )
+    def since(self):
+        try:
+            return max(int(self.query_param('since')), 0)
+        except (TypeError, ValueError):
+            return None
 
 
-    def receive(self, text_data):
+    async def leave_groups(self):
+        # If the connection was turned away, we never joined the group
+        if self.group_name is not None:
+            group_name, self.group_name = self.group_name, None
+            await leave_group(self.channel_layer, group_name, self.channel_name)
+
+
+    async def receive(self, text_data=None, bytes_data=None):
         '''
         Handle message sent by a connected WebSocket
         (This is only used for by the "send test message" UI.)
+
+        Test messages are size-capped, checked, and rate-limited per socket and per tier
+        before they're relayed to the tier, and reach sockets at low priority: see inbound.
+        Those we don't relay are dropped, and counted, without an answer.
         '''
-        text_data_json = json.loads(text_data)
-        async_to_sync(self.channel_layer.group_send)(
-            self.group_name,
-            {
-                'type': 'maintenance_msg',
-                'active': text_data_json.get('active', False),
-                'status': text_data_json.get('status', None)
-            }
-        )
+        if not settings.WS_TEST_MESSAGES_ENABLED:
+            metrics.WS_TEST_MESSAGES.inc('disabled')
+            return
+        if text_data is not None and len(text_data.encode('utf8')) > settings.WS_TEST_MESSAGE_MAX_BYTES:
+            metrics.WS_TEST_MESSAGES.inc('too_large')
+            await self.close(code=inbound.MESSAGE_TOO_BIG)
+            return
+        try:
+            if text_data is None:
+                raise ValueError('Expected a text frame')
+            text = inbound.parse_test_message(text_data)
+        except ValueError:
+            metrics.WS_TEST_MESSAGES.inc('invalid')
+            return
+
+        # (made on first use: most sockets never send anything)
+        if self.test_message_bucket is None:
+            self.test_message_bucket = TokenBucket(settings.WS_TEST_MESSAGE_RATE, settings.WS_TEST_MESSAGE_BURST)
+        # per socket first, so that one busy socket doesn't use up its tier's allowance
+        if not (self.test_message_bucket.consume() and inbound.group_test_message_limits.consume(self.group_name)):
+            metrics.WS_TEST_MESSAGES.inc('rate_limited')
+            return
+
+        try:
+            await self.channel_layer.group_send(self.group_name, inbound.channel_test_message(self.group_name, text))
+        except Exception:
+            metrics.CHANNEL_LAYER_ERRORS.inc('group_send')
+            raise
+        metrics.WS_TEST_MESSAGES.inc('relayed')
+
 
+    async def test_msg(self, event):
+        inbound.low_priority_sender.submit(self, event['text'])
 
-    def maintenance_msg(self, event):
+
+    async def maintenance_msg(self, event):
         '''
         Forward messages broadcasted to the group on to the WebSocket
+        (already encoded by the sender: see models.channel_message)
+        '''
+        text = event['text']
+        sequence = event.get('sequence')
+        if sequence is not None:
+            if sequence <= self.sequence:
+                return
+            self.sequence = sequence
+            text = sequenced(text, sequence)
+        with metrics.WS_SEND_SECONDS.time('ChatConsumer'):
+            await self.send(text_data=text)
+
+
+class MultiplexConsumer(AdmissionControlledConsumer):
+    '''
+    Watch many application tiers over a single socket.
+
+    Clients send
+        {"action": "subscribe", "targets": [{"slug": "perma", "tier": "prod"}, {"slug": "h2o", "tier": "*"}]}
+    ("*" matches all of an application's tiers) and receive one snapshot of the current state
+    of everything they subscribed to, in the same shape as ChatConsumer's messages:
+        {"type": "snapshot", "events": [{"slug": "perma", "tier": "prod", "event": {...} or null}, ...]}
+    followed by tagged updates:
+        {"type": "update", "slug": "perma", "tier": "prod", "event": {...}}
+    {"action": "unsubscribe", "targets": [...]} stops updates.
+
+    Frames larger than WS_MULTIPLEX_MAX_FRAME_BYTES close the socket, and each socket may send
+    WS_MULTIPLEX_FRAME_RATE a second, in bursts of up to WS_MULTIPLEX_FRAME_BURST: those beyond
+    that are answered with an error, and dropped.
+    '''
+
+    # limits the frames this socket sends: see receive()
+    frame_bucket = None
+
+    async def admitted_connect(self):
+        # group name -> the JSON members tagging that group's messages with its app and tier
+        self.subscriptions = {}
+        await self.accept()
+
+
+    async def leave_groups(self):
+        subscriptions, self.subscriptions = getattr(self, 'subscriptions', {}), {}
+        for group in subscriptions:
+            await leave_group(self.channel_layer, group, self.channel_name)
+
+
+    async def receive(self, text_data=None, bytes_data=None):
+        frame = text_data.encode('utf8') if text_data is not None else bytes_data
+        if len(frame) > settings.WS_MULTIPLEX_MAX_FRAME_BYTES:
+            metrics.WS_MULTIPLEX_FRAMES.inc('too_large')
+            await self.close(code=inbound.MESSAGE_TOO_BIG)
+            return
+        # (made on first use: some sockets subscribe once, on connecting, others never)
+        if self.frame_bucket is None:
+            self.frame_bucket = TokenBucket(settings.WS_MULTIPLEX_FRAME_RATE, settings.WS_MULTIPLEX_FRAME_BURST)
+        if not self.frame_bucket.consume():
+            metrics.WS_MULTIPLEX_FRAMES.inc('rate_limited')
+            await self.send_error('Too many requests: at most {} a second.'.format(settings.WS_MULTIPLEX_FRAME_RATE))
+            return
+
+        try:
+            if text_data is None:
+                raise ValueError('Expected a text frame')
+            request = json.loads(text_data)
+            action = request['action']
+            targets = [(str(target['slug']), str(target['tier'])) for target in request['targets']]
+        except (ValueError, KeyError, TypeError):
+            metrics.WS_MULTIPLEX_FRAMES.inc('invalid')
+            await self.send_error('Expected {"action": "subscribe" or "unsubscribe", "targets": [{"slug": ..., "tier": ...}, ...]}')
+            return
+
+        if action == 'subscribe':
+            await self.subscribe(targets)
+        elif action == 'unsubscribe':
+            await self.unsubscribe(targets)
+        else:
+            metrics.WS_MULTIPLEX_FRAMES.inc('invalid')
+            await self.send_error('Unknown action {}'.format(action))
+            return
+        metrics.WS_MULTIPLEX_FRAMES.inc(action)
+
+
+    async def subscribe(self, targets):
+        keys = await self.resolve(targets)
+        new_keys = [key for key in keys if maintenance_group(*key) not in self.subscriptions]
+        if len(self.subscriptions) + len(new_keys) > settings.WS_MULTIPLEX_MAX_SUBSCRIPTIONS:
+            await self.send_error('At most {} subscriptions are allowed.'.format(settings.WS_MULTIPLEX_MAX_SUBSCRIPTIONS))
+            return
+
+        # Join the groups before reading the snapshot, so no update can fall in between
+        for slug, tier in new_keys:
+            group = maintenance_group(slug, tier)
+            await join_group(self.channel_layer, group, self.channel_name)
+            self.subscriptions[group] = '"slug": {}, "tier": {}, "event": '.format(json.dumps(slug), json.dumps(tier))
+
+        snapshots = await database_sync_to_async(snapshot_cache.get_many)(keys)
+        # Assembled from the cached, already-encoded payloads
+        events = ', '.join(
+            '{' + self.subscriptions[maintenance_group(*key)] + (snapshots[key].text or 'null') + '}'
+            for key in keys
+        )
+        await self.send(text_data='{"type": "snapshot", "events": [' + events + ']}')
+
+
+    async def unsubscribe(self, targets):
+        for slug, tier in targets:
+            if tier == '*':
+                prefix = '"slug": {}, '.format(json.dumps(slug))
+                groups = [group for group, tag in self.subscriptions.items() if tag.startswith(prefix)]
+            else:
+                groups = [maintenance_group(slug, tier)]
+            for group in groups:
+                if self.subscriptions.pop(group, None) is not None:
+                    await leave_group(self.channel_layer, group, self.channel_name)
+
+
+    async def maintenance_msg(self, event):
+        '''
+        Tag messages broadcasted to our groups with their app and tier, and send them on.
         '''
-        self.send(text_data=json.dumps(event))
+        text = self.update(event)
+        if text:
+            with metrics.WS_SEND_SECONDS.time('MultiplexConsumer'):
+                await self.send(text_data=text)
+
+
+    async def test_msg(self, event):
+        text = self.update(event)
+        if text:
+            inbound.low_priority_sender.submit(self, text)
+
+
+    def update(self, event):
+        tag = self.subscriptions.get(event['group'])
+        if tag:
+            if 'sequence' in event:
+                tag = '"sequence": {}, '.format(event['sequence']) + tag
+            return '{"type": "update", ' + tag + event['text'] + '}'
+
+
+    async def send_error(self, message):
+        await self.send(text_data=json.dumps({'type': 'error', 'message': message}))
+
+
+    @database_sync_to_async
+    def resolve(self, targets):
+        '''
+        Expand wildcards, and drop applications that don't exist.
+        '''
+        wildcards = {slug for slug, tier in targets if tier == '*'}
+        exact = {(slug, tier) for slug, tier in targets if tier != '*'}
+        existing = []
+        if wildcards:
+            existing += Application.objects.filter(slug__in=wildcards).values_list('slug', 'tier')
+        if exact:
+            snapshots = snapshot_cache.get_many(exact)
+            existing += [key for key, snapshot in snapshots.items() if snapshot.exists]
+        return sorted(set(existing))
+
+
+class MaintenanceHttpConsumer(AsyncHttpConsumer):
+    '''
+    Base for the HTTP transports, for clients that can't use WebSockets.
+
+    Looks up the tier like ChatConsumer does, then listens to the tier's group
+    while respond() runs, until respond() is done or the client goes away.
+    '''
+
+    async def __call__(self, receive, send):
+        self.send = send
+        self.app_slug = self.scope['url_route']['kwargs']['app_slug']
+        self.tier = self.scope['url_route']['kwargs']['tier']
+        self.group_name = maintenance_group(self.app_slug, self.tier)
+        self.query = parse_qs(self.scope.get('query_string', b'').decode('utf8'))
+
+        snapshot = await snapshot_cache.get_async(self.app_slug, self.tier)
+        if not snapshot.exists:
+            await self.send_response(404, b'', headers=[(b'Content-Type', b'text/plain')])
+            return
+
+        self.channel_layer = get_channel_layer()
+        self.channel_name = await self.channel_layer.new_channel()
+        await join_group(self.channel_layer, self.group_name, self.channel_name)
+        try:
+            # Again, now that we're in the group: a broadcast published before we joined reached no one
+            snapshot = await snapshot_cache.get_async(self.app_slug, self.tier)
+            response = asyncio.ensure_future(self.respond(snapshot))
+            disconnect = asyncio.ensure_future(self.wait_for_disconnect(receive))
+            done, _ = await asyncio.wait([response, disconnect], return_when=asyncio.FIRST_COMPLETED)
+            disconnect.cancel()
+            if response in done:
+                # re-raise anything that went wrong
+                response.result()
+            else:
+                response.cancel()
+        finally:
+            await leave_group(self.channel_layer, self.group_name, self.channel_name)
+
+    async def respond(self, snapshot):
+        raise NotImplementedError
+
+    async def wait_for_disconnect(self, receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    async def next_message(self, timeout):
+        '''
+        The next message broadcast to our group, or None if there's none within `timeout` seconds.
+        '''
+        try:
+            return await asyncio.wait_for(self.channel_layer.receive(self.channel_name), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class ServerSentEventsConsumer(MaintenanceHttpConsumer):
+    '''
+    Streams the messages ChatConsumer would send, as Server-Sent Events.
+    Each event's id is the version of the state it carries.
+    '''
+
+    async def respond(self, snapshot):
+        await self.send_headers(headers=[
+            (b'Content-Type', b'text/event-stream'),
+            (b'Cache-Control', b'no-cache'),
+            (b'X-Accel-Buffering', b'no'),  # don't let nginx buffer the stream
+        ])
+        # Signal right away if a maintenance event is active
+        await self.send_body(self.event(snapshot.text) if snapshot.text else b': connected\n\n', more_body=True)
+        while True:
+            message = await self.next_message(settings.SSE_KEEPALIVE_INTERVAL)
+            if message is None:
+                # keep proxies from closing an idle connection
+                await self.send_body(b': keepalive\n\n', more_body=True)
+            else:
+                await self.send_body(self.event(message['text']), more_body=True)
+
+    @staticmethod
+    def event(text):
+        return 'id: {}\ndata: {}\n\n'.format(state_version(text), text).encode('utf8')
+
+
+class LongPollConsumer(MaintenanceHttpConsumer):
+    '''
+    Returns {"version": ..., "event": <the message ChatConsumer would send, or null>}.
+    The version is the sequence number of the latest broadcast the state is at least as new as.
+
+    If the request's ?version= is that or later, waits for a later broadcast,
+    for up to LONG_POLL_TIMEOUT seconds, and then answers 304 Not Modified:
+    clients are never sent a state older than the one they have, even by a process
+    whose cache hasn't caught up with it yet.
+    '''
+
+    async def respond(self, snapshot):
+        known = self.known_version()
+        if known is None or snapshot.sequence > known:
+            await self.send_state(snapshot.sequence, snapshot.text)
+            return
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + settings.LONG_POLL_TIMEOUT
+        while True:
+            message = await self.next_message(max(deadline - loop.time(), 0))
+            if message is None:
+                await self.send_response(304, b'', headers=self.headers(known))
+                return
+            # (test messages aren't numbered, and don't change the state)
+            if (message.get('sequence') or 0) > known:
+                await self.send_state(message['sequence'], message['text'])
+                return
+
+    def known_version(self):
+        try:
+            return max(int(self.query.get('version', [None])[0]), 0)
+        except (TypeError, ValueError):
+            # none, or not one of ours
+            return None
+
+    async def send_state(self, sequence, text):
+        body = '{{"version": {}, "event": {}}}'.format(sequence, text or 'null')
+        await self.send_response(200, body.encode('utf8'), headers=self.headers(sequence) + [
+            (b'Content-Type', b'application/json'),
+        ])
+
+    @staticmethod
+    def headers(sequence):
+        return [
+            (b'ETag', '"{}"'.format(sequence).encode('utf8')),
+            (b'Cache-Control', b'no-store'),
+        ]
@@ -0,0 +1,126 @@
+import asyncio
+from datetime import timedelta
+
+from channels.layers import get_channel_layer
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from . import metrics
+from .models import Broadcast, OutboxMessage, SCHEDULER_GROUP, SNAPSHOTS_GROUP, channel_message
+
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Dispatcher(object):
+    """
+    Drains the OutboxMessage table, publishing each message to the channel layer.
+
+    Runs synchronously in its own process (see the dispatch_broadcasts management command),
+    on a private event loop, so that the channel layer's connections are reused across batches.
+    """
+
+    def __init__(self, batch_size=None, max_backoff=None):
+        self.batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+        self.max_backoff = max_backoff or settings.OUTBOX_MAX_BACKOFF
+        self.loop = asyncio.new_event_loop()
+
+    def close(self):
+        self.loop.close()
+
+    def dispatch_batch(self):
+        """
+        Publish one batch of due messages. Returns the number of messages handled.
+
+        Rows are locked with SKIP LOCKED, so several dispatchers can safely run side by side.
+        Each message is numbered and recorded as a Broadcast before it is published.
+        Published messages are deleted in the same transaction; if a message can't be
+        published, it and the rest of its group's messages are postponed with exponential
+        backoff, so that a group's broadcasts are never delivered out of order.
+        """
+        try:
+            with transaction.atomic():
+                batch = list(
+                    OutboxMessage.objects.select_for_update(skip_locked=True).filter(
+                        next_attempt__lte=timezone.now()
+                    ).order_by('id')[:self.batch_size]
+                )
+                if not batch:
+                    return 0
+                broadcasts = Broadcast.record(batch)
+                published, failed = self.loop.run_until_complete(self.publish(batch, broadcasts))
+                OutboxMessage.objects.filter(id__in=[message.id for message in published]).delete()
+                if len(published) < len(batch):
+                    # numbered again when they are retried
+                    unpublished = set(broadcasts) - {message.id for message in published}
+                    Broadcast.objects.filter(id__in=[broadcasts[id].id for id in unpublished]).delete()
+                Broadcast.prune({message.group: broadcasts[message.id].sequence for message in published})
+                for message, error in failed:
+                    self.postpone(message, error)
+        except IntegrityError:
+            # another dispatcher numbered a broadcast of one of these groups first
+            logger.warning('Conflicting broadcast sequence numbers; retrying', exc_info=True)
+            return 0
+        return len(batch)
+
+    async def publish(self, batch, broadcasts=None):
+        channel_layer = get_channel_layer()
+        broadcasts = broadcasts or {}
+        published, failed = [], []
+        failed_groups = set()
+        await self.announce_changes(channel_layer, sorted({message.group for message in batch}))
+        for message in batch:
+            if message.group in failed_groups:
+                continue
+            sequence = broadcasts[message.id].sequence if message.id in broadcasts else None
+            try:
+                with metrics.BROADCAST_PUBLISH_SECONDS.time():
+                    await channel_layer.group_send(message.group, channel_message(message.group, message.payload, sequence))
+            except Exception as e:
+                logger.exception('Failed to publish OutboxMessage {}'.format(message))
+                metrics.CHANNEL_LAYER_ERRORS.inc('group_send')
+                failed.append((message, e))
+                failed_groups.add(message.group)
+            else:
+                metrics.BROADCASTS_PUBLISHED.inc()
+                metrics.BROADCAST_DELAY_SECONDS.observe((timezone.now() - message.created).total_seconds())
+                published.append(message)
+        if published:
+            await self.poke_scheduler(channel_layer, sorted({message.group for message in published}))
+        return published, failed
+
+    async def announce_changes(self, channel_layer, groups):
+        """
+        Tell every web process that these groups' state changed (it's committed by now),
+        so that they drop it from their snapshot caches: see snapshots.SnapshotChanges.
+        (Best effort: cached snapshots also expire.)
+        """
+        try:
+            await channel_layer.group_send(SNAPSHOTS_GROUP, {'type': 'snapshots.changed', 'groups': groups})
+        except Exception:
+            logger.exception('Failed to announce changes to {}'.format(', '.join(groups)))
+            metrics.CHANNEL_LAYER_ERRORS.inc('group_send')
+
+    async def poke_scheduler(self, channel_layer, groups):
+        """
+        A broadcast means some event's status or schedule changed: let the scheduler know which groups'.
+        (Best effort: the scheduler also resyncs periodically.)
+        """
+        try:
+            await channel_layer.group_send(SCHEDULER_GROUP, {'type': 'schedule.changed', 'groups': groups})
+        except Exception:
+            logger.exception('Failed to poke the scheduler')
+            metrics.CHANNEL_LAYER_ERRORS.inc('group_send')
+
+    def postpone(self, message, error):
+        backoff = min(2 ** message.attempts, self.max_backoff)
+        OutboxMessage.objects.filter(id=message.id).update(
+            attempts=message.attempts + 1,
+            last_error=repr(error)
+        )
+        OutboxMessage.objects.filter(group=message.group).update(
+            next_attempt=timezone.now() + timedelta(seconds=backoff)
+        )
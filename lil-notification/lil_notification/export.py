@@ -0,0 +1,150 @@
+import csv
+import json
+
+from datetime import datetime
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .models import MaintenanceEvent
+
+
+History = MaintenanceEvent.history.model
+
+EVENT_COLUMNS = [
+    'record',
+    'id',
+    'application_id',
+    'slug',
+    'tier',
+    'status',
+    'scheduled_start',
+    'scheduled_end',
+    'started',
+    'ended',
+    'reason',
+    'modified',
+]
+HISTORY_COLUMNS = EVENT_COLUMNS + [
+    'history_id',
+    'history_date',
+    'history_type',
+    'history_user_id',
+]
+
+FORMATS = ('ndjson', 'csv')
+CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def export_rows(history=False, since=None, until=None, chunk_size=None):
+    """
+    Yield every MaintenanceEvent as a dict, in id order, each followed by its
+    HistoricalMaintenanceEvent rows in the order they were recorded, if `history`.
+    (History of deleted events comes out in its place in the id order, on its own.)
+
+    Rows are read through server-side cursors, `chunk_size` at a time,
+    so memory use doesn't depend on the number of rows.
+    `since` and `until` limit events to those last modified, and history to that
+    recorded, in [since, until).
+    """
+    chunk_size = chunk_size or settings.EXPORT_CHUNK_SIZE
+    events = rows(
+        MaintenanceEvent.objects.order_by('id'),
+        'modified', since, until, EVENT_COLUMNS, 'event', chunk_size
+    )
+    if not history:
+        return events
+    history = rows(
+        History.objects.order_by('id', 'history_date', 'history_id'),
+        'history_date', since, until, HISTORY_COLUMNS, 'history', chunk_size
+    )
+    return merge(events, history)
+
+
+def rows(queryset, date_field, since, until, columns, record, chunk_size):
+    if since:
+        queryset = queryset.filter(**{date_field + '__gte': since})
+    if until:
+        queryset = queryset.filter(**{date_field + '__lt': until})
+    fields = [column for column in columns if column not in ('record', 'slug', 'tier')]
+    queryset = queryset.values(
+        *fields,
+        slug=F('application__slug'),
+        tier=F('application__tier')
+    )
+    for row in queryset.iterator(chunk_size=chunk_size):
+        row['record'] = record
+        yield row
+
+
+def merge(events, history):
+    """
+    Interleave the two id-ordered streams, each event before its history.
+    """
+    history = iter(history)
+    entry = next(history, None)
+    for event in events:
+        while entry is not None and entry['id'] < event['id']:
+            yield entry
+            entry = next(history, None)
+        yield event
+        while entry is not None and entry['id'] == event['id']:
+            yield entry
+            entry = next(history, None)
+    while entry is not None:
+        yield entry
+        entry = next(history, None)
+
+
+def ndjson_lines(rows, columns):
+    for row in rows:
+        yield json.dumps(dict((column, row.get(column)) for column in columns), cls=DjangoJSONEncoder) + '\n'
+
+
+class Echo(object):
+    """
+    A file-like object that hands back what is written to it:
+    lets csv.writer produce lines one at a time.
+    """
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows, columns):
+    writer = csv.DictWriter(Echo(), fieldnames=columns, extrasaction='ignore')
+    yield writer.writerow(dict(zip(columns, columns)))
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def parse_bound(value):
+    """
+    A date range bound from a date or datetime string, in the current time zone unless it says otherwise.
+    Raises ValueError for anything else.
+    """
+    parsed = parse_datetime(value)
+    if parsed is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError('Expected a date or datetime, not {}'.format(value))
+        parsed = datetime.combine(date, datetime.min.time())
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def export_lines(format, history=False, since=None, until=None, chunk_size=None):
+    """
+    The export, as lines of text in the given format (one of FORMATS).
+    """
+    columns = HISTORY_COLUMNS if history else EVENT_COLUMNS
+    rows = export_rows(history, since, until, chunk_size)
+    if format == 'csv':
+        return csv_lines(rows, columns)
+    return ndjson_lines(rows, columns)
@@ -0,0 +1,104 @@
+import asyncio
+import json
+import time
+
+from django.conf import settings
+
+from . import metrics
+
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Close code for sockets that stopped answering heartbeats
+HEARTBEAT_TIMEOUT = 4408
+
+PING = '{"type": "ping"}'
+
+
+def is_pong(text):
+    # cheap enough: clients don't send much else
+    try:
+        return '"pong"' in text and json.loads(text).get('type') == 'pong'
+    except (ValueError, AttributeError):
+        return False
+
+
+class Heartbeat(object):
+    """
+    Pings the WebSockets that asked for heartbeats every `interval` seconds, and closes
+    (removing them from their groups first) those we haven't heard from in `timeout` seconds:
+    dead mobile clients and the like, whose TCP connections can linger for much longer.
+
+    A single task per worker pings every socket, rather than one task per socket,
+    and all it keeps per socket is when we last heard from it.
+    """
+
+    def __init__(self, interval, timeout, clock=time.monotonic):
+        self.interval = interval
+        self.timeout = timeout
+        self.clock = clock
+        self._last_seen = {}
+        self._task = None
+        self._beating = False
+
+    def __len__(self):
+        return len(self._last_seen)
+
+    def watch(self, consumer):
+        self._last_seen[consumer] = self.clock()
+        if self._task is None:
+            self._task = asyncio.ensure_future(self.run())
+
+    def seen(self, consumer):
+        if consumer in self._last_seen:
+            self._last_seen[consumer] = self.clock()
+
+    def forget(self, consumer):
+        self._last_seen.pop(consumer, None)
+        # (if it's beating, the task stops by itself when it's done)
+        if not self._last_seen and self._task is not None and not self._beating:
+            self._task.cancel()
+            self._task = None
+
+    async def run(self):
+        while self._last_seen:
+            await asyncio.sleep(self.interval)
+            self._beating = True
+            try:
+                await self.beat()
+            finally:
+                self._beating = False
+        self._task = None
+
+    async def beat(self):
+        """
+        Reap the sockets that missed their heartbeats, and ping the rest.
+        """
+        deadline = self.clock() - self.timeout
+        dead = [consumer for consumer, last_seen in self._last_seen.items() if last_seen < deadline]
+        for consumer in dead:
+            del self._last_seen[consumer]
+        metrics.WS_REAPED.inc(amount=len(dead))
+        await asyncio.gather(*[self.reap(consumer) for consumer in dead])
+
+        for consumer in list(self._last_seen):
+            try:
+                await consumer.send(text_data=PING)
+            except Exception:
+                logger.debug('Failed to ping {}'.format(consumer.channel_name), exc_info=True)
+                self._last_seen.pop(consumer, None)
+
+    async def reap(self, consumer):
+        try:
+            await consumer.leave_groups()
+            await consumer.close(code=HEARTBEAT_TIMEOUT)
+        except Exception:
+            logger.exception('Failed to reap {}'.format(consumer.channel_name))
+
+
+heartbeat = Heartbeat(
+    interval=settings.WS_HEARTBEAT_INTERVAL,
+    timeout=settings.WS_HEARTBEAT_TIMEOUT
+)
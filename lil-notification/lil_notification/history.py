@@ -0,0 +1,102 @@
+import json
+import time
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.db.models import Exists, Max, Min, OuterRef, Q
+
+from .models import MaintenanceEvent
+
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+History = MaintenanceEvent.history.model
+
+# The columns that make one history row differ from the previous one.
+# (`modified` changes on every save, whether or not anything else did.)
+TRACKED_COLUMNS = [field.column for field in MaintenanceEvent._meta.fields if field.name not in ('id', 'modified')]
+
+
+class HistoryPruner(object):
+    """
+    Keeps HistoricalMaintenanceEvent from growing without bound; see the prune_history management command.
+
+    Rows are deleted in batches of `batch_size`, each in its own short transaction,
+    sleeping `pause` seconds in between so as not to starve other writers.
+    With `dry_run`, nothing is deleted, and the methods return what would have been.
+    With `archive`, a file object, deleted rows are first written to it as JSON lines.
+    """
+
+    def __init__(self, batch_size, pause=0, dry_run=False, archive=None):
+        self.batch_size = batch_size
+        self.pause = pause
+        self.dry_run = dry_run
+        self.archive = archive
+
+    def expire(self, cutoff):
+        """
+        Delete history recorded before `cutoff`, keeping the latest row of each event that
+        still exists, so that every event keeps a record of its current state.
+        Returns the number of rows deleted.
+        """
+        newer = History.objects.filter(id=OuterRef('id')).filter(
+            Q(history_date__gt=OuterRef('history_date')) |
+            # e.g. rows written in bulk
+            Q(history_date=OuterRef('history_date'), history_id__gt=OuterRef('history_id'))
+        )
+        expired = History.objects.filter(history_date__lt=cutoff).annotate(
+            superseded=Exists(newer)
+        ).filter(Q(superseded=True) | Q(history_type='-'))
+        if self.dry_run:
+            return expired.count()
+
+        deleted = 0
+        while True:
+            ids = list(expired.order_by('history_id').values_list('history_id', flat=True)[:self.batch_size])
+            if not ids:
+                return deleted
+            deleted += self.delete(ids)
+
+    def compact(self):
+        """
+        Delete the update rows that recorded no change to the event's tracked fields
+        (e.g. repeated PATCHes of the same status), working through the events
+        `batch_size` at a time. Returns the number of rows deleted.
+        """
+        bounds = History.objects.aggregate(first=Min('id'), last=Max('id'))
+        if bounds['first'] is None:
+            return 0
+        columns = ', '.join(connection.ops.quote_name(column) for column in TRACKED_COLUMNS)
+        sql = '''
+            SELECT history_id FROM (
+                SELECT history_id, history_type,
+                    ROW({columns}) IS NOT DISTINCT FROM
+                    LAG(ROW({columns})) OVER (PARTITION BY id ORDER BY history_date, history_id) AS unchanged
+                FROM {table}
+                WHERE id >= %s AND id < %s
+            ) AS history
+            WHERE unchanged AND history_type = '~'
+            ORDER BY history_id
+        '''.format(columns=columns, table=connection.ops.quote_name(History._meta.db_table))
+
+        deleted = 0
+        for start in range(bounds['first'], bounds['last'] + 1, self.batch_size):
+            with connection.cursor() as cursor:
+                cursor.execute(sql, [start, start + self.batch_size])
+                ids = [row[0] for row in cursor.fetchall()]
+            if ids:
+                deleted += len(ids) if self.dry_run else self.delete(ids)
+        return deleted
+
+    def delete(self, ids):
+        with transaction.atomic():
+            if self.archive:
+                for row in History.objects.filter(history_id__in=ids).order_by('history_id').values():
+                    self.archive.write(json.dumps(row, cls=DjangoJSONEncoder) + '\n')
+            deleted, _ = History.objects.filter(history_id__in=ids).delete()
+        logger.debug('Deleted {} history rows'.format(deleted))
+        if self.pause:
+            time.sleep(self.pause)
+        return deleted
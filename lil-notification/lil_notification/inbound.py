@@ -0,0 +1,89 @@
+import asyncio
+from collections import deque
+import json
+
+from django.conf import settings
+
+from . import metrics
+from .ratelimit import TokenBuckets
+
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Close code for frames larger than WS_TEST_MESSAGE_MAX_BYTES
+MESSAGE_TOO_BIG = 1009
+
+MAX_STATUS_LENGTH = 200
+
+
+def parse_test_message(text):
+    """
+    The JSON to relay to the tier for the test message a client sent, as text:
+        {"active": true or false, "status": "Test message ..." or null}
+    Other members are dropped. Raises ValueError if it doesn't look like that.
+    """
+    message = json.loads(text)
+    if not isinstance(message, dict):
+        raise ValueError('Expected a JSON object')
+    active = message.get('active', False)
+    status = message.get('status')
+    if not isinstance(active, bool):
+        raise ValueError('Expected "active" to be true or false')
+    if status is not None and not (isinstance(status, str) and len(status) <= MAX_STATUS_LENGTH):
+        raise ValueError('Expected "status" to be a string of at most {} characters'.format(MAX_STATUS_LENGTH))
+    return json.dumps({'active': active, 'status': status})
+
+
+def channel_test_message(group, text):
+    """
+    The channel-layer message relaying a test message to a maintenance group:
+    like models.channel_message, but handled by the consumers' test_msg().
+    """
+    return {'type': 'test_msg', 'group': group, 'text': text}
+
+
+class LowPrioritySender(object):
+    """
+    Sends test messages on to sockets from a single task per worker, one at a time,
+    letting everything else that's ready run in between, so that they never hold up
+    broadcasts: consumers hand test messages over and go straight back to their channel.
+
+    At most `max_pending` wait to be sent; beyond that, they're dropped.
+    """
+
+    def __init__(self, max_pending):
+        self.max_pending = max_pending
+        self._pending = deque()
+        self._task = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def submit(self, consumer, text):
+        if len(self._pending) >= self.max_pending:
+            metrics.WS_TEST_DELIVERIES_DROPPED.inc()
+            return
+        self._pending.append((consumer, text))
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while self._pending:
+            consumer, text = self._pending.popleft()
+            try:
+                await consumer.send(text_data=text)
+            except Exception:
+                # e.g. it has disconnected since
+                logger.debug('Failed to send a test message to {}'.format(consumer.channel_name), exc_info=True)
+            await asyncio.sleep(0)
+
+
+# Per worker: the tiers' limits are only shared by the sockets each worker holds
+group_test_message_limits = TokenBuckets(
+    rate=settings.WS_TEST_MESSAGE_GROUP_RATE,
+    burst=settings.WS_TEST_MESSAGE_GROUP_BURST
+)
+
+low_priority_sender = LowPrioritySender(max_pending=settings.WS_TEST_MESSAGE_MAX_PENDING)
@@ -0,0 +1,107 @@
+from bisect import bisect
+import hashlib
+
+from channels_redis.core import RedisChannelLayer
+
+
+class HashRing(object):
+    """
+    Consistent hashing: maps keys to nodes, each node owning `replicas` points on a ring.
+    A key belongs to the node owning the first point at or after the key's hash.
+
+    Adding a node to N only moves about 1/(N+1) of the keys, all of them to the new node;
+    removing one only moves that node's keys.
+    """
+
+    def __init__(self, nodes, replicas=160):
+        points = sorted(
+            (self.hash('{}-{}'.format(node, i)), index)
+            for index, node in enumerate(nodes)
+            for i in range(replicas)
+        )
+        self.points = [point for point, _ in points]
+        self.owners = [index for _, index in points]
+
+    @staticmethod
+    def hash(key):
+        if isinstance(key, str):
+            key = key.encode('utf8')
+        return int.from_bytes(hashlib.md5(key).digest()[:8], 'big')
+
+    def node(self, key):
+        """
+        The index, in the nodes we were given, of the node `key` belongs to.
+        """
+        return self.owners[bisect(self.points, self.hash(key)) % len(self.points)]
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    """
+    channels_redis' layer, spreading groups and channels across its `hosts` with a HashRing,
+    rather than by ranges of a CRC, which moves most groups whenever a host is added.
+
+    Each group's membership lives on one host, and each process' channels share one
+    inbox on one host, so messages sent to a group arrive in the order they were sent.
+    The ring is keyed on the hosts' addresses, not their order, so every process must be
+    given the same hosts, but not necessarily in the same order. Change them with a rolling
+    restart: sockets reconnect, rejoin their groups on the new ring, and catch up with ?since=.
+
+    With `local_fanout`, a process joins each group its channels are in once, with its inbox,
+    and keeps which of its channels are in the group itself: a group_send is then one message
+    per process rather than one per channel, and each process' receive loop hands it to its
+    channels in the group. Every process must agree on `local_fanout`, too.
+    """
+
+    def __init__(self, hosts=None, replicas=160, local_fanout=False, **kwargs):
+        super(ShardedRedisChannelLayer, self).__init__(hosts=hosts, **kwargs)
+        self.ring = HashRing([str(host['address']) for host in self.hosts], replicas)
+        self.local_fanout = local_fanout
+        # group -> the channels of ours in it, with local_fanout
+        self.local_groups = {}
+
+    def consistent_hash(self, value):
+        return self.ring.node(value)
+
+    def fanned_out_locally(self, channel):
+        return self.local_fanout and '!' in channel and self.non_local_name(channel).endswith(self.client_prefix + '!')
+
+    async def group_add(self, group, channel):
+        if not self.fanned_out_locally(channel):
+            await super(ShardedRedisChannelLayer, self).group_add(group, channel)
+            return
+        self.local_groups.setdefault(group, set()).add(channel)
+        # (again on every join, to renew it: members expire after group_expiry)
+        await super(ShardedRedisChannelLayer, self).group_add(group, self.non_local_name(channel))
+
+    async def group_discard(self, group, channel):
+        if not self.fanned_out_locally(channel):
+            await super(ShardedRedisChannelLayer, self).group_discard(group, channel)
+            return
+        channels = self.local_groups.get(group)
+        if not channels or channel not in channels:
+            return
+        channels.remove(channel)
+        if channels:
+            return
+        del self.local_groups[group]
+        inbox = self.non_local_name(channel)
+        await super(ShardedRedisChannelLayer, self).group_discard(group, inbox)
+        # One of ours may have joined while we were leaving
+        if self.local_groups.get(group):
+            await super(ShardedRedisChannelLayer, self).group_add(group, inbox)
+
+    async def group_send(self, group, message):
+        if self.local_fanout:
+            message = dict(message, __asgi_group__=group)
+        await super(ShardedRedisChannelLayer, self).group_send(group, message)
+
+    async def receive_loop(self, general_channel):
+        while True:
+            channel, message = await self.receive_single(general_channel)
+            group = message.pop('__asgi_group__', None)
+            if group is None:
+                self.receive_buffer.setdefault(channel, []).append(message)
+                continue
+            for channel in self.local_groups.get(group, ()):
+                self.receive_buffer.setdefault(channel, []).append(dict(message))
+
@@ -0,0 +1,34 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from lil_notification import metrics
+from lil_notification.dispatch import Dispatcher
+
+
+class Command(BaseCommand):
+    help = 'Publish queued maintenance broadcasts from the outbox to the channel layer.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.OUTBOX_BATCH_SIZE)
+        parser.add_argument('--poll-interval', type=float, default=settings.OUTBOX_POLL_INTERVAL,
+                            help='Seconds to sleep when the outbox is empty.')
+        parser.add_argument('--once', action='store_true',
+                            help='Drain the outbox and exit, rather than running forever.')
+        parser.add_argument('--metrics-port', type=int,
+                            help='Serve Prometheus metrics on this port.')
+
+    def handle(self, *args, **options):
+        if options['metrics_port']:
+            metrics.serve(options['metrics_port'])
+        dispatcher = Dispatcher(batch_size=options['batch_size'])
+        try:
+            while True:
+                handled = dispatcher.dispatch_batch()
+                if handled < dispatcher.batch_size:
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+        finally:
+            dispatcher.close()
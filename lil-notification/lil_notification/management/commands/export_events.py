@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from lil_notification import export
+
+
+class Command(BaseCommand):
+    help = 'Write every maintenance event, and optionally its history, as NDJSON or CSV.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output-format', choices=export.FORMATS, default='ndjson')
+        parser.add_argument('--history', action='store_true',
+                            help='Follow each event with its history.')
+        parser.add_argument('--since', help='Only events modified, and history recorded, at or after this date or datetime.')
+        parser.add_argument('--until', help='Only events modified, and history recorded, before this date or datetime.')
+        parser.add_argument('--chunk-size', type=int, default=settings.EXPORT_CHUNK_SIZE)
+        parser.add_argument('--file', help='Write to this file rather than to stdout.')
+
+    def handle(self, *args, **options):
+        bounds = {}
+        for bound in ['since', 'until']:
+            if options[bound]:
+                try:
+                    bounds[bound] = export.parse_bound(options[bound])
+                except ValueError as e:
+                    raise CommandError(e)
+
+        lines = export.export_lines(
+            options['output_format'],
+            history=options['history'],
+            chunk_size=options['chunk_size'],
+            **bounds
+        )
+        if options['file']:
+            with open(options['file'], 'w', newline='') as f:
+                f.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
@@ -0,0 +1,49 @@
+from datetime import timedelta
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from lil_notification.history import HistoryPruner
+
+
+class Command(BaseCommand):
+    help = 'Delete expired and redundant HistoricalMaintenanceEvent rows.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.HISTORY_RETENTION_DAYS,
+                            help='Delete history older than this, keeping the latest row of each existing event.')
+        parser.add_argument('--no-compact', action='store_true',
+                            help="Don't delete update rows that recorded no change.")
+        parser.add_argument('--batch-size', type=int, default=settings.HISTORY_PRUNE_BATCH_SIZE)
+        parser.add_argument('--pause', type=float, default=0,
+                            help='Seconds to sleep between batches, to go easy on a busy database.')
+        parser.add_argument('--archive', help='Append deleted rows to this file, as JSON lines.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report how many rows would be deleted, without deleting them.')
+
+    def handle(self, *args, **options):
+        archive = open(options['archive'], 'a') if options['archive'] and not options['dry_run'] else None
+        pruner = HistoryPruner(
+            batch_size=options['batch_size'],
+            pause=options['pause'],
+            dry_run=options['dry_run'],
+            archive=archive
+        )
+        try:
+            self.report(pruner, 'Expired', pruner.expire, timezone.now() - timedelta(days=options['days']))
+            if not options['no_compact']:
+                self.report(pruner, 'Unchanged', pruner.compact)
+        finally:
+            if archive:
+                archive.close()
+
+    def report(self, pruner, label, prune, *args):
+        start = time.monotonic()
+        count = prune(*args)
+        elapsed = time.monotonic() - start
+        verb = 'would delete' if pruner.dry_run else 'deleted'
+        self.stdout.write('{}: {} {} rows in {:.1f}s ({:.0f} rows/s)'.format(
+            label, verb, count, elapsed, count / elapsed if elapsed else 0
+        ))
@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from lil_notification.scheduler import Scheduler
+
+
+class Command(BaseCommand):
+    help = 'Start and complete maintenance events at their scheduled_start and scheduled_end.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.SCHEDULER_BATCH_SIZE)
+        parser.add_argument('--once', action='store_true',
+                            help='Apply the transitions that are due now and exit, rather than running forever.')
+
+    def handle(self, *args, **options):
+        scheduler = Scheduler(batch_size=options['batch_size'])
+        try:
+            if options['once']:
+                scheduler.apply_due()
+            else:
+                scheduler.run()
+        finally:
+            scheduler.close()
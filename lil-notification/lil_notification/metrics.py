@@ -0,0 +1,213 @@
+"""
+Operational metrics, in Prometheus' text exposition format.
+
+Metrics are kept per process: scrape /metrics on each web worker, and pass --metrics-port
+to the dispatch_broadcasts worker to have it serve its own.
+Recording a sample takes a lock and a few arithmetic operations, so it's cheap enough
+for the hot paths; rendering happens only when scraped.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import threading
+import time
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_metrics = []
+_collectors = []
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def samples(self):
+        """
+        Yields (name suffix, label names, label values, value).
+        """
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in sorted(values):
+            yield '', self.labels, label_values, value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+    default_buckets = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name, documentation, labels=(), buckets=default_buckets):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            # a count per bucket, then the +Inf count, then the sum
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bucket] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def samples(self):
+        with self._lock:
+            values = [(label_values, list(counts)) for label_values, counts in self._values.items()]
+        labels = self.labels + ('le',)
+        for label_values, counts in sorted(values):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield '_bucket', labels, label_values + (format_float(bound),), cumulative
+            yield '_sum', self.labels, label_values, counts[-1]
+            yield '_count', self.labels, label_values, cumulative
+
+
+def collector(func):
+    """
+    Register a function returning [(name, type, documentation, value)],
+    called at each scrape: for values that are kept elsewhere, like cache sizes.
+    """
+    _collectors.append(func)
+    return func
+
+
+def format_float(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+        for suffix, labels, label_values, value in metric.samples():
+            label_text = ','.join('{}="{}"'.format(label, escape(v)) for label, v in zip(labels, label_values))
+            lines.append('{}{}{} {}'.format(
+                metric.name, suffix, '{' + label_text + '}' if label_text else '', format_float(value)
+            ))
+    for func in _collectors:
+        for name, type, documentation, value in func():
+            lines.append('# HELP {} {}'.format(name, documentation))
+            lines.append('# TYPE {} {}'.format(name, type))
+            lines.append('{} {}'.format(name, format_float(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def serve(port):
+    """
+    Serve /metrics from a background thread: for the workers that don't serve HTTP.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = render().encode('utf8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('', port), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+class RequestMetricsMiddleware(object):
+    """
+    Times every request, labelled by the name of the URL pattern that served it.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        response = self.get_response(request)
+        match = getattr(request, 'resolver_match', None)
+        view = match.url_name if match and match.url_name else 'unknown'
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, view, request.method)
+        HTTP_RESPONSES.inc(view, str(response.status_code))
+        return response
+
+
+###
+# The metrics themselves
+###
+
+# WebSockets and other subscribers, by maintenance group
+GROUP_JOINS = Counter('lil_group_joins_total', 'Subscriptions to maintenance groups, by sockets and HTTP streams.', ['group'])
+GROUP_LEAVES = Counter('lil_group_leaves_total', 'Subscriptions to maintenance groups ended.', ['group'])
+GROUP_SUBSCRIBERS = Gauge('lil_group_subscribers', 'Current subscriptions to maintenance groups in this process.', ['group'])
+WS_CONNECTS_REJECTED = Counter('lil_ws_connects_rejected_total', 'WebSocket connects turned away by admission control.')
+WS_CONNECT_SECONDS = Histogram('lil_ws_connect_seconds', 'Time to set up an admitted WebSocket connection.', ['consumer'])
+WS_REAPED = Counter('lil_ws_reaped_total', 'WebSockets closed for missing their heartbeats.')
+WS_SEND_SECONDS = Histogram('lil_ws_send_seconds', 'Time to hand a broadcast to one socket.', ['consumer'])
+WS_TEST_MESSAGES = Counter('lil_ws_test_messages_total', 'Test messages received from WebSockets, by outcome.', ['result'])
+WS_TEST_DELIVERIES_DROPPED = Counter(
+    'lil_ws_test_deliveries_dropped_total', 'Test messages not sent on to a socket, because too many were pending.'
+)
+WS_MULTIPLEX_FRAMES = Counter(
+    'lil_ws_multiplex_frames_total', 'Subscribe/unsubscribe frames received from multiplexed WebSockets, by outcome.', ['result']
+)
+
+# Broadcasts, as published by the dispatcher
+BROADCASTS_PUBLISHED = Counter('lil_broadcasts_published_total', 'Broadcasts published to the channel layer.')
+BROADCAST_PUBLISH_SECONDS = Histogram('lil_broadcast_publish_seconds', 'Time to publish one broadcast to the channel layer.')
+BROADCAST_DELAY_SECONDS = Histogram(
+    'lil_broadcast_delay_seconds', 'Time from queueing a broadcast to publishing it.',
+    buckets=(.1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300)
+)
+CHANNEL_LAYER_ERRORS = Counter('lil_channel_layer_errors_total', 'Failed channel layer operations.', ['operation'])
+
+# Maintenance state lookups, on connect and in the status views
+SNAPSHOT_LOOKUPS = Counter('lil_snapshot_lookups_total', 'Snapshot cache lookups.', ['result'])
+SNAPSHOT_LOAD_SECONDS = Histogram('lil_snapshot_load_seconds', 'Time to load snapshots from the database on a cache miss.', ['method'])
+
+# REST API and other Django views
+HTTP_REQUEST_SECONDS = Histogram('lil_http_request_seconds', 'Time to serve an HTTP request through Django.', ['view', 'method'])
+HTTP_RESPONSES = Counter('lil_http_responses_total', 'HTTP responses served through Django.', ['view', 'status'])
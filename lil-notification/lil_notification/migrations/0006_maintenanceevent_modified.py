@@ -0,0 +1,25 @@
+# Generated by Django 2.0.4 on 2026-10-18 10:15
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lil_notification', '0005_outboxmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historicalmaintenanceevent',
+            name='modified',
+            field=models.DateTimeField(blank=True, default=django.utils.timezone.now, editable=False),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='maintenanceevent',
+            name='modified',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
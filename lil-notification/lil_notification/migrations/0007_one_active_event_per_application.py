@@ -0,0 +1,24 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """
+    Enforce one active MaintenanceEvent per Application in the database;
+    see models.ONE_ACTIVE_EVENT_INDEX. (Django 2.0 can't express partial indexes.)
+
+    Fails if an application already has more than one active event:
+    cancel the extras first.
+    """
+
+    dependencies = [
+        ('lil_notification', '0006_maintenanceevent_modified'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            "CREATE UNIQUE INDEX lil_notification_maintenanceevent_one_active "
+            "ON lil_notification_maintenanceevent (application_id) "
+            "WHERE status IN ('imminent', 'in_progress');",
+            reverse_sql="DROP INDEX lil_notification_maintenanceevent_one_active;"
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 2.0.4 on 2026-10-18 10:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lil_notification', '0007_one_active_event_per_application'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='maintenanceevent',
+            index=models.Index(fields=['application', 'status'], name='maintenance_app_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='maintenanceevent',
+            index=models.Index(fields=['application', 'scheduled_start'], name='maintenance_app_start_idx'),
+        ),
+    ]
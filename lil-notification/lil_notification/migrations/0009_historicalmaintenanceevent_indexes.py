@@ -0,0 +1,29 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """
+    Indexes for per-event history lookups, and for finding expired history:
+    see history.py. (simple_history generates the historical model, so they
+    can't be declared in its Meta.)
+
+    Built CONCURRENTLY, so as not to lock a large history table for writes.
+    """
+    atomic = False
+
+    dependencies = [
+        ('lil_notification', '0008_maintenanceevent_indexes'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS historicalmaintenance_id_date_idx "
+            "ON lil_notification_historicalmaintenanceevent (id, history_date);",
+            reverse_sql="DROP INDEX CONCURRENTLY IF EXISTS historicalmaintenance_id_date_idx;"
+        ),
+        migrations.RunSQL(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS historicalmaintenance_date_idx "
+            "ON lil_notification_historicalmaintenanceevent (history_date);",
+            reverse_sql="DROP INDEX CONCURRENTLY IF EXISTS historicalmaintenance_date_idx;"
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.0.4 on 2026-10-18 10:41
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lil_notification', '0009_historicalmaintenanceevent_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Broadcast',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('group', models.CharField(max_length=200)),
+                ('sequence', models.PositiveIntegerField()),
+                ('payload', models.TextField()),
+                ('published', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='broadcast',
+            unique_together={('group', 'sequence')},
+        ),
+    ]
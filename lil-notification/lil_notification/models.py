@@ -1,16 +1,21 @@
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
+from datetime import timedelta
+import json
+
 from simple_history.models import HistoricalRecords
 
 from rest_framework.authtoken.models import Token
 
 from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.models.signals import post_save, pre_delete
+from django.db import IntegrityError, models, transaction
+from django.db.models.signals import post_delete, post_init, post_save, pre_delete, pre_save
 from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.functional import cached_property
 
+from .authentication import token_cache
+from .snapshots import snapshot_cache
+
 
 import logging
 logger = logging.getLogger(__name__)
@@ -21,6 +26,41 @@ ACTIVE_STATUSES = [
     'in_progress'
 ]
 
+# Partial unique index allowing one active MaintenanceEvent per Application;
+# see migration 0007
+ONE_ACTIVE_EVENT_INDEX = 'lil_notification_maintenanceevent_one_active'
+
+def maintenance_group(slug, tier):
+    return 'maintenance_{}_{}'.format(slug, tier)
+
+# Poked by the dispatcher when it publishes broadcasts; see scheduler.py
+SCHEDULER_GROUP = 'scheduler'
+
+# Told by the dispatcher which maintenance groups' state changed, before it publishes
+# their broadcasts, so that every web process drops them from its cache; see snapshots.py
+SNAPSHOTS_GROUP = 'snapshots'
+
+
+def channel_message(group, text, sequence=None):
+    """
+    The channel-layer message for a broadcast to a maintenance group.
+    `text` is the JSON-encoded payload, encoded once by the sender
+    and written as-is to each socket by ChatConsumer.maintenance_msg.
+    Published broadcasts also carry their `sequence` number: see Broadcast.
+    """
+    message = {'type': 'maintenance_msg', 'group': group, 'text': text}
+    if sequence is not None:
+        message['sequence'] = sequence
+    return message
+
+
+# The MaintenanceEvent fields that get_details_for_ws() depends on
+BROADCAST_FIELDS = (
+    'status',
+    'scheduled_start',
+    'scheduled_end'
+)
+
 
 class Application(models.Model):
     # required fields
@@ -61,8 +101,15 @@ class MaintenanceEvent(models.Model):
     started = models.DateTimeField(blank=True, null=True)
     ended = models.DateTimeField(blank=True, null=True)
     reason =  models.TextField(blank=True, null=True)
+    modified = models.DateTimeField(auto_now=True)
     history = HistoricalRecords()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['application', 'status'], name='maintenance_app_status_idx'),
+            models.Index(fields=['application', 'scheduled_start'], name='maintenance_app_start_idx'),
+        ]
+
     # Django methods
 
     def __str__(self):
@@ -70,31 +117,48 @@ class MaintenanceEvent(models.Model):
 
     def clean(self):
         super(MaintenanceEvent, self).clean()
-        if MaintenanceEvent.invalid_active_status_for_pk(self.id, self.status):
-            raise ValidationError(
-                'There is already an active maintenance event for {}.'.format(
-                    self.application.name
-                )
-            )
+        if MaintenanceEvent.other_active_event_exists(self.application_id, self.id, self.status):
+            raise self.already_active_error()
+
+    def save(self, *args, **kwargs):
+        # The database has the last word: two concurrent saves can both pass clean()
+        try:
+            with transaction.atomic():
+                super(MaintenanceEvent, self).save(*args, **kwargs)
+        except IntegrityError as e:
+            if ONE_ACTIVE_EVENT_INDEX in str(e):
+                raise self.already_active_error()
+            raise
 
 
     # Custom methods
 
     @classmethod
-    def invalid_active_status_for_pk(cls, pk, status):
+    def other_active_event_exists(cls, application_id, pk, status):
         # We should be able to update the statuses of active events,
-        # but if a different active event already exists, we
-        # should not be able to create another one.
-        already_active = cls.objects.filter(status__in=ACTIVE_STATUSES)
-        return already_active.count() > 1 or (
-            already_active and \
-            already_active.get().id != pk and \
-            (status in ACTIVE_STATUSES or not status)
+        # but if a different active event already exists for the application,
+        # we should not be able to create another one.
+        if status and status not in ACTIVE_STATUSES:
+            return False
+        return cls.objects.filter(
+            application_id=application_id,
+            status__in=ACTIVE_STATUSES
+        ).exclude(pk=pk).exists()
+
+    def already_active_error(self):
+        return ValidationError(
+            'There is already an active maintenance event for {}.'.format(
+                self.application.name
+            )
         )
 
     def is_active(self):
         return self.status in ACTIVE_STATUSES
 
+    def get_broadcast_state(self):
+        # read from __dict__, so that deferred fields aren't loaded
+        return tuple(self.__dict__.get(field) for field in BROADCAST_FIELDS)
+
     def get_details_for_ws(self):
         return {
             'active': self.is_active(),
@@ -104,15 +168,181 @@ class MaintenanceEvent(models.Model):
         }
 
 
+class OutboxMessage(models.Model):
+    """
+    A channel-layer broadcast waiting to be published.
+
+    Written in the same transaction as the change that triggered it, so it is
+    published if and only if that transaction commits; see dispatch.py.
+    """
+    group = models.CharField(max_length=200)
+    payload = models.TextField()  # JSON text, as sent to each socket
+    created = models.DateTimeField(default=timezone.now)
+    next_attempt = models.DateTimeField(default=timezone.now, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, null=True)
+
+    def __str__(self):
+        return "{}: {}".format(self.id, self.group)
+
+    @classmethod
+    def enqueue(cls, group, payload):
+        """
+        Queue a broadcast, to be published BROADCAST_COALESCE_WINDOW seconds from now.
+
+        Every message carries the full state of the group, so if one is already waiting
+        for this group, we just replace its payload: rapid successive changes
+        go out as a single broadcast of the latest state.
+        (Rows locked by a dispatcher are being published right now, and are skipped.)
+        """
+        return cls.enqueue_many({group: payload})[0]
+
+    @classmethod
+    def enqueue_many(cls, payloads):
+        """
+        Like enqueue(), for a dict of group -> payload, with one query to find
+        pending messages and one to insert the rest.
+        """
+        with transaction.atomic():
+            pending = {}
+            # in id order, so the latest pending message of each group wins
+            for message in cls.objects.select_for_update(skip_locked=True).filter(group__in=payloads).order_by('id'):
+                pending[message.group] = message
+            for group, message in pending.items():
+                message.payload = payloads[group]
+                message.save(update_fields=['payload'])
+            next_attempt = timezone.now() + timedelta(seconds=settings.BROADCAST_COALESCE_WINDOW)
+            created = cls.objects.bulk_create([
+                cls(group=group, payload=payload, next_attempt=next_attempt)
+                for group, payload in payloads.items() if group not in pending
+            ])
+            return list(pending.values()) + created
+
+
+class Broadcast(models.Model):
+    """
+    A published broadcast, numbered in sequence within its group.
+
+    The last BROADCAST_BUFFER_SIZE broadcasts of each group are kept, so that
+    reconnecting clients can catch up on what they missed: see resume().
+    """
+    group = models.CharField(max_length=200)
+    sequence = models.PositiveIntegerField()
+    payload = models.TextField()
+    published = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = ('group', 'sequence')
+
+    def __str__(self):
+        return "{}: {} #{}".format(self.id, self.group, self.sequence)
+
+    @classmethod
+    def record(cls, messages):
+        """
+        Number the given OutboxMessages, in order, after the latest broadcast of their group,
+        and record them. Returns a dict of message id -> Broadcast.
+
+        Two dispatchers numbering broadcasts of the same group at once
+        would collide on the unique constraint, and one of them roll back.
+        """
+        latest = cls.latest({message.group for message in messages})
+        broadcasts = {}
+        for message in messages:
+            latest[message.group] = latest.get(message.group, 0) + 1
+            broadcasts[message.id] = cls(group=message.group, sequence=latest[message.group], payload=message.payload)
+        cls.objects.bulk_create(broadcasts.values())
+        return broadcasts
+
+    @classmethod
+    def latest(cls, groups):
+        """
+        A dict of group -> the sequence number of its latest broadcast, for those of `groups` that had any.
+        """
+        return dict(
+            cls.objects.filter(group__in=groups).values('group').annotate(
+                latest=models.Max('sequence')
+            ).values_list('group', 'latest')
+        )
+
+    @classmethod
+    def prune(cls, latest):
+        """
+        Drop all but the last BROADCAST_BUFFER_SIZE broadcasts of each group,
+        given a dict of group -> latest sequence.
+        """
+        query = models.Q()
+        for group, sequence in latest.items():
+            query |= models.Q(group=group, sequence__lte=sequence - settings.BROADCAST_BUFFER_SIZE)
+        if query:
+            cls.objects.filter(query).delete()
+
+    @classmethod
+    def resume(cls, group, since):
+        """
+        The (sequence, payload) of the broadcasts a client that last saw broadcast number `since`
+        has missed, in order. If some have already been dropped (or `since` is 0, for a new client,
+        or unknown), just the latest, which carries the full state. None if the group has never
+        had a broadcast.
+        """
+        missed = list(cls.objects.filter(group=group, sequence__gte=since).order_by('sequence').values_list('sequence', 'payload'))
+        if since and missed and missed[0][0] <= since + 1:
+            return [(sequence, payload) for sequence, payload in missed if sequence > since]
+        if missed:
+            return missed[-1:]
+        latest = cls.objects.filter(group=group).order_by('-sequence').values_list('sequence', 'payload').first()
+        return [latest] if latest else None
+
+
+def invalidate_snapshot(application):
+    """
+    Drop the cached snapshot now, and again once the transaction commits,
+    in case a concurrent connect re-cached the pre-commit state in the meantime.
+    """
+    slug, tier = application.slug, application.tier
+    snapshot_cache.invalidate(slug, tier)
+    transaction.on_commit(lambda: snapshot_cache.invalidate(slug, tier))
+
+
+@receiver(post_save, sender=Application)
+@receiver(post_delete, sender=Application)
+def invalidate_application_snapshot(sender, instance=None, **kwargs):
+    if instance:
+        invalidate_snapshot(instance)
+
+
+@receiver(post_init, sender=MaintenanceEvent)
+def remember_broadcast_state(sender, instance=None, **kwargs):
+    if instance:
+        instance._broadcast_state = instance.get_broadcast_state()
+
+
+@receiver(pre_save, sender=MaintenanceEvent)
+def read_stored_broadcast_state(sender, instance=None, raw=False, **kwargs):
+    """
+    Compare with the row as stored, not as this instance loaded it: another process may
+    have changed it since, and saving it back to its load-time state is then a change.
+    """
+    if instance and not raw and not instance._state.adding:
+        instance._broadcast_state = MaintenanceEvent.objects.filter(pk=instance.pk).values_list(*BROADCAST_FIELDS).first()
+
+
 @receiver(post_save, sender=MaintenanceEvent)
 def notify_groups(sender, instance=None, created=False, **kwargs):
     if instance:
+        invalidate_snapshot(instance.application)
+        state = instance.get_broadcast_state()
+        if not created and state == instance._broadcast_state:
+            # e.g. only `reason` changed: clients would get an identical message
+            logger.debug('No broadcast needed for MaintenanceEvent {}'.format(instance))
+            return
+        instance._broadcast_state = state
         logger.info('Notifying {} about MaintenanceEvent {}'.format(instance.application.name, instance))
-        group = 'maintenance_{}_{}'.format(instance.application.slug, instance.application.tier)
-        data = {'type': 'maintenance_msg'}
-        data.update(instance.get_details_for_ws())
-        async_to_sync(get_channel_layer().group_send)(group, data)
-        logger.info('Notified {} about MaintenanceEvent {}'.format(instance.application.name, instance))
+        group = maintenance_group(instance.application.slug, instance.application.tier)
+        # Encoded once here, rather than once per subscriber;
+        # published by the dispatcher once (and only if) this transaction commits
+        OutboxMessage.enqueue(group, json.dumps(instance.get_details_for_ws()))
+        logger.info('Queued notification for {} about MaintenanceEvent {}'.format(instance.application.name, instance))
 
 
 @receiver(pre_delete, sender=MaintenanceEvent)
@@ -132,3 +362,26 @@ def create_auth_token(sender, instance=None, created=False, **kwargs):
         Token.objects.create(
             user=instance
         )
+
+
+def invalidate_token(key):
+    """
+    Drop the cached token now, and again once the transaction commits: see invalidate_snapshot.
+    """
+    token_cache.invalidate(key)
+    transaction.on_commit(lambda: token_cache.invalidate(key))
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def invalidate_cached_token(sender, instance=None, **kwargs):
+    if instance:
+        invalidate_token(instance.key)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def invalidate_cached_user_tokens(sender, instance=None, created=False, **kwargs):
+    # e.g. deactivated, or no longer staff
+    if instance and not created:
+        for key in Token.objects.filter(user=instance).values_list('key', flat=True):
+            invalidate_token(key)
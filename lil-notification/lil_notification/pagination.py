@@ -0,0 +1,158 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+import binascii
+import json
+
+from rest_framework.exceptions import NotFound
+from rest_framework.filters import OrderingFilter
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError as DjangoValidationError
+from django.db.models import F, Q
+
+
+class KeysetPagination(BasePagination):
+    """
+    Opt-in alternative to LimitOffsetPagination for deep listings: request it with
+    ?cursor= (empty for the first page), then follow the `next` and `previous` links.
+
+    Pages are found by position rather than by offset: the cursor holds the
+    (ordering field, id) of the row the page starts after, so every page costs the
+    same, and there is no COUNT(*). The ordering comes from the view's OrderingFilter
+    (one field from `ordering_fields`, ties broken by id); rows where the field is
+    null come last, whichever the direction.
+    """
+    cursor_query_param = 'cursor'
+    limit_query_param = 'limit'
+    invalid_cursor_message = 'Invalid cursor'
+
+    @classmethod
+    def requested(cls, request):
+        return cls.cursor_query_param in request.query_params
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.limit = self.get_limit(request)
+        self.field, self.descending = self.get_ordering(request, queryset, view)
+        forward, value, pk = self.decode_cursor(request)
+        self.has_cursor = pk is not None
+
+        if self.has_cursor:
+            queryset = queryset.filter(self.after(value, pk, forward))
+        rows = list(queryset.order_by(*self.order_by(forward))[:self.limit + 1])
+        has_more = len(rows) > self.limit
+        rows = rows[:self.limit]
+        if not forward:
+            rows.reverse()
+
+        # moving forward, we know there are earlier rows if we came from somewhere; and vice versa
+        self.has_next = has_more if forward else self.has_cursor
+        self.has_previous = self.has_cursor if forward else has_more
+        self.page = rows
+        return rows
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
+
+    def get_next_link(self):
+        if not (self.has_next and self.page):
+            return None
+        return self.link(True, self.page[-1])
+
+    def get_previous_link(self):
+        if not (self.has_previous and self.page):
+            return None
+        return self.link(False, self.page[0])
+
+
+    ### helpers ###
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params[self.limit_query_param])
+            if limit > 0:
+                return limit
+        except (KeyError, ValueError):
+            pass
+        return api_settings.PAGE_SIZE
+
+    def get_ordering(self, request, queryset, view):
+        """
+        Returns the model field to order by (None to order by id alone),
+        and whether the order is descending.
+        """
+        ordering = OrderingFilter().get_ordering(request, queryset, view) or ['id']
+        name = ordering[0]
+        descending = name.startswith('-')
+        name = name.lstrip('-')
+        if name in ('id', 'pk'):
+            return None, descending
+        try:
+            return queryset.model._meta.get_field(name), descending
+        except FieldDoesNotExist:
+            return None, descending
+
+    def order_by(self, forward):
+        """
+        Rows in forward order, or in reverse order for a backward page.
+        """
+        descending = self.descending != (not forward)
+        id_order = '-id' if descending else 'id'
+        if self.field is None:
+            return [id_order]
+        # nulls come last going forward, so first going backward
+        nulls = {'nulls_last': True} if forward else {'nulls_first': True}
+        expression = F(self.field.name)
+        return [expression.desc(**nulls) if descending else expression.asc(**nulls), id_order]
+
+    def after(self, value, pk, forward):
+        """
+        A filter for the rows after the cursor's position, in the direction of travel.
+        """
+        descending = self.descending != (not forward)
+        lookup = 'lt' if descending else 'gt'
+        id_after = Q(**{'id__' + lookup: pk})
+        if self.field is None:
+            return id_after
+
+        name = self.field.name
+        if value is None:
+            if forward:
+                # nulls are last: only nulls follow a null
+                return Q(**{name + '__isnull': True}) & id_after
+            return Q(**{name + '__isnull': False}) | (Q(**{name + '__isnull': True}) & id_after)
+        after = Q(**{name + '__' + lookup: value}) | (Q(**{name: value}) & id_after)
+        if forward:
+            after |= Q(**{name + '__isnull': True})
+        return after
+
+    def link(self, forward, row):
+        value = None
+        if self.field and getattr(row, self.field.attname) is not None:
+            # (at full precision: DjangoJSONEncoder would truncate datetimes to milliseconds)
+            value = self.field.value_to_string(row)
+        cursor = json.dumps([forward, value, row.id])
+        encoded = urlsafe_b64encode(cursor.encode('utf8')).decode('ascii')
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, encoded)
+
+    def decode_cursor(self, request):
+        """
+        Returns (forward, value, id); id is None on the first page.
+        """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return True, None, None
+        try:
+            forward, value, pk = json.loads(urlsafe_b64decode(encoded.encode('ascii')).decode('utf8'))
+            if value is not None and self.field is not None:
+                value = self.field.to_python(value)
+            return bool(forward), value, int(pk)
+        except (TypeError, ValueError, UnicodeError, binascii.Error, DjangoValidationError):
+            raise NotFound(self.invalid_cursor_message)
@@ -0,0 +1,110 @@
+import random
+import threading
+import time
+
+from django.conf import settings
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` events per second on average, and bursts of up to `burst` events.
+    """
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+
+    def consume(self, tokens=1):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def full(self):
+        return self.tokens + (self.clock() - self.updated) * self.rate >= self.burst
+
+
+class TokenBuckets(object):
+    """
+    A TokenBucket per key, e.g. per group, made on first use.
+    A bucket that has refilled is no different from a new one, so those are
+    dropped whenever there are more than `max_keys`.
+    """
+
+    def __init__(self, rate, burst, max_keys=10000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.clock = clock
+        self.buckets = {}
+
+    def consume(self, key, tokens=1):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_keys:
+                self.buckets = {key: bucket for key, bucket in self.buckets.items() if not bucket.full()}
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst, self.clock)
+        return bucket.consume(tokens)
+
+
+class ConnectAdmission(object):
+    """
+    Per-worker admission control for WebSocket connects.
+
+    A connect is admitted if fewer than `max_concurrent` connects are being set up
+    right now, and the accept rate allows it. Rejected clients are told when to
+    come back: each rejection books the next free slot at the accept rate, so
+    a reconnecting herd is spread out instead of returning all at once.
+    """
+
+    def __init__(self, max_concurrent, rate, burst, max_retry_after, clock=time.monotonic):
+        self.max_concurrent = max_concurrent
+        self.bucket = TokenBucket(rate, burst, clock)
+        self.max_retry_after = max_retry_after
+        self.clock = clock
+        self.in_progress = 0
+        self.booked_until = clock()
+        self._lock = threading.Lock()
+
+    def try_enter(self):
+        """
+        Returns True if the connect may proceed; it must then call leave() when done.
+        """
+        with self._lock:
+            if self.in_progress >= self.max_concurrent or not self.bucket.consume():
+                return False
+            self.in_progress += 1
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.in_progress -= 1
+
+    def retry_after(self):
+        """
+        Seconds a rejected client should wait before reconnecting, with jitter.
+        """
+        with self._lock:
+            now = self.clock()
+            self.booked_until = min(
+                max(self.booked_until, now) + 1.0 / self.bucket.rate,
+                now + self.max_retry_after
+            )
+            delay = self.booked_until - now
+        if delay >= self.max_retry_after:
+            return random.uniform(self.max_retry_after / 2, self.max_retry_after)
+        return random.uniform(delay, min(delay * 1.5, self.max_retry_after))
+
+
+connect_admission = ConnectAdmission(
+    max_concurrent=settings.WS_CONNECT_MAX_CONCURRENT,
+    rate=settings.WS_CONNECT_RATE,
+    burst=settings.WS_CONNECT_BURST,
+    max_retry_after=settings.WS_RETRY_AFTER_MAX
+)
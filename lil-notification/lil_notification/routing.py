@@ -3,5 +3,11 @@ from django.urls import path
 from . import consumers
 
 websocket_urlpatterns = [
+    path('ws/multiplex', consumers.MultiplexConsumer),
     path('ws/<app_slug>/<tier>', consumers.ChatConsumer),
 ]
+
+http_urlpatterns = [
+    path('sse/<app_slug>/<tier>', consumers.ServerSentEventsConsumer),
+    path('poll/<app_slug>/<tier>', consumers.LongPollConsumer),
+]
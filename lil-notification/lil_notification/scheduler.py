@@ -0,0 +1,164 @@
+import asyncio
+import heapq
+
+from channels.layers import get_channel_layer
+
+from django.conf import settings
+from django.db.models import CharField, Value
+from django.db.models.functions import Concat
+from django.utils import timezone
+
+from . import bulk
+from .models import MaintenanceEvent, ACTIVE_STATUSES, SCHEDULER_GROUP
+
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Scheduler(object):
+    """
+    Starts maintenance events at their scheduled_start and completes them at their
+    scheduled_end, filling in `started` and `ended`.
+
+    Keeps a heap of the times at which active events are due to change, with the maintenance
+    group of each event's application, and sleeps until the earliest. Runs in its own process
+    (see the run_scheduler management command). Listens on the channel layer's SCHEDULER_GROUP,
+    which the dispatcher pokes with the groups it published broadcasts to (i.e., whose events'
+    status or schedule changed), and updates just those groups' entries when poked. The whole
+    heap is reloaded every `resync_interval` seconds, in case a poke was lost.
+    """
+
+    def __init__(self, batch_size=None, resync_interval=None):
+        self.batch_size = batch_size or settings.SCHEDULER_BATCH_SIZE
+        self.resync_interval = resync_interval or settings.SCHEDULER_RESYNC_INTERVAL
+        self.loop = asyncio.new_event_loop()
+        self.channel_layer = get_channel_layer()
+        self.channel_name = None
+        # (timestamp, group), including entries since replaced: see is_current()
+        self.heap = []
+        # group -> the timestamps its active events are due at
+        self.due = {}
+
+    def close(self):
+        if self.channel_name:
+            self.loop.run_until_complete(self.channel_layer.group_discard(SCHEDULER_GROUP, self.channel_name))
+        self.loop.close()
+
+    def listen(self):
+        self.channel_name = self.loop.run_until_complete(self.channel_layer.new_channel())
+        self.loop.run_until_complete(self.channel_layer.group_add(SCHEDULER_GROUP, self.channel_name))
+
+    def run(self):
+        self.listen()
+        self.load()
+        resync_at = timezone.now().timestamp() + self.resync_interval
+        while True:
+            self.apply_due()
+            timeout = min(self.seconds_until_due(), resync_at - timezone.now().timestamp())
+            poke = self.wait(max(timeout, 0))
+            if timezone.now().timestamp() >= resync_at or (poke is not None and 'groups' not in poke):
+                self.load()
+                resync_at = timezone.now().timestamp() + self.resync_interval
+            elif poke is not None:
+                self.update(poke['groups'])
+
+    @staticmethod
+    def schedules(groups=None):
+        """
+        The (group, timestamp) of each time the active events (of these groups) are due to change.
+        (The partial index from migration 0007 covers exactly those rows.)
+        """
+        events = MaintenanceEvent.objects.filter(status__in=ACTIVE_STATUSES).annotate(
+            # models.maintenance_group(), in SQL
+            group=Concat(
+                Value('maintenance_'), 'application__slug', Value('_'), 'application__tier', output_field=CharField()
+            )
+        )
+        if groups is not None:
+            events = events.filter(group__in=groups)
+        for group, status, start, end in events.values_list('group', 'status', 'scheduled_start', 'scheduled_end'):
+            if status == 'imminent' and start:
+                yield group, start.timestamp()
+            if end:
+                yield group, end.timestamp()
+
+    def load(self):
+        """
+        Rebuild the heap from the schedules of all the active events.
+        """
+        self.due = {}
+        for group, timestamp in self.schedules():
+            self.due.setdefault(group, set()).add(timestamp)
+        self.heap = [(timestamp, group) for group, timestamps in self.due.items() for timestamp in timestamps]
+        heapq.heapify(self.heap)
+
+    def update(self, groups):
+        """
+        Replace the schedules of these groups' active events with their current ones.
+        (A group's entries are all those of its application's active events: there should only be one.)
+        """
+        for group in groups:
+            self.due.pop(group, None)
+        for group, timestamp in self.schedules(groups):
+            self.due.setdefault(group, set()).add(timestamp)
+            heapq.heappush(self.heap, (timestamp, group))
+        # replaced entries are skipped as they come up; don't let them pile up in between
+        if len(self.heap) > 2 * sum(len(timestamps) for timestamps in self.due.values()) + 100:
+            self.heap = [(timestamp, group) for group, timestamps in self.due.items() for timestamp in timestamps]
+            heapq.heapify(self.heap)
+
+    def is_current(self, entry):
+        timestamp, group = entry
+        return timestamp in self.due.get(group, ())
+
+    def seconds_until_due(self):
+        while self.heap and not self.is_current(self.heap[0]):
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return float('inf')
+        return self.heap[0][0] - timezone.now().timestamp()
+
+    def wait(self, timeout):
+        """
+        Sleep for up to `timeout` seconds; returns the poke that woke us, if any.
+        """
+        try:
+            return self.loop.run_until_complete(asyncio.wait_for(self.channel_layer.receive(self.channel_name), timeout))
+        except asyncio.TimeoutError:
+            return None
+
+    def apply_due(self):
+        """
+        Transition all events that are due. Returns the number of transitions made.
+        """
+        now = timezone.now()
+        while self.heap and self.heap[0][0] <= now.timestamp():
+            timestamp, group = heapq.heappop(self.heap)
+            if self.is_current((timestamp, group)):
+                self.due[group].discard(timestamp)
+                if not self.due[group]:
+                    del self.due[group]
+        # starts first, so that an event whose whole window has passed is started, then completed
+        count = self.transition(
+            MaintenanceEvent.objects.filter(status='imminent', scheduled_start__lte=now),
+            status='in_progress',
+            started=now
+        )
+        count += self.transition(
+            MaintenanceEvent.objects.filter(status__in=ACTIVE_STATUSES, scheduled_end__lte=now),
+            status='completed',
+            ended=now
+        )
+        return count
+
+    def transition(self, due, **fields):
+        count = 0
+        while True:
+            ids = list(due.order_by('id').values_list('id', flat=True)[:self.batch_size])
+            if not ids:
+                return count
+            # (update_events re-checks `due` once the rows are locked)
+            events = bulk.update_events(due.filter(id__in=ids), **fields)
+            logger.info('Scheduled transition to {} for MaintenanceEvents {}'.format(fields['status'], ids))
+            count += len(events)
@@ -1,5 +1,9 @@
 from rest_framework import serializers
+from rest_framework.settings import api_settings
 
+from django.core.exceptions import ValidationError as DjangoValidationError
+
+from . import bulk
 from .models import Application, MaintenanceEvent
 
 
@@ -51,11 +55,24 @@ class MaintenanceEventSerializer(BaseSerializer):
             'reason'
         ]
 
+    already_active_message = 'There is already an active maintenance event for this application.'
+
     def validate(self, attrs):
-        if MaintenanceEvent.invalid_active_status_for_pk(self.initial_data.get('id'), attrs.get('status')):
-            raise serializers.ValidationError('There is already an active maintenance event for this application.')
+        application = attrs['application'].id if 'application' in attrs else self.instance.application_id
+        status = attrs.get('status', self.instance.status if self.instance else None)
+        if MaintenanceEvent.other_active_event_exists(application, self.instance and self.instance.id, status):
+            raise serializers.ValidationError(self.already_active_message)
         return attrs
 
+    def save(self, **kwargs):
+        # Lost a race with another request: see MaintenanceEvent.save
+        try:
+            return super(MaintenanceEventSerializer, self).save(**kwargs)
+        except DjangoValidationError:
+            raise serializers.ValidationError({
+                api_settings.NON_FIELD_ERRORS_KEY: [self.already_active_message]
+            })
+
 
 class PublicMaintenanceEventSerializer(BaseSerializer):
     """
@@ -76,3 +93,42 @@ class PublicMaintenanceEventSerializer(BaseSerializer):
             # 'reason'
         ]
         depth = 1
+
+
+class BulkTargetSerializer(serializers.Serializer):
+    slug = serializers.CharField()
+    tier = serializers.CharField()  # "*" for all tiers
+
+
+class BulkMaintenanceEventSerializer(serializers.ModelSerializer):
+    """
+    Validates requests to change the maintenance events of many applications at once:
+    the applications, by id or by slug and tier, and the event fields to set.
+    validated_data['applications'] holds the Applications, resolved in one query.
+    """
+    applications = serializers.ListField(child=serializers.IntegerField(), required=False)
+    targets = BulkTargetSerializer(many=True, required=False)
+
+    class Meta:
+        model = MaintenanceEvent
+        fields = [
+            'applications',
+            'targets',
+            'status',
+            'scheduled_start',
+            'scheduled_end',
+            'started',
+            'ended',
+            'reason'
+        ]
+
+    def validate(self, attrs):
+        ids = attrs.pop('applications', [])
+        targets = [(target['slug'], target['tier']) for target in attrs.pop('targets', [])]
+        if not (ids or targets):
+            raise serializers.ValidationError('Pass "applications" (a list of ids) or "targets" (a list of {"slug": ..., "tier": ...}; tier may be "*").')
+        try:
+            attrs['applications'] = bulk.resolve_applications(ids, targets)
+        except DjangoValidationError as e:
+            raise serializers.ValidationError(e.messages)
+        return attrs
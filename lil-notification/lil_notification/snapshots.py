@@ -0,0 +1,328 @@
+import asyncio
+from collections import OrderedDict, namedtuple
+import hashlib
+import json
+import threading
+import time
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+
+from django.conf import settings
+from django.db.models import Max, Q
+
+from . import metrics
+
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# get_details_for_ws() when no maintenance event is active
+INACTIVE_STATUS = json.dumps({
+    'active': False,
+    'status': None,
+    'scheduled_start': None,
+    'scheduled_end': None,
+})
+
+
+def state_version(text):
+    """
+    A short, stable identifier for a maintenance state: the same in every process.
+    """
+    return hashlib.sha1((text or 'null').encode('utf8')).hexdigest()[:16]
+
+
+class Snapshot(namedtuple('Snapshot', ['exists', 'text', 'modified', 'sequence'])):
+    """
+    `exists`: whether an Application with this slug and tier exists
+    `text`: get_details_for_ws() of its active maintenance event, JSON-encoded, or None
+    `modified`: when any of its maintenance events last changed, or None
+    `sequence`: the number of the latest broadcast to its group when it was loaded, or 0;
+        the state is at least as new as that broadcast's (see load())
+    """
+    __slots__ = ()
+
+    def __new__(cls, exists, text, modified=None, sequence=0):
+        return super(Snapshot, cls).__new__(cls, exists, text, modified, sequence)
+
+    @property
+    def version(self):
+        return state_version(self.text)
+
+
+class SnapshotCache(object):
+    """
+    Per-process cache of the current maintenance state of each application tier,
+    keyed by (slug, tier). Entries expire after `ttl` seconds, and the least recently
+    used entries are evicted beyond `max_size`.
+
+    The model signals invalidate entries in the process that made the change;
+    other web processes drop theirs when the dispatcher announces the change
+    (see SnapshotChanges), or, should they miss that, when their entry expires.
+    """
+
+    def __init__(self, max_size, ttl, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        # bumped on every invalidation, so that a load that raced with
+        # an invalidation doesn't repopulate the cache with stale data
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def peek(self, slug, tier):
+        """
+        Return the cached snapshot, or None if it is missing or expired. Never hits the DB.
+        """
+        key = (slug, tier)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                snapshot, expires = entry
+                if expires <= self.clock():
+                    del self._entries[key]
+                    entry = None
+                else:
+                    self._entries.move_to_end(key)
+        if entry is None:
+            metrics.SNAPSHOT_LOOKUPS.inc('miss')
+            return None
+        metrics.SNAPSHOT_LOOKUPS.inc('hit')
+        return snapshot
+
+    def get(self, slug, tier):
+        """
+        Return the snapshot, loading it from the DB on a miss.
+        """
+        snapshot = self.peek(slug, tier)
+        if snapshot is None:
+            with self._lock:
+                generation = self._generation
+            with metrics.SNAPSHOT_LOAD_SECONDS.time('load'):
+                snapshot = self.load(slug, tier)
+            self.set(slug, tier, snapshot, generation)
+        return snapshot
+
+    def get_many(self, keys):
+        """
+        Return a dict of (slug, tier) -> snapshot, loading all misses with one pair of queries.
+        """
+        snapshots = {}
+        misses = []
+        for slug, tier in keys:
+            snapshot = self.peek(slug, tier)
+            if snapshot is None:
+                misses.append((slug, tier))
+            else:
+                snapshots[(slug, tier)] = snapshot
+        if misses:
+            with self._lock:
+                generation = self._generation
+            with metrics.SNAPSHOT_LOAD_SECONDS.time('load_many'):
+                loaded = self.load_many(misses)
+            for (slug, tier), snapshot in loaded.items():
+                self.set(slug, tier, snapshot, generation)
+                snapshots[(slug, tier)] = snapshot
+        return snapshots
+
+    async def get_async(self, slug, tier):
+        """
+        Like get(), but only leaves the event loop on a miss.
+        """
+        snapshot = self.peek(slug, tier)
+        if snapshot is None:
+            snapshot = await database_sync_to_async(self.get)(slug, tier)
+        return snapshot
+
+    def set(self, slug, tier, snapshot, generation=None):
+        key = (slug, tier)
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[key] = (snapshot, self.clock() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, slug, tier):
+        with self._lock:
+            self._generation += 1
+            self._entries.pop((slug, tier), None)
+
+    def invalidate_groups(self, groups):
+        """
+        Drop the entries of these maintenance groups.
+        """
+        from .models import maintenance_group
+
+        groups = set(groups)
+        with self._lock:
+            self._generation += 1
+            for key in [key for key in self._entries if maintenance_group(*key) in groups]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    @staticmethod
+    def load(slug, tier):
+        # imported here: models.py imports this module to invalidate entries
+        from .models import Application, Broadcast, MaintenanceEvent, ACTIVE_STATUSES, maintenance_group
+
+        # Before the state: a broadcast is only recorded once the change it carries is committed,
+        # so the state we read next is at least as new as it
+        group = maintenance_group(slug, tier)
+        sequence = Broadcast.latest([group]).get(group, 0)
+
+        # There should only be one active at a time,
+        # but don't be strict here
+        active = MaintenanceEvent.objects.filter(
+            application__slug=slug,
+            application__tier=tier,
+            status__in=ACTIVE_STATUSES
+        ).first()
+        if active:
+            return Snapshot(exists=True, text=json.dumps(active.get_details_for_ws()), modified=active.modified, sequence=sequence)
+        # (when the last event ended, if any)
+        modified = Application.objects.filter(slug=slug, tier=tier).annotate(
+            last_modified=Max('maintenance_events__modified')
+        ).values_list('last_modified', flat=True)
+        if not modified:
+            return Snapshot(exists=False, text=None)
+        return Snapshot(exists=True, text=None, modified=modified[0], sequence=sequence)
+
+    @staticmethod
+    def load_many(keys):
+        from .models import Application, Broadcast, MaintenanceEvent, ACTIVE_STATUSES, maintenance_group
+
+        # before the state, as in load()
+        sequences = Broadcast.latest([maintenance_group(*key) for key in keys])
+
+        query = Q()
+        for slug, tier in keys:
+            query |= Q(slug=slug, tier=tier)
+        existing = {
+            (slug, tier): modified for slug, tier, modified in
+            Application.objects.filter(query).annotate(
+                last_modified=Max('maintenance_events__modified')
+            ).values_list('slug', 'tier', 'last_modified')
+        }
+        snapshots = {
+            key: Snapshot(exists=True, text=None, modified=existing[key], sequence=sequences.get(maintenance_group(*key), 0))
+            if key in existing else Snapshot(exists=False, text=None)
+            for key in keys
+        }
+        active = MaintenanceEvent.objects.filter(
+            application__in=Application.objects.filter(query),
+            status__in=ACTIVE_STATUSES
+        ).select_related('application').order_by('-id')
+        # if there's more than one, keep the first, as load() does
+        for event in active:
+            key = (event.application.slug, event.application.tier)
+            snapshots[key] = snapshots[key]._replace(text=json.dumps(event.get_details_for_ws()), modified=event.modified)
+        return snapshots
+
+
+class SnapshotChanges(object):
+    """
+    Keeps a web process' snapshot cache in step with changes saved by other processes
+    (other web workers, the scheduler, the admin): listens to SNAPSHOTS_GROUP, where the
+    dispatcher announces which groups changed before it publishes their broadcasts,
+    and drops their entries.
+
+    Runs as a task on the event loop serving the process' connections, started by
+    SnapshotChangesMiddleware. Should it lose track of the announcements, e.g. while the
+    channel layer is down, it clears the whole cache, and tries again.
+    """
+
+    # channels_redis forgets group members after a day: join again this often
+    RENEW_INTERVAL = 3600  # seconds
+    RETRY_INTERVAL = 5  # seconds
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._task = None
+        self._loop = None
+
+    def follow(self):
+        """
+        Start following the announcements on the current event loop, unless we already are.
+        """
+        if not settings.SNAPSHOT_CACHE_FOLLOW_CHANGES:
+            return
+        loop = asyncio.get_event_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._loop = loop
+            self._task = loop.create_task(self.run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.wait([task])
+
+    async def run(self):
+        from .models import SNAPSHOTS_GROUP
+
+        channel_layer = get_channel_layer()
+        while True:
+            try:
+                channel_name = await channel_layer.new_channel()
+                while True:
+                    await channel_layer.group_add(SNAPSHOTS_GROUP, channel_name)
+                    renew_at = time.monotonic() + self.RENEW_INTERVAL
+                    while time.monotonic() < renew_at:
+                        try:
+                            message = await asyncio.wait_for(
+                                channel_layer.receive(channel_name), renew_at - time.monotonic()
+                            )
+                        except asyncio.TimeoutError:
+                            break
+                        self.cache.invalidate_groups(message['groups'])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Lost track of snapshot changes; retrying in {}s'.format(self.RETRY_INTERVAL))
+                metrics.CHANNEL_LAYER_ERRORS.inc('receive')
+                # we may have missed some
+                self.cache.clear()
+                await asyncio.sleep(self.RETRY_INTERVAL)
+
+
+class SnapshotChangesMiddleware(object):
+    """
+    ASGI middleware making sure the process follows snapshot changes (see SnapshotChanges)
+    on the event loop serving the connections, as soon as it serves one.
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    def __call__(self, scope):
+        inner = self.inner(scope)
+
+        async def application(receive, send):
+            snapshot_changes.follow()
+            await inner(receive, send)
+        return application
+
+
+snapshot_cache = SnapshotCache(
+    max_size=settings.SNAPSHOT_CACHE_MAX_SIZE,
+    ttl=settings.SNAPSHOT_CACHE_TTL
+)
+
+snapshot_changes = SnapshotChanges(snapshot_cache)
+
+
+@metrics.collector
+def snapshot_cache_metrics():
+    return [('lil_snapshot_cache_entries', 'gauge', 'Snapshots cached in this process.', len(snapshot_cache))]
@@ -5,13 +5,40 @@ const cancelTestMessaging = document.getElementById('cancel-test-messaging');
 
 
 const scheme = window.location.protocol == "https:" ? "wss" : "ws";
-const socket = new ReconnectingWebSocket(
-    `${scheme}://${window.location.host}/ws/${app}/${tier}`
-);
+// The server pings us, and closes the socket if we stop answering
+const socketUrl = `${scheme}://${window.location.host}/ws/${app}/${tier}?heartbeat=1`;
+// The sequence number of the last broadcast we saw: on reconnect,
+// the server sends us what we missed since, or just the current state.
+let lastSequence = 0;
+const socket = new ReconnectingWebSocket(`${socketUrl}&since=${lastSequence}`);
+const defaultReconnectInterval = socket.reconnectInterval;
+const defaultMaxReconnectInterval = socket.maxReconnectInterval;
 
 
+socket.onopen = function(e) {
+    // Jitter our next reconnect, so that when the server restarts,
+    // its clients don't all come back in the same instant.
+    socket.reconnectInterval = defaultReconnectInterval * (0.5 + Math.random());
+    socket.maxReconnectInterval = defaultMaxReconnectInterval;
+};
+
 socket.onmessage = function(e) {
     let data = JSON.parse(e.data)
+    if (data['type'] == 'ping'){
+        socket.send(JSON.stringify({'type': 'pong'}));
+        return;
+    }
+    if ('retry_after' in data){
+        // The server is busy: it will close this socket,
+        // and has told us how long to wait before reconnecting.
+        socket.reconnectInterval = data['retry_after'] * 1000;
+        socket.maxReconnectInterval = Math.max(defaultMaxReconnectInterval, socket.reconnectInterval);
+        return;
+    }
+    if ('sequence' in data){
+        lastSequence = data['sequence'];
+        socket.url = `${socketUrl}&since=${lastSequence}`;
+    }
     if (data['active']){
         wrapper.classList.add('active');
         container.innerHTML = `<p>${messageFromData(data)}</p>`;
@@ -0,0 +1,136 @@
+"""
+In-process stand-ins for Redis, for the tests and benchmarks of the sharded channel layer.
+"""
+import asyncio
+from collections import defaultdict, deque
+import time
+
+from .layers import ShardedRedisChannelLayer
+
+
+class InProcessRedis(object):
+    """
+    An in-memory stand-in for one Redis server, implementing just the commands channels_redis uses.
+    Keys don't expire. Each command takes `service_time` seconds, one at a time, like a server
+    working through its clients' commands would.
+    """
+
+    def __init__(self, service_time=0):
+        self.service_time = service_time
+        self.lists = defaultdict(deque)
+        self.sorted_sets = defaultdict(dict)
+        self.busy_until = 0
+        # traffic served, for benchmarks
+        self.commands = 0
+        self.bytes_pushed = 0
+
+    async def serve(self):
+        self.commands += 1
+        if self.service_time:
+            now = time.perf_counter()
+            self.busy_until = max(self.busy_until, now) + self.service_time
+            # the event loop can't sleep for much less than a millisecond: catch up in larger steps
+            if self.busy_until - now >= 0.001:
+                await asyncio.sleep(self.busy_until - now)
+
+    @staticmethod
+    def key(key):
+        return key.encode('utf8') if isinstance(key, str) else key
+
+    async def llen(self, key):
+        await self.serve()
+        return len(self.lists.get(self.key(key), ()))
+
+    async def rpush(self, key, value):
+        await self.serve()
+        items = self.lists[self.key(key)]
+        items.append(value)
+        self.bytes_pushed += len(value)
+        return len(items)
+
+    async def expire(self, key, seconds):
+        await self.serve()
+        return 1
+
+    async def blpop(self, key, timeout=0):
+        key = self.key(key)
+        deadline = time.perf_counter() + timeout if timeout else None
+        await self.serve()
+        while True:
+            if self.lists.get(key):
+                value = self.lists[key].popleft()
+                if not self.lists[key]:
+                    del self.lists[key]
+                return [key, value]
+            if deadline is not None and time.perf_counter() >= deadline:
+                return None
+            await asyncio.sleep(0.001)
+
+    async def zadd(self, key, score, member):
+        await self.serve()
+        self.sorted_sets[self.key(key)][self.key(member)] = score
+        return 1
+
+    async def zrem(self, key, member):
+        await self.serve()
+        return 1 if self.sorted_sets.get(self.key(key), {}).pop(self.key(member), None) is not None else 0
+
+    async def zremrangebyscore(self, key, min, max):
+        await self.serve()
+        members = self.sorted_sets.get(self.key(key), {})
+        removed = [member for member, score in members.items() if min <= score <= max]
+        for member in removed:
+            del members[member]
+        return len(removed)
+
+    async def zrange(self, key, start, stop):
+        await self.serve()
+        members = sorted(self.sorted_sets.get(self.key(key), {}).items(), key=lambda item: item[1])
+        return [member for member, _ in members][start:None if stop == -1 else stop + 1]
+
+    async def eval(self, script, keys=(), args=()):
+        # the only script channels_redis runs: flush(), deleting the keys matching args[0], a prefix and '*'
+        await self.serve()
+        prefix = self.key(args[0].rstrip('*'))
+        for keys in (self.lists, self.sorted_sets):
+            for key in [key for key in keys if key.startswith(prefix)]:
+                del keys[key]
+
+    def close(self):
+        pass
+
+
+# address -> InProcessRedis, shared by every InProcessShardedChannelLayer, as a real server would be
+in_process_servers = {}
+
+
+class InProcessShardedChannelLayer(ShardedRedisChannelLayer):
+    """
+    ShardedRedisChannelLayer against InProcessRedis stand-ins for its hosts, for tests and benchmarks.
+    Instances given the same hosts share them, like processes sharing Redis servers.
+    """
+
+    def __init__(self, hosts=None, service_time=0, **kwargs):
+        super(InProcessShardedChannelLayer, self).__init__(hosts=hosts, **kwargs)
+        self.servers = [
+            in_process_servers.setdefault(str(host['address']), InProcessRedis()) for host in self.hosts
+        ]
+        for server in self.servers:
+            server.service_time = service_time
+
+    def connection(self, index):
+        if not 0 <= index < self.ring_size:
+            raise ValueError('There are only {} hosts - you asked for {}!'.format(self.ring_size, index))
+        return InProcessConnection(self.servers[index])
+
+
+class InProcessConnection(object):
+
+    def __init__(self, server):
+        self.server = server
+
+    async def __aenter__(self):
+        return self.server
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
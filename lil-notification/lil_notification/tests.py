@@ -1,12 +1,51 @@
+import asyncio
+from datetime import timedelta
+from io import StringIO
+import json
 import logging
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import transaction
+from django.utils import timezone
+from django.utils.http import http_date
 
 import pytest
 
-from .models import Application, MaintenanceEvent, ACTIVE_STATUSES
+from config.routing import application as asgi_application
+from .authentication import TokenCache, token_cache
+from .dispatch import Dispatcher
+from .heartbeat import HEARTBEAT_TIMEOUT, PING, Heartbeat
+from . import inbound
+from .layers import HashRing
+from . import export
+from . import consumers
+from . import metrics
+from .models import Application, Broadcast, MaintenanceEvent, OutboxMessage, ACTIVE_STATUSES, SNAPSHOTS_GROUP, channel_message
+from .ratelimit import ConnectAdmission, TokenBucket, TokenBuckets
+from .scheduler import Scheduler
+from .snapshots import INACTIVE_STATUS, Snapshot, SnapshotCache, snapshot_cache, snapshot_changes, state_version
+from .testing import InProcessShardedChannelLayer
 
 # Fixtures
 
+@pytest.fixture(autouse=True)
+def clear_snapshot_cache(settings):
+    # the cache outlives each test's database transaction
+    snapshot_cache.clear()
+    # each test's event loops are short-lived: see test_snapshot_cache_follows_changes
+    settings.SNAPSHOT_CACHE_FOLLOW_CHANGES = False
+
+
+@pytest.fixture(autouse=True)
+def clear_token_cache():
+    token_cache.clear()
+
+
 @pytest.fixture()
 @pytest.mark.django_db
 def application():
@@ -26,6 +65,41 @@ def unsaved_event_for_app(application):
     return Factory()
 
 
+@pytest.fixture()
+def in_memory_channel_layer(settings):
+    settings.CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer'
+        }
+    }
+    return get_channel_layer()
+
+
+@pytest.fixture()
+def dispatcher(settings):
+    settings.BROADCAST_COALESCE_WINDOW = 0
+    d = Dispatcher()
+    yield d
+    d.close()
+
+
+@pytest.fixture()
+def group_listener(in_memory_channel_layer):
+    """
+    Subscribes a channel to the perma prod group; call it to receive what was sent there.
+    """
+    async_to_sync(in_memory_channel_layer.group_add)('maintenance_perma_prod', 'listener')
+
+    def receive():
+        async def receive_all():
+            messages = []
+            while 'listener' in in_memory_channel_layer.channels:
+                messages.append(await in_memory_channel_layer.receive('listener'))
+            return messages
+        return async_to_sync(receive_all)()
+    return receive
+
+
 # Tests
 
 @pytest.mark.django_db
@@ -76,6 +150,194 @@ def test_only_one_active_event(unsaved_event_for_app):
         e1.save()
 
 
+@pytest.mark.django_db
+def test_one_active_event_per_application(unsaved_event_for_app):
+    e1 = unsaved_event_for_app.get()
+    e1.full_clean()
+    e1.save()
+
+    e2 = MaintenanceEvent(application=Application.objects.create(slug='perma', tier='stage'))
+    e2.full_clean()
+    e2.save()
+
+
+@pytest.mark.django_db
+def test_only_one_active_event_enforced_by_database(unsaved_event_for_app):
+    e1 = unsaved_event_for_app.get()
+    e1.save()
+
+    # as if e2 had passed validation before e1 was saved
+    e2 = unsaved_event_for_app.get()
+    with pytest.raises(ValidationError) as excinfo:
+        e2.save()
+    assert 'There is already an active maintenance event for perma prod' in str(excinfo)
+    assert MaintenanceEvent.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_api_rejects_second_active_event(admin_client, unsaved_event_for_app):
+    e1 = unsaved_event_for_app.get()
+    e1.save()
+    url = '/api/applications/{}/maintenance-events/'.format(e1.application.id)
+
+    response = admin_client.post(url, {'status': 'in_progress'})
+    assert response.status_code == 400
+    assert response.json() == {'non_field_errors': ['There is already an active maintenance event for this application.']}
+
+    response = admin_client.post(url, {'status': 'completed'})
+    assert response.status_code == 201
+    e2_url = '/api/maintenance-events/{}/'.format(response.json()['id'])
+    response = admin_client.patch(e2_url, json.dumps({'reason': 'done'}), content_type='application/json')
+    assert response.status_code == 200
+    response = admin_client.patch(e2_url, json.dumps({'status': 'imminent'}), content_type='application/json')
+    assert response.status_code == 400
+
+    response = admin_client.patch('/api/maintenance-events/{}/'.format(e1.id), json.dumps({'status': 'in_progress'}), content_type='application/json')
+    assert response.status_code == 200
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('count', [1, 30])
+def test_list_views_query_count(admin_client, client, django_assert_num_queries, application, count):
+    other = Application.objects.create(slug='h2o', tier='prod')
+    for i in range(count):
+        MaintenanceEvent.objects.create(application=application, status='completed')
+        MaintenanceEvent.objects.create(application=other, status='completed')
+
+    # count, page
+    with django_assert_num_queries(2):
+        response = client.get('/api/maintenance-events/')
+    assert len(response.json()['results']) == count * 2
+    assert response.json()['results'][0]['application']['slug'] in ('perma', 'h2o')
+
+    # session, user, parent, count, page
+    with django_assert_num_queries(5):
+        response = admin_client.get('/api/applications/{}/maintenance-events/?ordering=scheduled_start'.format(application.id))
+    assert len(response.json()['results']) == count
+
+
+@pytest.mark.django_db
+def test_search_maintenance_events(admin_client, application):
+    MaintenanceEvent.objects.create(application=application, status='completed', reason='Database upgrade')
+    MaintenanceEvent.objects.create(application=application, status='completed', reason='Security patches')
+    response = admin_client.get('/api/applications/{}/maintenance-events/?search=UPGRADE'.format(application.id))
+    assert [e['reason'] for e in response.json()['results']] == ['Database upgrade']
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('ordering', ['', 'scheduled_start', '-scheduled_start', '-ended'])
+def test_keyset_pagination(client, django_assert_num_queries, application, ordering):
+    now = timezone.now()
+    starts = [now, None, now - timedelta(days=1), now, None, now + timedelta(days=1), now]
+    events = [MaintenanceEvent.objects.create(application=application, status='completed', scheduled_start=start) for start in starts]
+
+    # nulls last, ties broken by id in the same direction
+    descending = ordering.startswith('-')
+    if ordering.lstrip('-') == 'scheduled_start':
+        expected = sorted(
+            [e for e in events if e.scheduled_start], key=lambda e: (e.scheduled_start, e.id), reverse=descending
+        ) + sorted([e for e in events if not e.scheduled_start], key=lambda e: e.id, reverse=descending)
+    else:
+        expected = sorted(events, key=lambda e: e.id, reverse=descending)
+    expected = [e.id for e in expected]
+
+    url = '/api/maintenance-events/?cursor=&limit=3&ordering={}'.format(ordering)
+    pages = []
+    while url:
+        with django_assert_num_queries(1):
+            response = client.get(url).json()
+        assert 'count' not in response
+        pages.append([e['id'] for e in response['results']])
+        url = response['next']
+    assert sum(pages, []) == expected
+    assert [len(page) for page in pages] == [3, 3, 1]
+
+    # and back again
+    url = response['previous']
+    for page in reversed(pages[:-1]):
+        response = client.get(url).json()
+        assert [e['id'] for e in response['results']] == page
+        url = response['previous']
+    assert url is None
+
+    # offset pagination still works
+    response = client.get('/api/maintenance-events/?limit=3&offset=3').json()
+    assert response['count'] == 7
+    assert client.get('/api/maintenance-events/?cursor=garbage').status_code == 404
+
+
+@pytest.fixture()
+def fleet(application):
+    return [application] + [
+        Application.objects.create(slug=slug, tier=tier)
+        for slug, tier in [('perma', 'stage'), ('h2o', 'prod'), ('h2o', 'stage'), ('capstone', 'prod')]
+    ]
+
+
+@pytest.mark.django_db
+def test_bulk_create_events(admin_client, django_assert_num_queries, fleet):
+    h2o = [a.id for a in fleet if a.slug == 'h2o']
+    request = {
+        'targets': [{'slug': 'h2o', 'tier': '*'}, {'slug': 'perma', 'tier': 'prod'}],
+        'applications': [fleet[-1].id],
+        'status': 'in_progress',
+        'reason': 'OS upgrades',
+    }
+    # session, user, applications, active check, insert, history, outbox (select, insert), and 3 savepoints,
+    # however many applications there are
+    with django_assert_num_queries(14):
+        response = admin_client.post('/api/maintenance-events/bulk/', json.dumps(request), content_type='application/json')
+    assert response.status_code == 201
+    events = MaintenanceEvent.objects.filter(status='in_progress', reason='OS upgrades')
+    assert sorted(e['id'] for e in response.json()) == sorted(e.id for e in events)
+    assert sorted(e.application_id for e in events) == sorted(h2o + [fleet[0].id, fleet[-1].id])
+    assert MaintenanceEvent.history.filter(history_type='+', history_user__username='admin').count() == 4
+    assert sorted(OutboxMessage.objects.values_list('group', flat=True)) == [
+        'maintenance_capstone_prod', 'maintenance_h2o_prod', 'maintenance_h2o_stage', 'maintenance_perma_prod'
+    ]
+    assert snapshot_cache.get('h2o', 'stage').text == json.dumps(events[0].get_details_for_ws())
+
+    # all or nothing
+    request['targets'] = [{'slug': 'perma', 'tier': '*'}]
+    response = admin_client.post('/api/maintenance-events/bulk/', json.dumps(request), content_type='application/json')
+    assert response.status_code == 400
+    assert response.json() == ['There is already an active maintenance event for capstone prod, perma prod.']
+    assert not MaintenanceEvent.objects.filter(application=fleet[1]).exists()
+
+    response = admin_client.post('/api/maintenance-events/bulk/', json.dumps({'targets': [{'slug': 'lil', 'tier': '*'}], 'applications': [999]}), content_type='application/json')
+    assert response.status_code == 400
+    assert response.json() == {'non_field_errors': ['No such application: id 999, lil *.']}
+
+
+@pytest.mark.django_db
+def test_bulk_transition_events(admin_client, fleet):
+    for application in fleet[:3]:
+        MaintenanceEvent.objects.create(application=application)
+    completed = MaintenanceEvent.objects.create(application=fleet[3], status='completed')
+    OutboxMessage.objects.all().delete()
+
+    request = {'targets': [{'slug': 'perma', 'tier': '*'}, {'slug': 'h2o', 'tier': '*'}], 'status': 'in_progress'}
+    response = admin_client.patch('/api/maintenance-events/bulk/', json.dumps(request), content_type='application/json')
+    assert response.status_code == 200
+    assert len(response.json()) == 3
+    assert MaintenanceEvent.objects.filter(status='in_progress').count() == 3
+    assert MaintenanceEvent.history.filter(history_type='~', status='in_progress').count() == 3
+    assert OutboxMessage.objects.count() == 3
+    completed.refresh_from_db()
+    assert completed.status == 'completed'
+
+    # no broadcast if nothing clients see has changed
+    OutboxMessage.objects.all().delete()
+    request = {'applications': [fleet[0].id], 'reason': 'taking longer than expected'}
+    response = admin_client.patch('/api/maintenance-events/bulk/', json.dumps(request), content_type='application/json')
+    assert response.status_code == 200
+    assert MaintenanceEvent.objects.get(application=fleet[0]).reason == 'taking longer than expected'
+    assert not OutboxMessage.objects.exists()
+
+    response = admin_client.patch('/api/maintenance-events/bulk/', json.dumps({'applications': [fleet[0].id]}), content_type='application/json')
+    assert response.status_code == 400
+
+
 @pytest.mark.django_db
 def test_new_event_after_completed_event(unsaved_event_for_app):
     e1 = unsaved_event_for_app.get()
@@ -117,7 +379,7 @@ def test_group_notified_on_save(caplog, unsaved_event_for_app):
         assert record.levelname == 'INFO'
         assert record.name == 'lil_notification.models'
     assert "Notifying perma prod about MaintenanceEvent" in caplog.records[0].msg
-    assert "Notified perma prod about MaintenanceEvent" in caplog.records[1].msg
+    assert "Queued notification for perma prod about MaintenanceEvent" in caplog.records[1].msg
 
 
 @pytest.mark.django_db
@@ -136,7 +398,7 @@ def test_group_notified_on_deletion_of_active(caplog, unsaved_event_for_app):
         assert record.name == 'lil_notification.models'
     assert "Pending deletion of MaintenanceEvent" in caplog.records[0].msg
     assert "Notifying perma prod about MaintenanceEvent" in caplog.records[1].msg
-    assert "Notified perma prod about MaintenanceEvent" in caplog.records[2].msg
+    assert "Queued notification for perma prod about MaintenanceEvent" in caplog.records[2].msg
 
 
 
@@ -156,3 +418,1308 @@ def test_group_not_notified_on_deletion_of_inactive(caplog, unsaved_event_for_ap
         assert record.levelname == 'INFO'
         assert record.name == 'lil_notification.models'
     assert "Pending deletion of MaintenanceEvent" in caplog.records[0].msg
+
+
+@pytest.mark.django_db(transaction=True)
+def test_consumer_sends_active_event_on_connect(in_memory_channel_layer, unsaved_event_for_app):
+    e = unsaved_event_for_app.get()
+    e.save()
+
+    async def connect():
+        communicator = WebsocketCommunicator(asgi_application, '/ws/perma/prod')
+        connected, _ = await communicator.connect()
+        assert connected
+        message = await communicator.receive_json_from()
+        await communicator.disconnect()
+        return message
+
+    assert async_to_sync(connect)() == e.get_details_for_ws()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_consumer_sends_nothing_on_connect_if_inactive(in_memory_channel_layer, application):
+    async def connect():
+        communicator = WebsocketCommunicator(asgi_application, '/ws/perma/prod')
+        connected, _ = await communicator.connect()
+        assert connected
+        assert await communicator.receive_nothing()
+        await communicator.disconnect()
+
+    async_to_sync(connect)()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_consumer_denies_unknown_application(in_memory_channel_layer, application):
+    async def connect():
+        communicator = WebsocketCommunicator(asgi_application, '/ws/perma/stage')
+        connected, _ = await communicator.connect()
+        assert not connected
+
+    async_to_sync(connect)()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_consumer_forwards_group_broadcasts(in_memory_channel_layer, application):
+    async def connect_and_broadcast():
+        communicator = WebsocketCommunicator(asgi_application, '/ws/perma/prod')
+        connected, _ = await communicator.connect()
+        assert connected
+        await in_memory_channel_layer.group_send(
+            'maintenance_perma_prod',
+            channel_message('maintenance_perma_prod', '{"active": true, "status": "in_progress"}')
+        )
+        message = await communicator.receive_from()
+        await communicator.disconnect()
+        return message
+
+    assert async_to_sync(connect_and_broadcast)() == '{"active": true, "status": "in_progress"}'
+
+
+@pytest.fixture()
+def change_before_join(monkeypatch, unsaved_event_for_app):
+    """
+    Saves a maintenance event, and records its broadcast, just before the next consumer joins
+    its group, as if it were published while the consumer was connecting. Returns the event.
+    """
+    e = unsaved_event_for_app.get()
+    join_group = consumers.join_group
+
+    def publish():
+        e.save()
+        Broadcast.record(list(OutboxMessage.objects.all()))
+
+    async def save_then_join(*args):
+        await database_sync_to_async(publish)()
+        await join_group(*args)
+    monkeypatch.setattr(consumers, 'join_group', save_then_join)
+    return e
+
+
+@pytest.mark.django_db(transaction=True)
+def test_consumer_sends_changes_made_while_joining(in_memory_channel_layer, change_before_join):
+    assert snapshot_cache.get('perma', 'prod').text is None
+
+    async def connect():
+        communicator = WebsocketCommunicator(asgi_application, '/ws/perma/prod')
+        assert (await communicator.connect())[0]
+        message = await communicator.receive_json_from()
+        await communicator.disconnect()
+        return message
+
+    assert async_to_sync(connect)() == change_before_join.get_details_for_ws()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_http_consumers_send_changes_made_while_joining(settings, in_memory_channel_layer, change_before_join):
+    settings.LONG_POLL_TIMEOUT = 5
+    assert snapshot_cache.get('perma', 'prod').text is None
+
+    async def poll():
+        communicator = await http_get('/poll/perma/prod?version=0')
+        start = await communicator.receive_output(1)
+        body = await communicator.receive_output(1)
+        await communicator.wait()
+        return start['status'], body['body']
+
+    # answered with the change, not after LONG_POLL_TIMEOUT
+    status, body = async_to_sync(poll)()
+    assert status == 200
+    assert json.loads(body.decode('utf8'))['event'] == change_before_join.get_details_for_ws()
+
+
+def test_snapshot_cache_expires_entries():
+    now = [0]
+    cache = SnapshotCache(max_size=10, ttl=30, clock=lambda: now[0])
+    cache.set('perma', 'prod', Snapshot(exists=True, text=None))
+    now[0] = 29
+    assert cache.peek('perma', 'prod') == Snapshot(exists=True, text=None)
+    now[0] = 30
+    assert cache.peek('perma', 'prod') is None
+    assert len(cache) == 0
+
+
+def test_snapshot_cache_evicts_least_recently_used():
+    cache = SnapshotCache(max_size=2, ttl=30)
+    cache.set('perma', 'prod', Snapshot(exists=True, text=None))
+    cache.set('perma', 'stage', Snapshot(exists=True, text=None))
+    cache.peek('perma', 'prod')
+    cache.set('h2o', 'prod', Snapshot(exists=False, text=None))
+    assert len(cache) == 2
+    assert cache.peek('perma', 'stage') is None
+    assert cache.peek('perma', 'prod')
+    assert cache.peek('h2o', 'prod')
+
+
+def test_snapshot_cache_ignores_loads_that_raced_an_invalidation():
+    cache = SnapshotCache(max_size=10, ttl=30)
+    cache.set('perma', 'prod', Snapshot(exists=True, text=None), generation=0)
+    cache.invalidate('perma', 'prod')
+    cache.set('perma', 'prod', Snapshot(exists=True, text=None), generation=0)
+    assert cache.peek('perma', 'prod') is None
+
+
+@pytest.mark.django_db
+def test_snapshot_cache_loads_once(django_assert_num_queries, unsaved_event_for_app):
+    e = unsaved_event_for_app.get()
+    e.save()
+    Broadcast.objects.create(group='maintenance_perma_prod', sequence=3, payload=json.dumps(e.get_details_for_ws()))
+    snapshot = Snapshot(exists=True, text=json.dumps(e.get_details_for_ws()), modified=e.modified, sequence=3)
+    # latest broadcast, active event
+    with django_assert_num_queries(2):
+        assert snapshot_cache.get('perma', 'prod') == snapshot
+    with django_assert_num_queries(0):
+        assert snapshot_cache.get('perma', 'prod') == snapshot
+
+
+@pytest.mark.django_db
+def test_snapshot_cache_remembers_unknown_applications(django_assert_num_queries):
+    with django_assert_num_queries(3):
+        assert snapshot_cache.get('perma', 'prod') == Snapshot(exists=False, text=None)
+    with django_assert_num_queries(0):
+        assert snapshot_cache.get('perma', 'prod') == Snapshot(exists=False, text=None)
+
+
+@pytest.mark.django_db
+def test_snapshot_invalidated_by_signals(unsaved_event_for_app):
+    assert snapshot_cache.get('perma', 'prod') == Snapshot(exists=True, text=None)
+
+    e = unsaved_event_for_app.get()
+    e.save()
+    assert snapshot_cache.get('perma', 'prod') == Snapshot(exists=True, text=json.dumps(e.get_details_for_ws()), modified=e.modified)
+
+    e.delete()
+    assert snapshot_cache.get('perma', 'prod') == Snapshot(exists=True, text=None)
+
+    e.application.delete()
+    assert snapshot_cache.get('perma', 'prod') == Snapshot(exists=False, text=None)
+
+
+def test_snapshot_cache_invalidates_groups():
+    cache = SnapshotCache(max_size=10, ttl=30)
+    for key in [('perma', 'prod'), ('perma', 'stage'), ('h2o', 'prod')]:
+        cache.set(*key, Snapshot(exists=True, text=None), generation=0)
+    cache.invalidate_groups(['maintenance_perma_prod', 'maintenance_h2o_prod'])
+    assert [key for key in [('perma', 'prod'), ('perma', 'stage'), ('h2o', 'prod')] if cache.peek(*key)] == [('perma', 'stage')]
+    # loads that raced the invalidation aren't cached
+    cache.set('h2o', 'prod', Snapshot(exists=True, text=None), generation=0)
+    assert cache.peek('h2o', 'prod') is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_snapshot_cache_follows_changes(settings, in_memory_channel_layer, application):
+    settings.SNAPSHOT_CACHE_FOLLOW_CHANGES = True
+    Application.objects.create(slug='h2o', tier='prod')
+    snapshot_cache.get_many([('perma', 'prod'), ('h2o', 'prod')])
+
+    async def run():
+        # serving a connection starts following the announcements, on the connection's event loop
+        communicator = WebsocketCommunicator(asgi_application, '/ws/perma/prod')
+        assert (await communicator.connect())[0]
+        await communicator.disconnect()
+        assert in_memory_channel_layer.groups.get(SNAPSHOTS_GROUP)
+
+        # e.g. from the dispatcher, for a change saved by another process
+        await in_memory_channel_layer.group_send(SNAPSHOTS_GROUP, {'type': 'snapshots.changed', 'groups': ['maintenance_perma_prod']})
+        for _ in range(100):
+            if snapshot_cache.peek('perma', 'prod') is None:
+                break
+            await asyncio.sleep(0.01)
+        # (the loop is about to close)
+        await snapshot_changes.stop()
+
+    async_to_sync(run)()
+    assert snapshot_cache.peek('perma', 'prod') is None
+    assert snapshot_cache.peek('h2o', 'prod') is not None
+
+
+@pytest.mark.django_db
+def test_maintenance_monitor(client, application):
+    assert client.get('/perma/prod').status_code == 200
+    assert client.get('/perma/stage').status_code == 404
+
+
+@pytest.mark.django_db
+def test_maintenance_status(client, django_assert_num_queries, unsaved_event_for_app):
+    response = client.get('/api/status/perma/prod')
+    assert response.status_code == 200
+    assert json.loads(response.content.decode('utf8')) == {
+        'active': False,
+        'status': None,
+        'scheduled_start': None,
+        'scheduled_end': None,
+    }
+    assert response['ETag'] == '"{}"'.format(state_version(None))
+    assert 'Last-Modified' not in response
+    assert 'public' in response['Cache-Control']
+    assert 'max-age=5' in response['Cache-Control']
+
+    e = unsaved_event_for_app.get()
+    e.save()
+    response = client.get('/api/status/perma/prod', HTTP_IF_NONE_MATCH='"{}"'.format(state_version(None)))
+    assert response.status_code == 200
+    assert json.loads(response.content.decode('utf8')) == e.get_details_for_ws()
+    etag = response['ETag']
+    assert etag == '"{}"'.format(state_version(json.dumps(e.get_details_for_ws())))
+    assert response['Last-Modified'] == http_date(int(e.modified.timestamp()))
+
+    # revalidation, from the cache
+    with django_assert_num_queries(0):
+        response = client.get('/api/status/perma/prod', HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+    assert response['ETag'] == etag
+    assert 'max-age=5' in response['Cache-Control']
+
+    response = client.get('/api/status/perma/prod', HTTP_IF_MODIFIED_SINCE=http_date(int(e.modified.timestamp())))
+    assert response.status_code == 304
+
+    assert client.get('/api/status/perma/stage').status_code == 404
+    assert client.post('/api/status/perma/prod').status_code == 405
+
+
+@pytest.mark.django_db
+def test_broadcast_queued_until_dispatched(dispatcher, group_listener, unsaved_event_for_app):
+    e = unsaved_event_for_app.get()
+    e.save()
+    assert OutboxMessage.objects.get().group == 'maintenance_perma_prod'
+    assert group_listener() == []
+
+    assert dispatcher.dispatch_batch() == 1
+    assert group_listener() == [channel_message('maintenance_perma_prod', json.dumps(e.get_details_for_ws()), 1)]
+    assert not OutboxMessage.objects.exists()
+    assert dispatcher.dispatch_batch() == 0
+
+
+@pytest.mark.django_db
+def test_dispatcher_announces_changes(dispatcher, in_memory_channel_layer, unsaved_event_for_app):
+    async_to_sync(in_memory_channel_layer.group_add)(SNAPSHOTS_GROUP, 'web-process')
+    e = unsaved_event_for_app.get()
+    e.save()
+    Application.objects.create(slug='h2o', tier='prod').maintenance_events.create()
+    assert dispatcher.dispatch_batch() == 2
+    assert async_to_sync(in_memory_channel_layer.receive)('web-process') == {
+        'type': 'snapshots.changed', 'groups': ['maintenance_h2o_prod', 'maintenance_perma_prod']
+    }
+
+
+@pytest.mark.django_db
+def test_broadcasts_numbered_and_buffered(settings, monkeypatch, dispatcher, group_listener, in_memory_channel_layer, unsaved_event_for_app):
+    settings.BROADCAST_BUFFER_SIZE = 3
+    e = unsaved_event_for_app.get()
+    for status in ['imminent', 'in_progress', 'completed', 'imminent', 'canceled']:
+        e.status = status
+        e.save()
+        assert dispatcher.dispatch_batch() == 1
+    assert [message['sequence'] for message in group_listener()] == [1, 2, 3, 4, 5]
+    assert list(Broadcast.objects.order_by('sequence').values_list('sequence', flat=True)) == [3, 4, 5]
+    assert Broadcast.objects.get(sequence=5).payload == json.dumps(e.get_details_for_ws())
+
+    # failed broadcasts are numbered again when retried
+    async def fail(*args, **kwargs):
+        raise ConnectionError
+    e.status = 'imminent'
+    e.save()
+    monkeypatch.setattr(in_memory_channel_layer, 'group_send', fail)
+    assert dispatcher.dispatch_batch() == 1
+    monkeypatch.undo()
+    assert Broadcast.objects.latest('sequence').sequence == 5
+    OutboxMessage.objects.update(next_attempt=timezone.now())
+    assert dispatcher.dispatch_batch() == 1
+    assert [message['sequence'] for message in group_listener()] == [6]
+
+
+@pytest.mark.django_db
+def test_broadcast_resume(settings):
+    settings.BROADCAST_BUFFER_SIZE = 3
+    group = 'maintenance_perma_prod'
+    assert Broadcast.resume(group, 0) is None
+    assert Broadcast.resume(group, 4) is None
+
+    for sequence in range(4, 7):
+        Broadcast.objects.create(group=group, sequence=sequence, payload='{"n": %s}' % sequence)
+    Broadcast.objects.create(group='maintenance_h2o_prod', sequence=9, payload='{}')
+
+    # missed broadcasts, while they're all still buffered
+    assert Broadcast.resume(group, 3) == [(4, '{"n": 4}'), (5, '{"n": 5}'), (6, '{"n": 6}')]
+    assert Broadcast.resume(group, 5) == [(6, '{"n": 6}')]
+    assert Broadcast.resume(group, 6) == []
+    # otherwise just the latest
+    assert Broadcast.resume(group, 2) == [(6, '{"n": 6}')]
+    assert Broadcast.resume(group, 0) == [(6, '{"n": 6}')]
+    assert Broadcast.resume(group, 7) == [(6, '{"n": 6}')]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_consumer_resumes_from_sequence(in_memory_channel_layer, application):
+    group = 'maintenance_perma_prod'
+    inactive = '{"active": false, "status": "completed", "scheduled_start": null, "scheduled_end": null}'
+    for sequence, status in [(1, 'imminent'), (2, 'in_progress')]:
+        Broadcast.objects.create(group=group, sequence=sequence, payload='{"active": true, "status": "%s"}' % status)
+    Broadcast.objects.create(group=group, sequence=3, payload=inactive)
+
+    async def connect(query):
+        communicator = WebsocketCommunicator(asgi_application, '/ws/perma/prod' + query)
+        assert (await communicator.connect())[0]
+        return communicator
+
+    async def receive_all(communicator):
+        messages = []
+        while not await communicator.receive_nothing():
+            messages.append(await communicator.receive_json_from())
+        return messages
+
+    async def resume():
+        results = {}
+        for query in ['', '?since=1', '?since=3', '?since=0', '?since=junk']:
+            communicator = await connect(query)
+            results[query] = [message.get('sequence') for message in await receive_all(communicator)]
+            await communicator.disconnect()
+
+        # broadcasts already sent aren't sent again, or out of order
+        communicator = await connect('?since=2')
+        await in_memory_channel_layer.group_send(group, channel_message(group, inactive, 3))
+        await in_memory_channel_layer.group_send(group, channel_message(group, inactive, 4))
+        await in_memory_channel_layer.group_send(group, channel_message(group, '{"active": false}'))
+        results['live'] = await receive_all(communicator)
+        await communicator.disconnect()
+        return results
+
+    results = async_to_sync(resume)()
+    assert results[''] == []
+    assert results['?since=1'] == [2, 3]
+    assert results['?since=3'] == []
+    assert results['?since=0'] == [3]
+    assert results['?since=junk'] == []
+    assert results['live'] == [
+        dict(json.loads(inactive), sequence=3),
+        dict(json.loads(inactive), sequence=4),
+        {'active': False},
+    ]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_consumer_resume_without_broadcasts(in_memory_channel_layer, application):
+    async def connect():
+        communicator = WebsocketCommunicator(asgi_application, '/ws/perma/prod?since=0')
+        assert (await communicator.connect())[0]
+        message = await communicator.receive_json_from()
+        await communicator.disconnect()
+        return message
+
+    assert async_to_sync(connect)() == dict(json.loads(INACTIVE_STATUS), sequence=0)
+
+
+@pytest.mark.django_db
+def test_broadcast_not_queued_on_rollback(unsaved_event_for_app):
+    with pytest.raises(RuntimeError):
+        with transaction.atomic():
+            unsaved_event_for_app.get().save()
+            raise RuntimeError
+    assert not OutboxMessage.objects.exists()
+
+
+@pytest.mark.django_db
+def test_failed_broadcast_retried(monkeypatch, dispatcher, group_listener, in_memory_channel_layer, unsaved_event_for_app):
+    e = unsaved_event_for_app.get()
+    e.save()
+
+    async def fail(*args, **kwargs):
+        raise ConnectionError
+    monkeypatch.setattr(in_memory_channel_layer, 'group_send', fail)
+    assert dispatcher.dispatch_batch() == 1
+    monkeypatch.undo()
+    failed = OutboxMessage.objects.get()
+    assert failed.attempts == 1
+    assert 'ConnectionError' in failed.last_error
+    assert failed.next_attempt > timezone.now()
+
+    # changes made during the backoff replace the pending message
+    e.status = 'in_progress'
+    e.save()
+    assert OutboxMessage.objects.get().id == failed.id
+
+    # nothing is due until the backoff has passed
+    assert dispatcher.dispatch_batch() == 0
+    OutboxMessage.objects.update(next_attempt=timezone.now())
+    assert dispatcher.dispatch_batch() == 1
+    assert [json.loads(message['text'])['status'] for message in group_listener()] == ['in_progress']
+
+
+@pytest.mark.django_db
+def test_no_broadcast_if_payload_unchanged(unsaved_event_for_app):
+    e = unsaved_event_for_app.get()
+    e.save()
+    OutboxMessage.objects.all().delete()
+
+    e.reason = 'Upgrading Postgres'
+    e.save()
+    e = MaintenanceEvent.objects.get(id=e.id)
+    e.started = timezone.now()
+    e.save()
+    assert not OutboxMessage.objects.exists()
+
+    e.status = 'in_progress'
+    e.save()
+    assert OutboxMessage.objects.count() == 1
+
+    # changed by another process since this instance was loaded: saving it back is a change
+    stale = MaintenanceEvent.objects.get(id=e.id)
+    MaintenanceEvent.objects.filter(id=e.id).update(status='imminent')
+    OutboxMessage.objects.all().delete()
+    stale.save()
+    assert json.loads(OutboxMessage.objects.get().payload)['status'] == 'in_progress'
+
+
+@pytest.mark.django_db
+def test_rapid_changes_coalesced(settings, unsaved_event_for_app):
+    settings.BROADCAST_COALESCE_WINDOW = 60
+    e = unsaved_event_for_app.get()
+    e.save()
+    e.status = 'in_progress'
+    e.save()
+    e.status = 'completed'
+    e.save()
+
+    message = OutboxMessage.objects.get()
+    assert json.loads(message.payload)['status'] == 'completed'
+    assert message.next_attempt > timezone.now() + timedelta(seconds=59)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_consumer_relays_test_messages(in_memory_channel_layer, application):
+    async def send_test_message():
+        sender = WebsocketCommunicator(asgi_application, '/ws/perma/prod')
+        receiver = WebsocketCommunicator(asgi_application, '/ws/perma/prod')
+        assert (await sender.connect())[0]
+        assert (await receiver.connect())[0]
+        await sender.send_json_to({'active': True, 'status': 'Test message', 'extra': 'ignored'})
+        message = await receiver.receive_json_from()
+        await sender.disconnect()
+        await receiver.disconnect()
+        return message
+
+    assert async_to_sync(send_test_message)() == {'active': True, 'status': 'Test message'}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_test_messages_checked_and_limited(settings, monkeypatch, in_memory_channel_layer, application):
+    settings.WS_TEST_MESSAGE_MAX_BYTES = 300
+    settings.WS_TEST_MESSAGE_RATE = 0
+    settings.WS_TEST_MESSAGE_BURST = 2
+    monkeypatch.setattr(inbound, 'group_test_message_limits', TokenBuckets(rate=0, burst=3))
+    monkeypatch.setattr(inbound, 'low_priority_sender', inbound.LowPrioritySender(max_pending=100))
+
+    def counts():
+        return dict(
+            (result, metric_value('lil_ws_test_messages_total{{result="{}"}}'.format(result)))
+            for result in ('disabled', 'invalid', 'rate_limited', 'relayed', 'too_large')
+        )
+    before = counts()
+
+    async def run():
+        first = WebsocketCommunicator(asgi_application, '/ws/perma/prod')
+        second = WebsocketCommunicator(asgi_application, '/ws/perma/prod')
+        receiver = WebsocketCommunicator(asgi_application, '/ws/perma/prod')
+        for communicator in (first, second, receiver):
+            assert (await communicator.connect())[0]
+
+        # not relayed
+        await first.send_to(text_data='not JSON')
+        await first.send_to(text_data='["active"]')
+        await first.send_to(text_data=json.dumps({'active': 'yes', 'status': 'Test message'}))
+        await first.send_to(text_data=json.dumps({'active': True, 'status': 'x' * 201}))
+        await first.send_to(bytes_data=b'{"active": true}')
+        # two per socket, three per tier
+        for i in range(3):
+            await first.send_json_to({'active': True, 'status': 'Test message {}'.format(i)})
+        received = [(await receiver.receive_json_from())['status'] for _ in range(2)]
+        assert await receiver.receive_nothing()
+        for i in range(3, 5):
+            await second.send_json_to({'active': True, 'status': 'Test message {}'.format(i)})
+        received.append((await receiver.receive_json_from())['status'])
+        assert await receiver.receive_nothing()
+
+        settings.WS_TEST_MESSAGES_ENABLED = False
+        await second.send_json_to({'active': False, 'status': 'Test message canceled'})
+        assert await receiver.receive_nothing()
+
+        settings.WS_TEST_MESSAGES_ENABLED = True
+        await first.send_json_to({'active': True, 'status': 'x' * 300})
+        output = await first.receive_output()
+        while output['type'] != 'websocket.close':
+            output = await first.receive_output()
+        assert output['code'] == inbound.MESSAGE_TOO_BIG
+
+        for communicator in (first, second, receiver):
+            await communicator.disconnect()
+        return received
+
+    assert async_to_sync(run)() == ['Test message 0', 'Test message 1', 'Test message 3']
+    after = counts()
+    assert dict((result, after[result] - before[result]) for result in after) == {
+        'disabled': 1, 'invalid': 5, 'rate_limited': 2, 'relayed': 3, 'too_large': 1
+    }
+
+
+def test_low_priority_sender():
+    sent = []
+
+    class Socket(object):
+        channel_name = 'socket'
+
+        async def send(self, text_data):
+            sent.append(text_data)
+
+    async def run():
+        sender = inbound.LowPrioritySender(max_pending=2)
+        dropped = metric_value('lil_ws_test_deliveries_dropped_total')
+        for text in ('first', 'second', 'third'):
+            sender.submit(Socket(), text)
+        assert len(sender) == 2
+        assert metric_value('lil_ws_test_deliveries_dropped_total') == dropped + 1
+
+        # one message at a time, letting anything else that's ready run in between
+        await asyncio.sleep(0)
+        sent.append('broadcast')
+        while len(sender):
+            await asyncio.sleep(0)
+
+    async_to_sync(run)()
+    assert sent == ['first', 'broadcast', 'second']
+
+
+def test_token_bucket():
+    now = [0]
+    bucket = TokenBucket(rate=2, burst=3, clock=lambda: now[0])
+    assert [bucket.consume() for _ in range(4)] == [True, True, True, False]
+    now[0] = 0.5
+    assert [bucket.consume() for _ in range(2)] == [True, False]
+    now[0] = 100
+    assert [bucket.consume() for _ in range(4)] == [True, True, True, False]
+
+
+def test_token_buckets():
+    now = [0]
+    buckets = TokenBuckets(rate=1, burst=2, max_keys=2, clock=lambda: now[0])
+    assert [buckets.consume('a') for _ in range(3)] == [True, True, False]
+    assert buckets.consume('b')
+    # full buckets are dropped to make room
+    now[0] = 5
+    assert buckets.consume('c')
+    assert set(buckets.buckets) == {'c'}
+
+
+def test_connect_admission_limits_concurrency():
+    admission = ConnectAdmission(max_concurrent=2, rate=100, burst=100, max_retry_after=60)
+    assert admission.try_enter()
+    assert admission.try_enter()
+    assert not admission.try_enter()
+    admission.leave()
+    assert admission.try_enter()
+
+
+def test_connect_admission_spreads_retries():
+    now = [0]
+    admission = ConnectAdmission(max_concurrent=100, rate=10, burst=1, max_retry_after=5, clock=lambda: now[0])
+    assert admission.try_enter()
+    assert not admission.try_enter()
+
+    # each rejected client is booked into a later slot, with jitter
+    delays = [admission.retry_after() for _ in range(100)]
+    for i, delay in enumerate(delays[:49]):
+        slot = (i + 1) / 10.0
+        assert slot <= delay <= slot * 1.5
+    # ...up to the maximum
+    assert all(2.5 <= delay <= 5 for delay in delays[50:])
+
+
+@pytest.mark.django_db(transaction=True)
+def test_consumer_asks_client_to_retry_when_busy(monkeypatch, in_memory_channel_layer, application):
+    admission = ConnectAdmission(max_concurrent=100, rate=1, burst=1, max_retry_after=60)
+    monkeypatch.setattr(consumers, 'connect_admission', admission)
+
+    async def connect():
+        first = WebsocketCommunicator(asgi_application, '/ws/perma/prod')
+        assert (await first.connect())[0]
+        assert admission.in_progress == 0
+
+        second = WebsocketCommunicator(asgi_application, '/ws/perma/prod')
+        assert (await second.connect())[0]
+        hint = await second.receive_json_from()
+        assert (await second.receive_output())['code'] == consumers.RETRY_LATER
+        await second.disconnect()
+        await first.disconnect()
+        return hint
+
+    hint = async_to_sync(connect)()
+    assert 1 <= hint['retry_after'] <= 1.5
+
+
+@pytest.mark.django_db(transaction=True)
+def test_heartbeats(monkeypatch, in_memory_channel_layer, application):
+    heartbeat = Heartbeat(interval=0.05, timeout=0.2)
+    monkeypatch.setattr(consumers, 'heartbeat', heartbeat)
+    reaped = metric_value('lil_ws_reaped_total')
+
+    async def connect(path):
+        communicator = WebsocketCommunicator(asgi_application, path)
+        assert (await communicator.connect())[0]
+        return communicator
+
+    async def run():
+        alive = await connect('/ws/perma/prod?heartbeat=1')
+        dead = await connect('/ws/perma/prod?heartbeat=1')
+        silent = await connect('/ws/perma/prod')
+        assert len(heartbeat) == 2
+
+        def members():
+            return len(in_memory_channel_layer.groups.get('maintenance_perma_prod', {}))
+        assert members() == 3
+
+        # pongs keep a socket open (and aren't taken for test messages)
+        for _ in range(10):
+            assert await alive.receive_from() == PING
+            await alive.send_to(text_data=json.dumps({'type': 'pong'}))
+        while True:
+            output = await dead.receive_output()
+            if output['type'] == 'websocket.close':
+                break
+            assert output['text'] == PING
+        assert output['code'] == HEARTBEAT_TIMEOUT
+        assert members() == 2
+        assert len(heartbeat) == 1
+        # sockets that didn't ask for heartbeats are left alone
+        assert await silent.receive_nothing()
+
+        for communicator in (alive, dead, silent):
+            await communicator.disconnect()
+        assert members() == 0
+        assert len(heartbeat) == 0
+
+    async_to_sync(run)()
+    assert metric_value('lil_ws_reaped_total') == reaped + 1
+
+
+def test_hash_ring():
+    keys = ['maintenance_app{}_prod'.format(i) for i in range(10000)]
+    nodes = ['redis1', 'redis2', 'redis3', 'redis4']
+    ring = HashRing(nodes)
+    owners = [ring.node(key) for key in keys]
+    assert all(2000 <= owners.count(node) <= 3000 for node in range(len(nodes)))
+
+    # the order of the nodes doesn't matter
+    reordered = list(reversed(nodes))
+    reordered_ring = HashRing(reordered)
+    assert [reordered[reordered_ring.node(key)] for key in keys] == [nodes[owner] for owner in owners]
+
+    # adding a node only moves about a fifth of the keys, all to the new node
+    bigger = HashRing(nodes + ['redis5'])
+    moved = [key for key, owner in zip(keys, owners) if bigger.node(key) != owner]
+    assert 1500 <= len(moved) <= 2500
+    assert all(bigger.node(key) == 4 for key in moved)
+
+
+@pytest.mark.parametrize('local_fanout', [False, True])
+def test_sharded_channel_layer(local_fanout):
+    hosts = [('test-redis', port) for port in range(3)]
+
+    async def run():
+        # as if in two processes
+        layers = [InProcessShardedChannelLayer(hosts=hosts, local_fanout=local_fanout) for _ in range(2)]
+        await layers[0].flush()
+        subscribers = {}
+        for i in range(30):
+            group = 'maintenance_app{}_prod'.format(i)
+            layer = layers[i % 2]
+            channel = await layer.new_channel()
+            await layer.group_add(group, channel)
+            subscribers[group] = (layer, channel)
+        # the groups are spread across every host
+        assert all(server.sorted_sets for server in layers[0].servers)
+
+        for n in range(5):
+            for i, group in enumerate(subscribers):
+                await layers[(i + n) % 2].group_send(group, channel_message(group, str(n)))
+        # ...and their messages arrive in order
+        for group, (layer, channel) in subscribers.items():
+            messages = [await layer.receive(channel) for _ in range(5)]
+            assert [message['text'] for message in messages] == ['0', '1', '2', '3', '4']
+            assert all(message['group'] == group for message in messages)
+        await layers[0].flush()
+
+    async_to_sync(run)()
+
+
+def test_local_fanout():
+    group = 'maintenance_perma_prod'
+
+    async def run():
+        # as if in two processes, with three and two subscribers
+        layers = [InProcessShardedChannelLayer(hosts=[('test-redis', 0)], local_fanout=True) for _ in range(2)]
+        server = layers[0].servers[0]
+        await layers[0].flush()
+        subscribers = [(layer, await layer.new_channel()) for layer in layers[:1] * 3 + layers[1:] * 2]
+        for layer, channel in subscribers:
+            await layer.group_add(group, channel)
+        # each process joined the group once, with its inbox
+        assert len(await server.zrange(layers[0]._group_key(group), 0, -1)) == 2
+
+        # a broadcast is one message per process, not per subscriber
+        commands = server.commands
+        await layers[0].group_send(group, channel_message(group, 'first'))
+        assert server.commands - commands == 2 + 3 * 2
+        await layers[1].group_send(group, channel_message(group, 'second'))
+        for layer, channel in subscribers:
+            assert [(await layer.receive(channel))['text'] for _ in range(2)] == ['first', 'second']
+
+        # a process leaves the group with its last subscriber
+        (first, first_channel), (second, second_channel) = subscribers[0], subscribers[3]
+        await first.group_discard(group, first_channel)
+        await second.group_discard(group, second_channel)
+        assert len(await server.zrange(layers[0]._group_key(group), 0, -1)) == 2
+        await second.group_discard(group, subscribers[4][1])
+        assert len(await server.zrange(layers[0]._group_key(group), 0, -1)) == 1
+        await first.group_send(group, channel_message(group, 'third'))
+        for layer, channel in subscribers[1:3]:
+            assert (await layer.receive(channel))['text'] == 'third'
+        assert not any(channel in layer.receive_buffer for layer, channel in [subscribers[0]] + subscribers[3:])
+        await layers[0].flush()
+
+    async_to_sync(run)()
+
+
+@pytest.mark.django_db
+def test_snapshot_cache_loads_many_at_once(django_assert_num_queries, unsaved_event_for_app):
+    e = unsaved_event_for_app.get()
+    e.save()
+    Application.objects.create(slug='perma', tier='stage')
+    Broadcast.objects.create(group='maintenance_perma_stage', sequence=2, payload=INACTIVE_STATUS)
+    # latest broadcasts, applications, active events
+    with django_assert_num_queries(3):
+        snapshots = snapshot_cache.get_many([('perma', 'prod'), ('perma', 'stage'), ('h2o', 'prod')])
+    assert snapshots == {
+        ('perma', 'prod'): Snapshot(exists=True, text=json.dumps(e.get_details_for_ws()), modified=e.modified),
+        ('perma', 'stage'): Snapshot(exists=True, text=None, sequence=2),
+        ('h2o', 'prod'): Snapshot(exists=False, text=None),
+    }
+    with django_assert_num_queries(0):
+        assert snapshot_cache.get_many([('perma', 'prod'), ('h2o', 'prod')]) == {
+            ('perma', 'prod'): snapshots[('perma', 'prod')],
+            ('h2o', 'prod'): snapshots[('h2o', 'prod')],
+        }
+
+
+@pytest.mark.django_db(transaction=True)
+def test_multiplex_consumer(in_memory_channel_layer, unsaved_event_for_app):
+    e = unsaved_event_for_app.get()
+    e.save()
+    Application.objects.create(slug='perma', tier='stage')
+    Application.objects.create(slug='h2o', tier='prod')
+    Application.objects.create(slug='capstone', tier='prod')
+
+    async def watch():
+        communicator = WebsocketCommunicator(asgi_application, '/ws/multiplex')
+        assert (await communicator.connect())[0]
+        await communicator.send_json_to({'action': 'subscribe', 'targets': [
+            {'slug': 'perma', 'tier': '*'},
+            {'slug': 'h2o', 'tier': 'prod'},
+            {'slug': 'h2o', 'tier': 'nonexistent'},
+        ]})
+        snapshot = await communicator.receive_json_from()
+
+        for group in ['maintenance_perma_stage', 'maintenance_capstone_prod']:
+            await in_memory_channel_layer.group_send(group, channel_message(group, '{"active": true}'))
+        update = await communicator.receive_json_from()
+        assert await communicator.receive_nothing()
+
+        await communicator.send_json_to({'action': 'unsubscribe', 'targets': [{'slug': 'perma', 'tier': '*'}]})
+        await communicator.send_json_to({'action': 'unsubscribe', 'targets': [{'slug': 'perma', 'tier': 'prod'}]})
+        await in_memory_channel_layer.group_send('maintenance_perma_stage', channel_message('maintenance_perma_stage', '{"active": true}'))
+        assert await communicator.receive_nothing()
+
+        await communicator.send_to(text_data='nonsense')
+        error = await communicator.receive_json_from()
+        await communicator.disconnect()
+        return snapshot, update, error
+
+    snapshot, update, error = async_to_sync(watch)()
+    assert snapshot == {'type': 'snapshot', 'events': [
+        {'slug': 'h2o', 'tier': 'prod', 'event': None},
+        {'slug': 'perma', 'tier': 'prod', 'event': e.get_details_for_ws()},
+        {'slug': 'perma', 'tier': 'stage', 'event': None},
+    ]}
+    assert update == {'type': 'update', 'slug': 'perma', 'tier': 'stage', 'event': {'active': True}}
+    assert error['type'] == 'error'
+
+
+@pytest.mark.django_db(transaction=True)
+def test_multiplex_frames_limited(settings, in_memory_channel_layer, application):
+    settings.WS_MULTIPLEX_MAX_FRAME_BYTES = 200
+    settings.WS_MULTIPLEX_FRAME_RATE = 0
+    settings.WS_MULTIPLEX_FRAME_BURST = 3
+
+    def counts():
+        return dict(
+            (result, metric_value('lil_ws_multiplex_frames_total{{result="{}"}}'.format(result)))
+            for result in ('invalid', 'rate_limited', 'subscribe', 'too_large', 'unsubscribe')
+        )
+    before = counts()
+
+    async def run():
+        communicator = WebsocketCommunicator(asgi_application, '/ws/multiplex')
+        assert (await communicator.connect())[0]
+        await communicator.send_json_to({'action': 'subscribe', 'targets': [{'slug': 'perma', 'tier': 'prod'}]})
+        assert (await communicator.receive_json_from())['type'] == 'snapshot'
+        await communicator.send_to(bytes_data=b'{}')
+        assert (await communicator.receive_json_from())['type'] == 'error'
+        await communicator.send_json_to({'action': 'unsubscribe', 'targets': [{'slug': 'perma', 'tier': 'prod'}]})
+        # out of tokens
+        await communicator.send_json_to({'action': 'subscribe', 'targets': [{'slug': 'perma', 'tier': 'prod'}]})
+        limited = await communicator.receive_json_from()
+        assert await communicator.receive_nothing()
+
+        await communicator.send_json_to({'action': 'subscribe', 'targets': [{'slug': 'perma', 'tier': 'prod'}] * 10})
+        output = await communicator.receive_output()
+        assert output == {'type': 'websocket.close', 'code': inbound.MESSAGE_TOO_BIG}
+        await communicator.disconnect()
+        return limited
+
+    assert async_to_sync(run)()['message'].startswith('Too many requests')
+    after = counts()
+    assert dict((result, after[result] - before[result]) for result in after) == {
+        'invalid': 1, 'rate_limited': 1, 'subscribe': 1, 'too_large': 1, 'unsubscribe': 1
+    }
+
+
+async def http_get(path):
+    """
+    An ApplicationCommunicator for a GET to our ASGI application, that has sent its request.
+    (channels' HttpCommunicator can't do query strings or streaming.)
+    """
+    path, _, query_string = path.partition('?')
+    communicator = ApplicationCommunicator(asgi_application, {
+        'type': 'http',
+        'http_version': '1.1',
+        'method': 'GET',
+        'path': path,
+        'query_string': query_string.encode('utf8'),
+        'headers': [],
+    })
+    await communicator.send_input({'type': 'http.request', 'body': b''})
+    return communicator
+
+
+@pytest.mark.django_db(transaction=True)
+def test_long_poll(settings, in_memory_channel_layer, unsaved_event_for_app):
+    settings.LONG_POLL_TIMEOUT = 0.1
+    e = unsaved_event_for_app.get()
+    e.save()
+
+    async def poll(path, *broadcasts):
+        communicator = await http_get(path)
+        if broadcasts:
+            # give the consumer time to join the group
+            await asyncio.sleep(0.05)
+            for broadcast in broadcasts:
+                await in_memory_channel_layer.group_send('maintenance_perma_prod', broadcast)
+        start = await communicator.receive_output()
+        body = await communicator.receive_output()
+        await communicator.wait()
+        return start['status'], dict(start['headers']), body['body']
+
+    # without a version, we get the current state right away: not broadcast yet, so version 0
+    status, headers, body = async_to_sync(poll)('/poll/perma/prod')
+    assert status == 200
+    response = json.loads(body.decode('utf8'))
+    assert response == {'version': 0, 'event': e.get_details_for_ws()}
+    assert headers[b'ETag'] == b'"0"'
+
+    # with the current version, we wait, and time out
+    status, headers, body = async_to_sync(poll)('/poll/perma/prod?version=0')
+    assert status == 304
+    assert body == b''
+    assert headers[b'ETag'] == b'"0"'
+
+    # ...unless a later broadcast comes (test messages, and broadcasts the client has seen, don't count)
+    status, headers, body = async_to_sync(poll)(
+        '/poll/perma/prod?version=1',
+        inbound.channel_test_message('maintenance_perma_prod', '{"active": true, "status": "Test message"}'),
+        channel_message('maintenance_perma_prod', '{"active": true}', 1),
+        channel_message('maintenance_perma_prod', '{"active": false}', 2),
+    )
+    assert status == 200
+    assert json.loads(body.decode('utf8')) == {'version': 2, 'event': {'active': False}}
+
+    # a client that has seen a later broadcast than this process has cached isn't sent the older state
+    snapshot_cache.set('perma', 'prod', Snapshot(exists=True, text='{"active": true}', sequence=1))
+    status, headers, body = async_to_sync(poll)('/poll/perma/prod?version=2')
+    assert status == 304
+
+    # an older version, or none of ours, gets the current state right away
+    for version in ('0', 'stale'):
+        status, headers, body = async_to_sync(poll)('/poll/perma/prod?version={}'.format(version))
+        assert json.loads(body.decode('utf8')) == {'version': 1, 'event': {'active': True}}
+
+    status, headers, body = async_to_sync(poll)('/poll/perma/stage')
+    assert status == 404
+
+
+@pytest.mark.django_db(transaction=True)
+def test_server_sent_events(settings, in_memory_channel_layer, unsaved_event_for_app):
+    settings.SSE_KEEPALIVE_INTERVAL = 0.1
+    e = unsaved_event_for_app.get()
+    e.save()
+    text = json.dumps(e.get_details_for_ws())
+
+    async def stream():
+        communicator = await http_get('/sse/perma/prod')
+        start = await communicator.receive_output()
+        chunks = [(await communicator.receive_output())['body']]
+        await in_memory_channel_layer.group_send('maintenance_perma_prod', channel_message('maintenance_perma_prod', '{"active": false}'))
+        chunks.append((await communicator.receive_output())['body'])
+        chunks.append((await communicator.receive_output())['body'])
+        await communicator.send_input({'type': 'http.disconnect'})
+        await communicator.wait()
+        return start, chunks
+
+    start, chunks = async_to_sync(stream)()
+    assert start['status'] == 200
+    assert (b'Content-Type', b'text/event-stream') in start['headers']
+    assert chunks == [
+        'id: {}\ndata: {}\n\n'.format(state_version(text), text).encode('utf8'),
+        'id: {}\ndata: {{"active": false}}\n\n'.format(state_version('{"active": false}')).encode('utf8'),
+        b': keepalive\n\n',
+    ]
+
+
+@pytest.fixture()
+def scheduler(in_memory_channel_layer):
+    s = Scheduler(batch_size=1)
+    yield s
+    s.close()
+
+
+@pytest.mark.django_db
+def test_scheduler_applies_due_transitions(scheduler, fleet):
+    now = timezone.now()
+    hour = timedelta(hours=1)
+    starting = MaintenanceEvent.objects.create(application=fleet[0], scheduled_start=now - hour, scheduled_end=now + hour)
+    ending = MaintenanceEvent.objects.create(application=fleet[1], status='in_progress', scheduled_end=now - hour)
+    missed = MaintenanceEvent.objects.create(application=fleet[2], scheduled_start=now - 2 * hour, scheduled_end=now - hour)
+    upcoming = MaintenanceEvent.objects.create(application=fleet[3], scheduled_start=now + hour)
+    unscheduled = MaintenanceEvent.objects.create(application=fleet[4])
+    OutboxMessage.objects.all().delete()
+
+    scheduler.load()
+    assert scheduler.heap[0] == ((now - 2 * hour).timestamp(), 'maintenance_h2o_prod')
+    assert len(scheduler.heap) == 6
+
+    assert scheduler.apply_due() == 4
+    for e in [starting, ending, missed, upcoming, unscheduled]:
+        e.refresh_from_db()
+    assert starting.status == 'in_progress' and starting.started and not starting.ended
+    assert ending.status == 'completed' and ending.ended
+    assert missed.status == 'completed' and missed.started and missed.ended
+    assert upcoming.status == 'imminent' and not upcoming.started
+    assert unscheduled.status == 'imminent'
+    assert MaintenanceEvent.history.filter(history_type='~').count() == 4
+    assert sorted(OutboxMessage.objects.values_list('group', flat=True)) == [
+        'maintenance_h2o_prod', 'maintenance_perma_prod', 'maintenance_perma_stage'
+    ]
+
+    # the past is gone from the heap: next up are the end of `starting` and the start of `upcoming`
+    assert scheduler.heap[0][0] == (now + hour).timestamp()
+    assert scheduler.due == {
+        'maintenance_perma_prod': {(now + hour).timestamp()},
+        'maintenance_h2o_stage': {(now + hour).timestamp()},
+    }
+    assert 3590 < scheduler.seconds_until_due() <= 3600
+    assert scheduler.apply_due() == 0
+
+
+@pytest.mark.django_db
+def test_scheduler_woken_by_broadcasts(scheduler, dispatcher, unsaved_event_for_app):
+    scheduler.listen()
+    assert not scheduler.wait(0.01)
+
+    e = unsaved_event_for_app.get()
+    e.scheduled_start = timezone.now() + timedelta(minutes=5)
+    e.save()
+    dispatcher.dispatch_batch()
+    assert scheduler.wait(0.01) == {'type': 'schedule.changed', 'groups': ['maintenance_perma_prod']}
+
+
+@pytest.mark.django_db
+def test_scheduler_updates_poked_groups(scheduler, django_assert_num_queries, fleet):
+    now = timezone.now()
+    hour = timedelta(hours=1)
+    perma = MaintenanceEvent.objects.create(application=fleet[0], scheduled_start=now + hour, scheduled_end=now + 2 * hour)
+    h2o = MaintenanceEvent.objects.create(application=fleet[2], scheduled_start=now + 3 * hour)
+    scheduler.load()
+
+    # (without signals, like changes saved by another process)
+    MaintenanceEvent.objects.filter(id=perma.id).update(scheduled_start=now + 4 * hour)
+    MaintenanceEvent.objects.filter(id=h2o.id).update(status='completed')
+    MaintenanceEvent.objects.create(application=fleet[4], status='in_progress', scheduled_end=now + 5 * hour)
+    with django_assert_num_queries(1):
+        scheduler.update(['maintenance_perma_prod', 'maintenance_capstone_prod'])
+    assert scheduler.due == {
+        'maintenance_perma_prod': {(now + 4 * hour).timestamp(), (now + 2 * hour).timestamp()},
+        # not poked
+        'maintenance_h2o_prod': {(now + 3 * hour).timestamp()},
+        'maintenance_capstone_prod': {(now + 5 * hour).timestamp()},
+    }
+    # the replaced start is skipped
+    assert 2 * 3600 - 10 < scheduler.seconds_until_due() <= 2 * 3600
+
+    scheduler.update(['maintenance_h2o_prod'])
+    assert 'maintenance_h2o_prod' not in scheduler.due
+
+
+@pytest.mark.django_db
+def test_token_authentication_cached(client, django_assert_num_queries, admin_user, application):
+    key = admin_user.auth_token.key
+    auth = {'HTTP_AUTHORIZATION': 'ApiKey {}'.format(key)}
+
+    # token and user, count, page
+    with django_assert_num_queries(3):
+        assert client.get('/api/applications/', **auth).status_code == 200
+    with django_assert_num_queries(2):
+        assert client.get('/api/applications/', **auth).status_code == 200
+    assert (token_cache.hits, token_cache.misses) == (1, 1)
+
+    admin_user.is_active = False
+    admin_user.save()
+    assert client.get('/api/applications/', **auth).status_code == 401
+
+    admin_user.is_active = True
+    admin_user.save()
+    assert client.get('/api/applications/', **auth).status_code == 200
+    admin_user.auth_token.delete()
+    assert client.get('/api/applications/', **auth).status_code == 401
+
+
+def test_token_cache_expires_and_evicts_entries():
+    now = [0]
+    cache = TokenCache(max_size=2, ttl=30, clock=lambda: now[0])
+    for key in ['a', 'b', 'c']:
+        cache.set(key, (key, key))
+    assert cache.get('a') is None
+    assert cache.get('c') == ('c', 'c')
+    now[0] = 30
+    assert cache.get('c') is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_token_cache_shared(settings):
+    settings.CACHES = {
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+        'tokens': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tokens'},
+    }
+    worker, other_worker = TokenCache(max_size=10, ttl=30, shared_cache='tokens'), TokenCache(max_size=10, ttl=30, shared_cache='tokens')
+    worker.set('a', ('user', 'token'))
+    assert other_worker.get('a') == ('user', 'token')
+    assert len(worker) == 0
+    worker.invalidate('a')
+    assert other_worker.get('a') is None
+
+    # a lookup in one worker racing a revocation in another doesn't cache the revoked credentials
+    generation = worker.current_generation('a')
+    other_worker.invalidate('a')
+    worker.set('a', ('user', 'token'), generation)
+    assert other_worker.get('a') is None
+    assert worker.get('a') is None
+    worker.set('a', ('user', 'token'), worker.current_generation('a'))
+    assert other_worker.get('a') == ('user', 'token')
+
+
+@pytest.mark.django_db
+def test_prune_history(tmpdir, unsaved_event_for_app):
+    History = MaintenanceEvent.history.model
+    long_ago = timezone.now() - timedelta(days=400)
+
+    old = unsaved_event_for_app.get()
+    old.status = 'completed'
+    old.save()
+    old.reason = 'did it'
+    old.save()
+    gone = unsaved_event_for_app.get()
+    gone.status = 'canceled'
+    gone.save()
+    gone_id = gone.id
+    gone.delete()
+    History.objects.update(history_date=long_ago)
+
+    current = unsaved_event_for_app.get()
+    current.save()
+    for _ in range(3):
+        # e.g. a script PATCHing the same status over and over
+        current.save()
+    current.status = 'in_progress'
+    current.save()
+    assert History.objects.count() == 2 + 2 + 5
+
+    out = StringIO()
+    call_command('prune_history', '--dry-run', stdout=out)
+    assert 'Expired: would delete 3 rows' in out.getvalue()
+    assert 'Unchanged: would delete 3 rows' in out.getvalue()
+    assert History.objects.count() == 9
+
+    archive = tmpdir.join('history.jsonl')
+    out = StringIO()
+    call_command('prune_history', '--batch-size=1', '--archive={}'.format(archive), stdout=out)
+    assert 'Expired: deleted 3 rows' in out.getvalue()
+    assert 'Unchanged: deleted 3 rows' in out.getvalue()
+    assert [json.loads(line)['id'] for line in archive.readlines()] == [old.id, gone_id, gone_id, current.id, current.id, current.id]
+
+    # the latest state of the old event, and each real change to the current one
+    assert list(History.objects.order_by('history_id').values_list('id', 'history_type', 'status')) == [
+        (old.id, '~', 'completed'),
+        (current.id, '+', 'imminent'),
+        (current.id, '~', 'in_progress'),
+    ]
+
+
+@pytest.mark.django_db
+def test_export(admin_client, fleet):
+    first = MaintenanceEvent.objects.create(application=fleet[0])
+    first.status = 'completed'
+    first.save()
+    gone = MaintenanceEvent.objects.create(application=fleet[1], status='canceled')
+    gone_id = gone.id
+    gone.delete()
+    last = MaintenanceEvent.objects.create(application=fleet[2], reason='a, "quoted" reason')
+
+    response = admin_client.get('/api/export/maintenance-events')
+    assert response.status_code == 200
+    assert response.streaming
+    assert response['Content-Type'] == 'application/x-ndjson'
+    rows = [json.loads(line) for line in b''.join(response.streaming_content).decode('utf8').splitlines()]
+    assert [(row['record'], row['id'], row['slug'], row['tier'], row['status']) for row in rows] == [
+        ('event', first.id, 'perma', 'prod', 'completed'),
+        ('event', last.id, 'h2o', 'prod', 'imminent'),
+    ]
+
+    # history follows each event; that of deleted events comes in its place
+    response = admin_client.get('/api/export/maintenance-events?history=1')
+    rows = [json.loads(line) for line in b''.join(response.streaming_content).decode('utf8').splitlines()]
+    assert [(row['record'], row['id'], row['status'], row.get('history_type')) for row in rows] == [
+        ('event', first.id, 'completed', None),
+        ('history', first.id, 'imminent', '+'),
+        ('history', first.id, 'completed', '~'),
+        ('history', gone_id, 'canceled', '+'),
+        ('history', gone_id, 'canceled', '-'),
+        ('event', last.id, 'imminent', None),
+        ('history', last.id, 'imminent', '+'),
+    ]
+
+    MaintenanceEvent.objects.filter(id=first.id).update(modified=timezone.now() - timedelta(days=10))
+    response = admin_client.get('/api/export/maintenance-events?output=csv&since={}'.format(
+        (timezone.now() - timedelta(days=1)).date().isoformat()
+    ))
+    assert response['Content-Type'] == 'text/csv'
+    lines = b''.join(response.streaming_content).decode('utf8').splitlines()
+    assert lines[0].startswith('record,id,application_id,slug,tier,status')
+    assert len(lines) == 2
+    assert lines[1].startswith('event,{},{},h2o,prod,imminent'.format(last.id, fleet[2].id))
+    assert '"a, ""quoted"" reason"' in lines[1]
+
+    assert admin_client.get('/api/export/maintenance-events?output=xml').status_code == 400
+    assert admin_client.get('/api/export/maintenance-events?until=tomorrow').status_code == 400
+
+
+@pytest.mark.django_db
+def test_export_command(tmpdir, fleet):
+    for application in fleet:
+        MaintenanceEvent.objects.create(application=application, status='completed')
+
+    out = StringIO()
+    call_command('export_events', '--chunk-size=2', '--history', stdout=out)
+    rows = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [row['record'] for row in rows] == ['event', 'history'] * len(fleet)
+
+    f = tmpdir.join('events.csv')
+    call_command('export_events', '--output-format=csv', '--until=2000-01-01', '--file={}'.format(f))
+    assert f.read().splitlines() == [','.join(export.EVENT_COLUMNS)]
+
+
+def metric_value(sample):
+    """
+    The value of e.g. 'lil_group_joins_total{group="maintenance_perma_prod"}' in the current metrics, or 0.
+    """
+    for line in metrics.render().splitlines():
+        name, _, value = line.rpartition(' ')
+        if name == sample:
+            return float(value)
+    return 0
+
+
+def test_metrics_rendering():
+    counter = metrics.Counter('test_requests_total', 'Requests.', ['path'])
+    histogram = metrics.Histogram('test_latency_seconds', 'Latency.', buckets=(0.1, 1))
+    try:
+        counter.inc('/a')
+        counter.inc('/a', amount=2)
+        counter.inc('say "hi"\n')
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value)
+        text = metrics.render()
+    finally:
+        metrics._metrics.remove(counter)
+        metrics._metrics.remove(histogram)
+
+    assert """# HELP test_requests_total Requests.
+# TYPE test_requests_total counter
+test_requests_total{path="/a"} 3
+test_requests_total{path="say \\"hi\\"\\n"} 1
+# HELP test_latency_seconds Latency.
+# TYPE test_latency_seconds histogram
+test_latency_seconds_bucket{le="0.1"} 1
+test_latency_seconds_bucket{le="1"} 2
+test_latency_seconds_bucket{le="+Inf"} 3
+test_latency_seconds_sum 5.55
+test_latency_seconds_count 3
+""" in text
+
+
+@pytest.mark.django_db(transaction=True)
+def test_metrics(client, admin_user, dispatcher, in_memory_channel_layer, unsaved_event_for_app):
+    group = 'group="maintenance_perma_prod"'
+    joins = metric_value('lil_group_joins_total{%s}' % group)
+    leaves = metric_value('lil_group_leaves_total{%s}' % group)
+    subscribers = metric_value('lil_group_subscribers{%s}' % group)
+    connects = metric_value('lil_ws_connect_seconds_count{consumer="ChatConsumer"}')
+    sends = metric_value('lil_ws_send_seconds_count{consumer="ChatConsumer"}')
+    published = metric_value('lil_broadcasts_published_total')
+    requests = metric_value('lil_http_request_seconds_count{view="maintenance_status",method="GET"}')
+
+    async def connect_and_receive():
+        communicator = WebsocketCommunicator(asgi_application, '/ws/perma/prod')
+        assert (await communicator.connect())[0]
+        assert metric_value('lil_group_joins_total{%s}' % group) == joins + 1
+        assert metric_value('lil_group_subscribers{%s}' % group) == subscribers + 1
+        await in_memory_channel_layer.group_send('maintenance_perma_prod', channel_message('maintenance_perma_prod', '{}'))
+        await communicator.receive_from()
+        await communicator.disconnect()
+    async_to_sync(connect_and_receive)()
+    assert metric_value('lil_ws_connect_seconds_count{consumer="ChatConsumer"}') == connects + 1
+    assert metric_value('lil_ws_send_seconds_count{consumer="ChatConsumer"}') == sends + 1
+    assert metric_value('lil_group_leaves_total{%s}' % group) == leaves + 1
+    assert metric_value('lil_group_subscribers{%s}' % group) == subscribers
+
+    unsaved_event_for_app.get().save()
+    assert dispatcher.dispatch_batch() == 1
+    assert metric_value('lil_broadcasts_published_total') == published + 1
+    assert metric_value('lil_broadcast_publish_seconds_count') >= 1
+    assert metric_value('lil_broadcast_delay_seconds_count') >= 1
+
+    assert client.get('/api/status/perma/prod').status_code == 200
+    assert metric_value('lil_http_request_seconds_count{view="maintenance_status",method="GET"}') == requests + 1
+    assert metric_value('lil_http_responses_total{view="maintenance_status",status="200"}') >= 1
+
+    # staff only, whatever the address
+    assert client.get('/metrics').status_code == 401
+    response = client.get('/metrics', HTTP_AUTHORIZATION='ApiKey {}'.format(admin_user.auth_token.key))
+    assert response.status_code == 200
+    assert response['Content-Type'] == metrics.CONTENT_TYPE
+    assert b'# TYPE lil_ws_connect_seconds histogram' in response.content
+    assert b'lil_token_cache_hits_total ' in response.content
@@ -18,6 +18,10 @@ urlpatterns = [
     path('api/applications/<int:pk>/', views.ApplicationDetailView.as_view(), name='applications_detail'),
     re_path(r'^api/(?P<parent_type>applications)/(?P<parent_id>[0-9]+)/maintenance-events/?$', views.ApplicationMaintenanceEventListView.as_view(), name='applications_events'),
     path('api/maintenance-events/', views.MaintenanceEventListView.as_view(), name='maintenance_events'),
+    path('api/maintenance-events/bulk/', views.MaintenanceEventBulkView.as_view(), name='maintenance_events_bulk'),
     path('api/maintenance-events/<int:pk>/', views.MaintenanceEventDetailView.as_view(), name='maintenance_events_detail'),
+    path('api/status/<app>/<tier>', views.maintenance_status, name='maintenance_status'),
+    path('api/export/maintenance-events', views.MaintenanceEventExportView.as_view(), name='maintenance_events_export'),
+    path('metrics', views.MetricsView.as_view(), name='metrics'),
     path('<app>/<tier>', views.maintenance_monitor, name='maintenance_monitor')
 ]
@@ -12,13 +12,19 @@ from django_filters.rest_framework import DjangoFilterBackend, FilterSet
 
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist, ValidationError as DjangoValidationError
-from django.http import Http404
-from django.shortcuts import render, get_object_or_404
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.shortcuts import render
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
 from django.utils.safestring import mark_safe
+from django.views.decorators.http import require_safe
 
+from . import bulk, export, metrics
 from .models import Application, MaintenanceEvent
-from .serializers import ApplicationSerializer, MaintenanceEventSerializer, \
+from .pagination import KeysetPagination
+from .serializers import ApplicationSerializer, BulkMaintenanceEventSerializer, MaintenanceEventSerializer, \
     PublicMaintenanceEventSerializer
+from .snapshots import INACTIVE_STATUS, snapshot_cache
 
 
 ###
@@ -26,7 +32,8 @@ from .serializers import ApplicationSerializer, MaintenanceEventSerializer, \
 ###
 
 def maintenance_monitor(request, app, tier):
-    get_object_or_404(Application, slug=app, tier=tier)
+    if not snapshot_cache.get(app, tier).exists:
+        raise Http404
     return render(request, 'maintenance_monitor.html', {
         'app': app,
         'app_json': mark_safe(json.dumps(app)),
@@ -35,6 +42,50 @@ def maintenance_monitor(request, app, tier):
     })
 
 
+###
+# Status
+###
+
+@require_safe
+def maintenance_status(request, app, tier):
+    """
+    The current maintenance status of an application tier, cheap enough to poll.
+
+    Served from the snapshot cache, bypassing DRF's authentication and pagination;
+    conditional requests are answered with 304 Not Modified without touching the DB
+    (when the snapshot is cached), and CDNs may cache responses for STATUS_CACHE_MAX_AGE seconds.
+    The ETag is the version used by the SSE and long-poll transports.
+    """
+    snapshot = snapshot_cache.get(app, tier)
+    if not snapshot.exists:
+        raise Http404
+    etag = quote_etag(snapshot.version)
+    last_modified = int(snapshot.modified.timestamp()) if snapshot.modified else None
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = HttpResponse(snapshot.text or INACTIVE_STATUS, content_type='application/json')
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, public=True, max_age=settings.STATUS_CACHE_MAX_AGE)
+    return response
+
+
+###
+# Metrics
+###
+
+class MetricsView(APIView):
+    """
+    This process' metrics, for Prometheus to scrape: see metrics.py.
+    Staff only, like the API: scrape with an "Authorization: ApiKey <key>" header.
+    """
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request, format=None):
+        return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
 ###
 # API
 #
@@ -133,10 +184,11 @@ class BaseView(APIView):
     def simple_list(self, request, queryset):
         """
             Paginate and return a list of objects from given queryset.
+            Pass ?cursor= for keyset pagination, which stays fast on deep pages.
         """
         queryset = self.filter_queryset(queryset)
-        paginator = LimitOffsetPagination()
-        items = paginator.paginate_queryset(queryset, request)
+        paginator = KeysetPagination() if KeysetPagination.requested(request) else LimitOffsetPagination()
+        items = paginator.paginate_queryset(queryset, request, view=self)
         serializer = self.serializer_class(items, many=True, context={"request": request})
         return paginator.get_paginated_response(serializer.data)
 
@@ -203,7 +255,7 @@ class ApplicationDetailView(BaseView):
 class ApplicationMaintenanceEventListView(BaseView):
     serializer_class = MaintenanceEventSerializer
     ordering_fields = ('scheduled_start', 'scheduled_end', 'started', 'ended')
-    search_fields = ('reason')
+    search_fields = ('reason',)
 
 
     @load_parent
@@ -234,7 +286,8 @@ class MaintenanceEventListView(BaseView):
 
     def get(self, request, format=None):
         """ List maintenance events. """
-        queryset = MaintenanceEvent.objects.all()
+        # the serializer nests each event's application
+        queryset = MaintenanceEvent.objects.select_related('application')
         return self.simple_list(request, queryset)
 
 
@@ -249,8 +302,60 @@ class MaintenanceEventDetailView(BaseView):
     def patch(self, request, pk, format=None):
         """ Update  maintenance event. """
         # Get id from route, not from request data.
-        data = request.data.copy()
         obj = self.get_object_for_user_by_pk(request.user, pk)
-        # Pass id for validation purposes
-        data['id'] = obj.id
-        return self.simple_update(obj, data)
+        return self.simple_update(obj, request.data)
+
+
+# /maintenance-events/bulk/
+class MaintenanceEventBulkView(BaseView):
+    serializer_class = BulkMaintenanceEventSerializer
+
+    def post(self, request, format=None):
+        """
+        Create a maintenance event for each of many applications.
+        """
+        return self.bulk_change(request, bulk.create_events, status.HTTP_201_CREATED)
+
+    def patch(self, request, format=None):
+        """
+        Update the active maintenance event of each of many applications.
+        """
+        return self.bulk_change(request, bulk.transition_events, status.HTTP_200_OK)
+
+    def bulk_change(self, request, change, success_status):
+        serializer = self.serializer_class(data=request.data, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        fields = dict(serializer.validated_data)
+        applications = fields.pop('applications')
+        try:
+            events = change(applications, user=request.user, **fields)
+        except DjangoValidationError as e:
+            raise ValidationError(e.messages)
+        return Response(MaintenanceEventSerializer(events, many=True).data, status=success_status)
+
+
+# /export/maintenance-events
+class MaintenanceEventExportView(BaseView):
+
+    def get(self, request):
+        """
+        Stream every maintenance event, and optionally its history, as NDJSON or CSV.
+        ?output=ndjson (default) or csv; ?history=1; ?since= and ?until=, dates or datetimes.
+        """
+        output = request.query_params.get('output', 'ndjson')
+        if output not in export.FORMATS:
+            raise ValidationError({'output': 'Expected one of {}.'.format(', '.join(export.FORMATS))})
+        bounds = {}
+        for bound in ['since', 'until']:
+            if request.query_params.get(bound):
+                try:
+                    bounds[bound] = export.parse_bound(request.query_params[bound])
+                except ValueError as e:
+                    raise ValidationError({bound: str(e)})
+
+        response = StreamingHttpResponse(
+            export.export_lines(output, history=request.query_params.get('history') in ('1', 'true'), **bounds),
+            content_type=export.CONTENT_TYPES[output]
+        )
+        response['Content-Disposition'] = 'attachment; filename="maintenance-events.{}"'.format(output)
+        return response